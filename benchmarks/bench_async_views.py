@@ -0,0 +1,104 @@
+"""Compare STK push throughput of the sync and async views.
+
+Both paths run against a local fake Daraja server with a fixed response
+latency. The sync views get a fixed pool of worker threads (what a WSGI
+worker has), the async views get a single event loop with a cap on
+in-flight requests (what one ASGI worker has):
+
+    python benchmarks/bench_async_views.py --requests 400 --threads 8 --concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import percentile, setup_django  # noqa: E402
+from fake_daraja import start_server  # noqa: E402
+
+BODY = json.dumps({'phone_number': '0712345678', 'amount': 1})
+
+
+def report(label, latencies, elapsed):
+    latencies.sort()
+    print(f'{label:>6}: {len(latencies)} requests in {elapsed:.2f}s '
+          f'= {len(latencies) / elapsed:7.1f} req/s  '
+          f'p50 {percentile(latencies, 50) * 1000:.0f}ms  '
+          f'p99 {percentile(latencies, 99) * 1000:.0f}ms')
+
+
+def run_sync(total, threads):
+    from django.contrib.auth.models import AnonymousUser
+    from django.test import RequestFactory
+    from mpesa import views
+
+    factory = RequestFactory()
+
+    def one(_):
+        request = factory.post('/stk-push/', BODY, content_type='application/json')
+        request.user = AnonymousUser()
+        started = time.perf_counter()
+        response = views.stk_push_view(request)
+        assert json.loads(response.content)['success'], response.content
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(one, range(total)))
+    report('sync', latencies, time.perf_counter() - started)
+
+
+def run_async(total, concurrency):
+    from django.contrib.auth.models import AnonymousUser
+    from django.test import AsyncRequestFactory
+    from mpesa import async_views
+    from mpesa.client import get_async_client
+    from mpesa.merchants import aget_merchant
+
+    factory = AsyncRequestFactory()
+
+    async def auser():
+        return AnonymousUser()
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                request = factory.post('/stk-push/', BODY, content_type='application/json')
+                request.auser = auser
+                started = time.perf_counter()
+                response = await async_views.stk_push_view(request)
+                assert json.loads(response.content)['success'], response.content
+                return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(one() for _ in range(total)))
+        report('async', list(latencies), time.perf_counter() - started)
+        await get_async_client(await aget_merchant()).close()
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=8, help='Sync worker threads')
+    parser.add_argument('--concurrency', type=int, default=200, help='Async in-flight requests')
+    parser.add_argument('--latency', type=float, default=0.2, help='Fake Daraja latency in seconds')
+    args = parser.parse_args()
+
+    server = start_server(latency=args.latency)
+    db_path = setup_django(daraja_url=server.url)
+    try:
+        print(f'Fake Daraja latency {args.latency * 1000:.0f}ms, {args.requests} STK pushes')
+        run_sync(args.requests, args.threads)
+        run_async(args.requests, args.concurrency)
+    finally:
+        server.shutdown()
+        if db_path:
+            os.remove(db_path)
@@ -0,0 +1,149 @@
+"""Compare callback ingestion write throughput across database profiles.
+
+Each profile (see MPESA_DB_PROFILE in mcheda/settings.py) runs in its own
+process against a fresh database. Worker threads apply STK callbacks
+inline, as ``/callback/`` does in the default mode, and then store them in
+the callback inbox and drain it, as the queued mode does:
+
+    python benchmarks/bench_db_profiles.py --callbacks 2000 --threads 16
+    python benchmarks/bench_db_profiles.py --profiles sqlite-wal postgres
+
+The postgres profile uses the POSTGRES_* variables and migrates that
+database in place; it is skipped unless POSTGRES_DB is set.
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import setup_django  # noqa: E402
+
+PROFILES = ('sqlite', 'sqlite-wal', 'postgres')
+
+
+def callback_body(checkout_request_id):
+    return {'Body': {'stkCallback': {
+        'MerchantRequestID': 'bench',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': 0,
+        'ResultDesc': 'The service request is processed successfully.',
+        'CallbackMetadata': {'Item': [
+            {'Name': 'Amount', 'Value': 1},
+            {'Name': 'MpesaReceiptNumber', 'Value': uuid.uuid4().hex[:10].upper()},
+            {'Name': 'TransactionDate', 'Value': 20250101120000},
+            {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]},
+    }}}
+
+
+def timed_writes(fn, items, threads):
+    """Call ``fn`` for every item from ``threads`` threads; return (writes/s, errors)
+
+    Connections are recycled after each call like at the end of a request,
+    so CONN_MAX_AGE and pooling settings take effect.
+    """
+    from django.db import close_old_connections
+
+    def one(item):
+        try:
+            fn(item)
+            return True
+        except Exception:
+            return False
+        finally:
+            close_old_connections()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        outcomes = list(pool.map(one, items))
+    elapsed = time.perf_counter() - started
+    return round(len(items) / elapsed, 1), outcomes.count(False)
+
+
+def run_profile(total, threads):
+    """Benchmark the configured profile. Runs in a child process"""
+    db_path = setup_django()
+
+    import logging
+
+    from django.db import connection
+
+    from mpesa.callbacks import drain_inbox, enqueue_callback
+    from mpesa.models import MpesaTransaction
+    from mpesa.views import process_callback
+
+    logging.getLogger('mpesa').setLevel(logging.ERROR)
+
+    def seed():
+        return [
+            t.checkout_request_id for t in MpesaTransaction.objects.bulk_create([
+                MpesaTransaction(phone_number='254712345678', amount=1, status='PENDING',
+                                 checkout_request_id=f'ws_CO_bench_{uuid.uuid4().hex}')
+                for _ in range(total)
+            ], batch_size=1000)
+        ]
+
+    try:
+        inline, inline_errors = timed_writes(
+            lambda checkout_id: process_callback(callback_body(checkout_id)), seed(), threads)
+        queued, queued_errors = timed_writes(
+            lambda checkout_id: enqueue_callback(json.dumps(callback_body(checkout_id))), seed(), threads)
+
+        started = time.perf_counter()
+        drained = 0
+        while True:
+            count = drain_inbox(batch_size=500)
+            drained += count
+            if count < 500:
+                break
+        drain = round(drained / (time.perf_counter() - started), 1)
+        return {
+            'vendor': connection.vendor,
+            'inline_per_s': inline,
+            'inline_errors': inline_errors,
+            'enqueue_per_s': queued,
+            'enqueue_errors': queued_errors,
+            'drain_per_s': drain,
+        }
+    finally:
+        connection.close()
+        if db_path:
+            for path in glob.glob(f'{db_path}*'):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=list(PROFILES))
+    parser.add_argument('--callbacks', type=int, default=2000, help='Callbacks per mode')
+    parser.add_argument('--threads', type=int, default=16, help='Concurrent writers')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_profile(args.callbacks, args.threads)))
+        sys.exit()
+
+    print(f'{args.callbacks} callbacks per mode, {args.threads} writer threads')
+    print(f"{'profile':>10}  {'inline/s':>9} {'errors':>6}  {'enqueue/s':>9} {'errors':>6}  {'drain/s':>9}")
+    for profile in args.profiles:
+        if profile == 'postgres' and not os.getenv('POSTGRES_DB'):
+            print(f'{profile:>10}  skipped (POSTGRES_DB not set)')
+            continue
+        child = subprocess.run(
+            [sys.executable, __file__, '--child', '--callbacks', str(args.callbacks), '--threads', str(args.threads)],
+            env={**os.environ, 'MPESA_DB_PROFILE': profile}, capture_output=True, text=True,
+        )
+        if child.returncode:
+            print(f'{profile:>10}  failed: {child.stderr.strip().splitlines()[-1]}')
+            continue
+        r = json.loads(child.stdout.strip().splitlines()[-1])
+        print(f"{profile:>10}  {r['inline_per_s']:9.1f} {r['inline_errors']:6}  "
+              f"{r['enqueue_per_s']:9.1f} {r['enqueue_errors']:6}  {r['drain_per_s']:9.1f}")
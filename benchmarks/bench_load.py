@@ -0,0 +1,295 @@
+"""End-to-end load benchmark of the payment endpoints.
+
+Serves the app over HTTP on a local threaded WSGI server, backed by the
+fake Daraja server (which also delivers the STK callbacks back to the app),
+and drives each scenario at every requested concurrency level:
+
+    stk_push   POST /stk-push/
+    callback   POST /callback/ for pending transactions
+    status     GET  /transaction/<id>/status/
+    history    GET  /transactions/ for a user with --history-rows transactions
+
+Latency percentiles and throughput are printed and written as JSON to
+``benchmarks/results/`` so runs from different commits can be compared:
+
+    python benchmarks/bench_load.py --concurrency 1 10 50 --requests 500
+    python benchmarks/bench_load.py --compare results/before.json results/after.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import BASE_DIR, percentile, setup_django  # noqa: E402
+from fake_daraja import add_server_arguments, server_options, start_server  # noqa: E402
+
+SCENARIOS = ('stk_push', 'callback', 'status', 'history')
+RESULTS_DIR = BASE_DIR / 'benchmarks' / 'results'
+
+
+class AppServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_app_server():
+    """Bind the app server before Django is set up so the callback URL is known"""
+    server = make_server('127.0.0.1', 0, None, server_class=AppServer, handler_class=QuietHandler)
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=BASE_DIR, capture_output=True, text=True).stdout.strip()
+
+    return {
+        'commit': git('rev-parse', '--short', 'HEAD') or None,
+        'dirty': bool(git('status', '--porcelain', '--', 'mpesa', 'mcheda')),
+    }
+
+
+class Scenario:
+    """A named request generator; ``prepare`` seeds data for ``total`` requests"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def prepare(self, total):
+        pass
+
+    def request(self, session, index):
+        raise NotImplementedError
+
+
+class StkPush(Scenario):
+    name = 'stk_push'
+    body = {'phone_number': '0712345678', 'amount': 1}
+
+    def request(self, session, index):
+        response = session.post(f'{self.base_url}/stk-push/', json=self.body)
+        return response.status_code == 200 and response.json().get('success')
+
+
+def seed_pending(total, user=None):
+    from mpesa.models import MpesaTransaction
+
+    transactions = MpesaTransaction.objects.bulk_create([
+        MpesaTransaction(
+            user=user, phone_number='254712345678', amount=1, status='PENDING',
+            checkout_request_id=f'ws_CO_bench_{uuid.uuid4().hex}',
+        )
+        for _ in range(total)
+    ], batch_size=1000)
+    return transactions
+
+
+class Callback(Scenario):
+    name = 'callback'
+
+    def prepare(self, total):
+        self.checkout_ids = [t.checkout_request_id for t in seed_pending(total)]
+
+    def request(self, session, index):
+        body = {'Body': {'stkCallback': {
+            'MerchantRequestID': 'bench',
+            'CheckoutRequestID': self.checkout_ids[index],
+            'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': 1},
+                {'Name': 'MpesaReceiptNumber', 'Value': uuid.uuid4().hex[:10].upper()},
+                {'Name': 'TransactionDate', 'Value': 20250101120000},
+                {'Name': 'PhoneNumber', 'Value': 254712345678},
+            ]},
+        }}}
+        response = session.post(f'{self.base_url}/callback/', json=body)
+        return response.status_code == 200
+
+
+class Status(Scenario):
+    name = 'status'
+    pool_size = 100  # Distinct transactions polled, like many open payment pages
+
+    def prepare(self, total):
+        self.ids = [str(t.id) for t in seed_pending(min(total, self.pool_size))]
+
+    def request(self, session, index):
+        response = session.get(f'{self.base_url}/transaction/{self.ids[index % len(self.ids)]}/status/')
+        return response.status_code == 200
+
+
+class History(Scenario):
+    name = 'history'
+    rows = 5000
+
+    def prepare(self, total):
+        from django.contrib.auth.models import User
+        from django.test import Client
+
+        if hasattr(self, 'session_id'):
+            return
+        user = User.objects.create_user(f'bench-{uuid.uuid4().hex[:8]}')
+        seed_pending(self.rows, user=user)
+        client = Client()
+        client.force_login(user)
+        self.session_id = client.cookies['sessionid'].value
+
+    def request(self, session, index):
+        session.cookies.set('sessionid', self.session_id)
+        response = session.get(f'{self.base_url}/transactions/', params={'limit': 50})
+        return response.status_code == 200
+
+
+def run(scenario, total, concurrency):
+    """Send ``total`` requests from ``concurrency`` threads; return the stats dict"""
+    scenario.prepare(total)
+    local = threading.local()
+
+    def one(index):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            ok = scenario.request(local.session, index)
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in outcomes)
+    return {
+        'scenario': scenario.name,
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': sum(1 for _, ok in outcomes if not ok),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(total / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'max_ms': round(latencies[-1] * 1000, 1),
+    }
+
+
+def print_result(result):
+    print(f"{result['scenario']:>9} c={result['concurrency']:<4} {result['throughput']:8.1f} req/s  "
+          f"p50 {result['p50_ms']:7.1f}ms  p95 {result['p95_ms']:7.1f}ms  p99 {result['p99_ms']:7.1f}ms  "
+          f"errors {result['errors']}/{result['requests']}")
+
+
+def benchmark(args):
+    daraja = start_server(**server_options(args))
+    app_server, app_url = start_app_server()
+    db_path = setup_django(daraja_url=daraja.url, callback_url=f'{app_url}/callback/')
+
+    from django.conf import settings
+    from django.core.wsgi import get_wsgi_application
+
+    settings.DEBUG = False  # Don't keep every SQL query in memory
+    app_server.set_app(get_wsgi_application())
+    threading.Thread(target=app_server.serve_forever, daemon=True).start()
+
+    History.rows = args.history_rows
+    scenarios = {cls.name: cls(app_url) for cls in (StkPush, Callback, Status, History)}
+    results = []
+    try:
+        for name in args.scenarios:
+            for concurrency in args.concurrency:
+                result = run(scenarios[name], args.requests, concurrency)
+                print_result(result)
+                results.append(result)
+    finally:
+        print(f'Fake Daraja delivered {daraja.callbacks_sent} callbacks ({daraja.callback_errors} failed)')
+        app_server.shutdown()
+        daraja.shutdown()
+        if db_path:
+            os.remove(db_path)
+
+    report = {
+        'meta': {
+            **git_revision(),
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'callback_mode': getattr(settings, 'MPESA_CALLBACK_MODE', 'inline'),
+            'options': {
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'history_rows': args.history_rows,
+                **{key: value for key, value in server_options(args).items() if key != 'result_weights'},
+            },
+        },
+        'results': results,
+    }
+    output = args.output
+    if output is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = RESULTS_DIR / f"{stamp}-{report['meta']['commit'] or 'nogit'}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+
+
+def compare(before_path, after_path, threshold):
+    """Print throughput and p95 changes between two runs; return the number of regressions"""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    print(f"{before['meta']['commit']} -> {after['meta']['commit']}")
+    baseline = {(r['scenario'], r['concurrency']): r for r in before['results']}
+    regressions = 0
+    for result in after['results']:
+        old = baseline.get((result['scenario'], result['concurrency']))
+        if old is None:
+            continue
+        throughput_change = (result['throughput'] - old['throughput']) / old['throughput'] * 100
+        p95_change = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+        regressed = throughput_change < -threshold or p95_change > threshold
+        regressions += regressed
+        print(f"{result['scenario']:>9} c={result['concurrency']:<4} "
+              f"{old['throughput']:8.1f} -> {result['throughput']:8.1f} req/s ({throughput_change:+6.1f}%)  "
+              f"p95 {old['p95_ms']:7.1f} -> {result['p95_ms']:7.1f}ms ({p95_change:+6.1f}%)"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 10, 50])
+    parser.add_argument('--requests', type=int, default=500, help='Requests per scenario and concurrency level')
+    parser.add_argument('--history-rows', type=int, default=5000, help='Transactions of the history user')
+    parser.add_argument('--output', help='Result file (default: benchmarks/results/<time>-<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two result files and exit')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Percent change reported as a regression')
+    add_server_arguments(parser)
+    parser.set_defaults(latency=0.05, callback_delay=1.0)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+    benchmark(args)
@@ -0,0 +1,49 @@
+"""Shared setup for the benchmark scripts."""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def setup_django(daraja_url=None, db_path=None, callback_url=None):
+    """Configure Django against a throwaway SQLite database
+
+    Must be called before importing anything from ``mpesa``. Returns the
+    path of the database file, or None when the configured database is not
+    SQLite (it is migrated in place).
+    """
+    if daraja_url:
+        os.environ['MPESA_BASE_URL'] = daraja_url
+    if callback_url:
+        os.environ['CALLBACK_URL'] = callback_url
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mcheda.settings')
+    sys.path.insert(0, str(BASE_DIR))
+
+    import django
+    from django.core.management import call_command
+    from django.db import connections
+
+    django.setup()
+
+    from django.conf import settings
+    settings.MPESA_RATE_LIMITS = {}  # Measure the app, not the Daraja quota
+
+    db = connections['default']
+    if db.vendor == 'sqlite':
+        if db_path is None:
+            fd, db_path = tempfile.mkstemp(prefix='mpesa-bench-', suffix='.sqlite3')
+            os.close(fd)
+        db.settings_dict['NAME'] = db_path
+        db.settings_dict.setdefault('OPTIONS', {}).setdefault('timeout', 30)
+    call_command('migrate', verbosity=0)
+    return db_path
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
@@ -0,0 +1,243 @@
+"""Local stand-in for the Safaricom Daraja API.
+
+Serves the OAuth, STK push and STK query endpoints with a configurable
+response latency and error rate so benchmarks can run without network
+access, and delivers the STK callback to the request's ``CallBackURL``
+after a delay, like Safaricom does once the customer answers the prompt:
+
+    python benchmarks/fake_daraja.py --port 8900 --latency 0.2 --callback-delay 2
+
+then point the app at it with ``MPESA_BASE_URL=http://127.0.0.1:8900``.
+Until its callback is delivered, a query for a checkout id answers that
+the transaction is still being processed.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Final result codes drawn for callbacks, with their descriptions
+RESULT_DESCRIPTIONS = {
+    0: 'The service request is processed successfully.',
+    1: 'The balance is insufficient for the transaction.',
+    1032: 'Request cancelled by user',
+    1037: 'DS timeout user cannot be reached',
+}
+
+PROCESSING = {
+    'requestId': '',
+    'errorCode': '500.001.1001',
+    'errorMessage': 'The transaction is being processed',
+}
+
+
+class FakeDarajaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.startswith('/oauth/v1/generate'):
+            self.server.pause(self.server.oauth_latency)
+            self._respond(200, {'access_token': uuid.uuid4().hex, 'expires_in': '3599'})
+        else:
+            self._respond(404, {'errorMessage': 'Not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        self.server.pause(self.server.latency)
+
+        if self.path not in ('/mpesa/stkpush/v1/processrequest', '/mpesa/stkpushquery/v1/query'):
+            self._respond(404, {'errorMessage': 'Not found'})
+        elif self.server.should_fail():
+            self._respond(500, {
+                'requestId': uuid.uuid4().hex,
+                'errorCode': '500.003.02',
+                'errorMessage': 'System is busy. Please try again in few minutes.',
+            })
+        elif self.path == '/mpesa/stkpush/v1/processrequest':
+            merchant_request_id = uuid.uuid4().hex[:20]
+            checkout_request_id = f'ws_CO_{uuid.uuid4().hex[:24]}'
+            self.server.schedule_callback(merchant_request_id, checkout_request_id, body)
+            self._respond(200, {
+                'MerchantRequestID': merchant_request_id,
+                'CheckoutRequestID': checkout_request_id,
+                'ResponseCode': '0',
+                'ResponseDescription': 'Success. Request accepted for processing',
+                'CustomerMessage': 'Success. Request accepted for processing',
+            })
+        else:
+            checkout_request_id = body.get('CheckoutRequestID')
+            result_code = self.server.results.get(checkout_request_id)
+            if result_code is None and self.server.callback_delay is not None:
+                self._respond(500, dict(PROCESSING, requestId=uuid.uuid4().hex))
+                return
+            result_code = result_code or 0
+            self._respond(200, {
+                'ResponseCode': '0',
+                'ResponseDescription': 'The service request has been accepted successsfully',
+                'MerchantRequestID': uuid.uuid4().hex[:20],
+                'CheckoutRequestID': checkout_request_id,
+                'ResultCode': str(result_code),
+                'ResultDesc': RESULT_DESCRIPTIONS[result_code],
+            })
+
+    def _respond(self, status, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeDarajaServer(ThreadingHTTPServer):
+    """Fake Daraja API
+
+    ``latency`` (plus up to ``jitter`` seconds) delays STK push and query
+    answers, ``oauth_latency`` delays token requests. ``error_rate`` is the
+    fraction of STK pushes and queries answered with a 500.
+
+    With ``callback_delay`` set, each accepted STK push gets a callback that
+    many seconds later, posted to ``callback_url`` or else to the request's
+    ``CallBackURL``; its result code is drawn from ``result_weights``.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.0, jitter=0.0, oauth_latency=0.0, error_rate=0.0,
+                 callback_delay=None, callback_url=None, result_weights=None, seed=None):
+        super().__init__(address, FakeDarajaHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.oauth_latency = oauth_latency
+        self.error_rate = error_rate
+        self.callback_delay = callback_delay
+        self.callback_url = callback_url
+        self.result_weights = result_weights or {0: 1.0}
+        self.results = {}
+        self.callbacks_sent = 0
+        self.callback_errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def pause(self, seconds):
+        if self.jitter:
+            with self._lock:
+                seconds += self._random.uniform(0, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def schedule_callback(self, merchant_request_id, checkout_request_id, request_body):
+        url = self.callback_url or request_body.get('CallBackURL')
+        if self.callback_delay is None or not url:
+            return
+        with self._lock:
+            result_code = self._random.choices(list(self.result_weights), list(self.result_weights.values()))[0]
+        timer = threading.Timer(self.callback_delay, self.deliver_callback, args=(
+            url, merchant_request_id, checkout_request_id, result_code, request_body,
+        ))
+        timer.daemon = True
+        timer.start()
+
+    def deliver_callback(self, url, merchant_request_id, checkout_request_id, result_code, request_body):
+        callback = {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': result_code,
+            'ResultDesc': RESULT_DESCRIPTIONS[result_code],
+        }
+        if result_code == 0:
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': request_body.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': uuid.uuid4().hex[:10].upper()},
+                {'Name': 'TransactionDate', 'Value': int(datetime.now().strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': request_body.get('PhoneNumber')},
+            ]}
+        self.results[checkout_request_id] = result_code
+
+        request = urllib.request.Request(
+            url, data=json.dumps({'Body': {'stkCallback': callback}}).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST',
+        )
+        try:
+            urllib.request.urlopen(request, timeout=30).close()
+            with self._lock:
+                self.callbacks_sent += 1
+        except OSError:
+            with self._lock:
+                self.callback_errors += 1
+
+
+def start_server(host='127.0.0.1', port=0, latency=0.0, **options):
+    """Start a fake Daraja server on a background thread and return it"""
+    server = FakeDarajaServer((host, port), latency=latency, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_result_weights(value):
+    """Parse ``0=0.8,1032=0.15,1037=0.05`` into ``{0: 0.8, 1032: 0.15, 1037: 0.05}``"""
+    weights = {}
+    for part in value.split(','):
+        code, _, weight = part.partition('=')
+        if int(code) not in RESULT_DESCRIPTIONS:
+            raise argparse.ArgumentTypeError(f'Unsupported result code {code}')
+        weights[int(code)] = float(weight or 1)
+    return weights
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds to wait before answering STK requests')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Extra random latency, up to this many seconds')
+    parser.add_argument('--oauth-latency', type=float, default=0.0, help='Seconds to wait before issuing tokens')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of STK requests answered with a 500')
+    parser.add_argument('--callback-delay', type=float, help='Deliver callbacks this many seconds after a push')
+    parser.add_argument('--callback-url', help='Deliver callbacks here instead of the request CallBackURL')
+    parser.add_argument('--results', type=parse_result_weights, default={0: 1.0},
+                        help='Callback result code weights, e.g. 0=0.8,1032=0.2')
+    parser.add_argument('--seed', type=int, help='Random seed for jitter, errors and results')
+
+
+def server_options(args):
+    return {
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'oauth_latency': args.oauth_latency,
+        'error_rate': args.error_rate,
+        'callback_delay': args.callback_delay,
+        'callback_url': args.callback_url,
+        'result_weights': args.results,
+        'seed': args.seed,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeDarajaServer((args.host, args.port), **server_options(args))
+    print(f'Fake Daraja listening on {server.url}')
+    server.serve_forever()
@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Inactive unless MPESA_PROFILING is set
+    'mpesa.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,12 +76,219 @@ WSGI_APPLICATION = 'mcheda.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# MPESA_DB_PROFILE selects the database setup:
+#   sqlite      plain SQLite, fine for development (default)
+#   sqlite-wal  SQLite in WAL mode with a busy timeout and IMMEDIATE write
+#               transactions, for small single-host deployments
+#   postgres    PostgreSQL from the POSTGRES_* variables, with persistent
+#               connections, or psycopg's pool when POSTGRES_POOL_MAX_SIZE is set
+# Compare them with benchmarks/bench_db_profiles.py.
+DB_PROFILE = os.getenv('MPESA_DB_PROFILE', 'sqlite')
+
+if DB_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'mcheda'),
+            'USER': os.getenv('POSTGRES_USER', 'mcheda'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', '127.0.0.1'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.getenv('POSTGRES_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+            # Server-side cursors (QuerySet.iterator) don't survive a
+            # transaction-pooling pgbouncer
+            'DISABLE_SERVER_SIDE_CURSORS': os.getenv('POSTGRES_PGBOUNCER', '').lower() in ('1', 'true', 'yes'),
+            'OPTIONS': {},
+        }
     }
-}
+    if os.getenv('POSTGRES_POOL_MAX_SIZE'):
+        # Needs psycopg[pool]; persistent connections are handled by the pool
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.getenv('POSTGRES_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('POSTGRES_POOL_MAX_SIZE')),
+            'timeout': 10,
+        }
+elif DB_PROFILE == 'sqlite-wal':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # Readers don't block the writer in WAL mode, and NORMAL only
+                # syncs at checkpoints, which is safe with WAL
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                ),
+                # Take the write lock when the transaction starts instead of
+                # failing with "database is locked" when upgrading a read lock
+                'transaction_mode': 'IMMEDIATE',
+                # Busy timeout in seconds while waiting for that lock
+                'timeout': 20,
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Set REDIS_URL so every worker shares the same cache (M-Pesa OAuth tokens,
+# locks). Without it each process keeps its own in-memory cache.
+
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
+# M-Pesa
+
+# Cache alias holding the shared OAuth token, and how many seconds before
+# expiry it is refreshed in the background.
+MPESA_TOKEN_CACHE = 'default'
+MPESA_TOKEN_REFRESH_MARGIN = 300
+
+# Daraja HTTP connection pool. The base URL comes from MPESA_BASE_URL in .env.
+MPESA_HTTP_POOL_SIZE = int(os.getenv('MPESA_HTTP_POOL_SIZE', 10))
+MPESA_HTTP_CONNECT_TIMEOUT = 5
+MPESA_HTTP_READ_TIMEOUT = 30
+MPESA_HTTP_MAX_RETRIES = 2
+MPESA_HTTP_BACKOFF = 0.5
+
+# Serve STK push, query and callback with the native async views. Enable
+# when running under ASGI (e.g. uvicorn mcheda.asgi:application); the async
+# Daraja client uses aiohttp when it is installed.
+MPESA_ASYNC_VIEWS = os.getenv('MPESA_ASYNC_VIEWS', '').lower() in ('1', 'true', 'yes')
+MPESA_ASYNC_HTTP_POOL_SIZE = 100
+
+# Batch STK push: concurrent Daraja calls per batch, rows written back per
+# bulk_update, and the largest accepted batch.
+MPESA_BATCH_WORKERS = 8
+MPESA_BATCH_FLUSH_EVERY = 100
+MPESA_BATCH_MAX_ITEMS = 5000
+
+# 'inline' sends STK pushes to Safaricom in the request; 'queued' only records
+# them and answers 202 with the transaction id. Run
+# `manage.py dispatch_stk_pushes --loop` (one or more) to send them. Claims
+# older than MPESA_DISPATCH_CLAIM_TIMEOUT seconds are failed, not resent.
+MPESA_STK_DISPATCH = os.getenv('MPESA_STK_DISPATCH', 'inline')
+MPESA_DISPATCH_BATCH_SIZE = 50
+MPESA_DISPATCH_WORKERS = 8
+MPESA_DISPATCH_CLAIM_TIMEOUT = 300
+
+# 'inline' processes callbacks in the request; 'queued' stores them in the
+# callback inbox and acknowledges immediately. Run
+# `manage.py process_callbacks --loop` to drain the inbox.
+MPESA_CALLBACK_MODE = os.getenv('MPESA_CALLBACK_MODE', 'inline')
+MPESA_CALLBACK_MAX_ATTEMPTS = 5
+MPESA_CALLBACK_RETRY_DELAY = 5
+
+# Live status stream (/transaction/<id>/events/). Each open stream holds a
+# worker thread under WSGI, so run threaded workers or ASGI. Other workers'
+# updates are picked up from the cache every MPESA_PUBSUB_POLL_INTERVAL.
+MPESA_SSE_MAX_SECONDS = 90
+MPESA_SSE_KEEPALIVE_SECONDS = 15
+MPESA_PUBSUB_POLL_INTERVAL = 1.0
+
+# Cached /transaction/<id>/status/ payloads, in seconds. Entries are dropped
+# on every update; the TTLs only bound staleness if an update is missed.
+MPESA_STATUS_CACHE_PENDING_TTL = 30
+MPESA_STATUS_CACHE_FINAL_TTL = 86400
+
+# Outbound Daraja protection, shared across workers through the cache (use
+# Redis in production; with LocMem each process has its own quota/breaker).
+# Calls per second by endpoint; callers over the limit wait up to
+# MPESA_RATE_LIMIT_MAX_WAIT seconds, then fail with RATE_LIMIT.
+MPESA_RATE_LIMITS = {'oauth': 5, 'stk_push': 30, 'stk_query': 15}
+MPESA_RATE_LIMIT_MAX_WAIT = 2.0
+# The breaker opens when at least MPESA_CIRCUIT_MIN_CALLS calls in a
+# MPESA_CIRCUIT_WINDOW-second window fail at MPESA_CIRCUIT_FAILURE_RATIO or
+# more, and probes again after MPESA_CIRCUIT_COOLDOWN seconds.
+MPESA_CIRCUIT_MIN_CALLS = 20
+MPESA_CIRCUIT_FAILURE_RATIO = 0.5
+MPESA_CIRCUIT_WINDOW = 30
+MPESA_CIRCUIT_COOLDOWN = 30
+
+# A repeated STK push with the same Idempotency-Key within this many seconds
+# gets the original result instead of a new prompt
+MPESA_IDEMPOTENCY_WINDOW = 86400
+
+# STK query results are shared between concurrent and repeated queries for
+# this many seconds (see mpesa/coalesce.py)
+MPESA_STK_QUERY_CACHE_TTL = 5
+
+# manage.py sweep_pending: query transactions pending longer than
+# MPESA_SWEEP_AFTER_SECONDS and time out the ones still unanswered after
+# MPESA_SWEEP_TIMEOUT_SECONDS, with bounded, throttled STK queries
+MPESA_SWEEP_AFTER_SECONDS = 120
+MPESA_SWEEP_TIMEOUT_SECONDS = 900
+MPESA_SWEEP_WORKERS = 4
+MPESA_SWEEP_QUERIES_PER_SECOND = 5
+
+# /reports/rollups/ answers from TransactionRollup, kept current as
+# transactions settle. `manage.py rebuild_rollups` recomputes it from history;
+# add --pending to count transactions the live updates missed.
+MPESA_ROLLUP_MAX_PERIODS = 744
+
+# manage.py archive_transactions moves settled transactions older than
+# MPESA_ARCHIVE_AFTER_DAYS, with their callbacks, to ArchivedTransaction in
+# batches of MPESA_ARCHIVE_BATCH_SIZE
+MPESA_ARCHIVE_AFTER_DAYS = 180
+MPESA_ARCHIVE_BATCH_SIZE = 500
+
+# manage.py reconcile_statement: statement times are in
+# MPESA_STATEMENT_TIMEZONE; rows without a receipt match are paired by phone
+# and amount within MPESA_RECONCILE_TIME_WINDOW seconds
+MPESA_STATEMENT_TIMEZONE = 'Africa/Nairobi'
+MPESA_RECONCILE_TIME_WINDOW = 600
+
+# Admin changelists count rows exactly up to this many, then estimate
+MPESA_ADMIN_COUNT_LIMIT = 10000
+
+# Shortest phone prefix (after 254) or suffix /transactions/search/ and the admin accept
+MPESA_SEARCH_MIN_DIGITS = 3
+
+# Per-view query and Daraja timings at /reports/profile/. A sample of sync requests
+# also runs under cProfile; profiles of those slower than the threshold are kept
+MPESA_PROFILING = os.getenv('MPESA_PROFILING', '').lower() in ('1', 'true', 'yes')
+MPESA_PROFILE_SAMPLE_RATE = float(os.getenv('MPESA_PROFILE_SAMPLE_RATE', '0'))
+MPESA_PROFILE_SLOW_SECONDS = 1.0
+MPESA_PROFILE_KEEP = 20
+
+# Merchants (tills/paybills) are cached per process; other processes pick up
+# changes within this many seconds. Without Merchant rows the .env credentials are used
+MPESA_MERCHANT_RELOAD_SECONDS = 30
+
+# Raw callback bodies are kept compressed: 'db' stores them in MpesaCallback.payload,
+# 'file' as gzipped files under MPESA_CALLBACK_PAYLOAD_DIR
+MPESA_CALLBACK_PAYLOAD_STORAGE = os.getenv('MPESA_CALLBACK_PAYLOAD_STORAGE', 'db')
+MPESA_CALLBACK_PAYLOAD_DIR = BASE_DIR / 'callback_payloads'
+
+# /transactions/ page size cap and the chunk size used for NDJSON/CSV exports
+MPESA_HISTORY_MAX_PAGE_SIZE = 500
+MPESA_HISTORY_CHUNK_SIZE = 2000
+
+# /metrics/ (Prometheus text format). When set, scrapers must send
+# "Authorization: Bearer <token>".
+MPESA_METRICS_TOKEN = os.getenv('MPESA_METRICS_TOKEN')
 
 
 # Password validation
@@ -123,3 +332,32 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Logging
+# https://docs.djangoproject.com/en/5.2/topics/logging/
+# The mpesa loggers log "event key=value" messages; set MPESA_LOG_LEVEL=DEBUG
+# to include STK query payloads.
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'kv': {
+            'format': 'ts=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'kv',
+        },
+    },
+    'loggers': {
+        'mpesa': {
+            'handlers': ['console'],
+            'level': os.getenv('MPESA_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
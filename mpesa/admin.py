@@ -1,23 +1,147 @@
 # admin.py
-from django.contrib import admin
-from .models import MpesaTransaction, MpesaCallback
+import json
+import uuid
+from datetime import date, datetime, time, timedelta
+
+from django import forms
+from django.contrib import admin, messages
+from django.db.models import Max, Min, QuerySet
+from django.utils import timezone
+
+from .models import ArchivedTransaction, Merchant, MpesaTransaction, MpesaCallback, CallbackInbox, TransactionRollup
+from .pagination import EstimatedCountPaginator
+from .search import SearchError, search_transactions
+from .utils import RESULT_CODE_STATUSES
+
+
+def _period_bounds(first, last, kind, tz):
+    """Yield ``(start, end)`` of every year, month or day from ``first`` to ``last``"""
+    first, last = timezone.localtime(first, tz).date(), timezone.localtime(last, tz).date()
+    current = date(first.year, 1 if kind == 'year' else first.month, first.day if kind == 'day' else 1)
+    while current <= last:
+        if kind == 'year':
+            following = date(current.year + 1, 1, 1)
+        elif kind == 'month':
+            following = date(current.year + current.month // 12, current.month % 12 + 1, 1)
+        else:
+            following = current + timedelta(days=1)
+        yield (
+            timezone.make_aware(datetime.combine(current, time.min), tz),
+            timezone.make_aware(datetime.combine(following, time.min), tz),
+        )
+        current = following
+
+
+class IndexedDatesQuerySet(QuerySet):
+    """Answers the date hierarchy's ``datetimes()`` from the field's index
+
+    Django's version runs SELECT DISTINCT over every row in range. This one
+    reads MIN/MAX and then probes each candidate year, month or day with an
+    indexed EXISTS, at most a few dozen queries whatever the table size.
+    """
+
+    def datetimes(self, field_name, kind, order='ASC', tzinfo=None):
+        if kind not in ('year', 'month', 'day'):
+            return super().datetimes(field_name, kind, order, tzinfo)
+        bounds = self.aggregate(first=Min(field_name), last=Max(field_name))
+        if bounds['first'] is None:
+            return []
+        tz = tzinfo or timezone.get_current_timezone()
+        periods = [
+            start for start, end in _period_bounds(bounds['first'], bounds['last'], kind, tz)
+            if self.filter(**{f'{field_name}__gte': start, f'{field_name}__lt': end}).exists()
+        ]
+        return periods if order == 'ASC' else periods[::-1]
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelists that stay fast on tables with millions of rows
+
+    No exact ``COUNT(*)``s, and a date hierarchy that stays on the index.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return IndexedDatesQuerySet(queryset.model, query=queryset.query, using=queryset.db)
+
+
+class TransactionSearchAdmin(LargeTableAdmin):
+    """Answers the search box from the indexes with ``mpesa.search``"""
+    # Shows the search box; get_search_results answers it
+    search_fields = ['phone_number', 'mpesa_receipt_number', 'account_reference']
+    search_help_text = 'Phone number or prefix, *last digits of a phone, receipt number or account reference'
+    
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        try:
+            return search_transactions(queryset, search_term), False
+        except SearchError as e:
+            self.message_user(request, str(e), level=messages.WARNING)
+            return queryset.none(), False
+
+
+class ResultCodeFilter(admin.SimpleListFilter):
+    """Result code choices without a SELECT DISTINCT over the table"""
+    title = 'result code'
+    parameter_name = 'result_code'
+    
+    def lookups(self, request, model_admin):
+        return [(code, f'{code} ({status.lower()})') for code, status in RESULT_CODE_STATUSES.items()]
+    
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(result_code=self.value())
+        return queryset
+
+@admin.register(Merchant)
+class MerchantAdmin(admin.ModelAdmin):
+    list_display = ['code', 'name', 'shortcode', 'party_b', 'transaction_type', 'is_active', 'is_default']
+    list_filter = ['is_active', 'transaction_type']
+    search_fields = ['code', 'name', 'shortcode']
+    readonly_fields = ['created_at', 'updated_at']
+    
+    fieldsets = (
+        (None, {
+            'fields': ('code', 'name', 'is_active', 'is_default')
+        }),
+        ('Till or paybill', {
+            'fields': ('shortcode', 'party_b', 'transaction_type', 'account_reference', 'transaction_desc')
+        }),
+        ('Daraja app', {
+            'fields': ('consumer_key', 'consumer_secret', 'passkey', 'callback_url', 'base_url')
+        }),
+        ('Timestamps', {
+            'fields': ('created_at', 'updated_at')
+        }),
+    )
+    
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        if db_field.name in ('consumer_secret', 'passkey'):
+            kwargs['widget'] = forms.PasswordInput(render_value=True)
+        return super().formfield_for_dbfield(db_field, request, **kwargs)
+
 
 @admin.register(MpesaTransaction)
-class MpesaTransactionAdmin(admin.ModelAdmin):
+class MpesaTransactionAdmin(TransactionSearchAdmin):
     list_display = [
         'id', 'user', 'phone_number', 
         'amount', 'status', 'mpesa_receipt_number', 'created_at'
     ]
-    list_filter = ['status', 'created_at']
-    search_fields = ['phone_number', 'mpesa_receipt_number', 'account_reference']
+    list_select_related = ['user']
+    list_filter = ['status', 'merchant']
+    date_hierarchy = 'created_at'
     readonly_fields = [
         'id', 'merchant_request_id', 'checkout_request_id', 
-        'mpesa_receipt_number', 'transaction_date', 'created_at', 'updated_at'
+        'mpesa_receipt_number', 'transaction_date', 'paid_amount', 'paid_phone_number',
+        'created_at', 'updated_at'
     ]
     
     fieldsets = (
         ('Basic Information', {
-            'fields': ('id', 'user', 'phone_number', 'amount')
+            'fields': ('id', 'user', 'merchant', 'phone_number', 'amount')
         }),
         ('Transaction Details', {
             'fields': ('account_reference', 'transaction_desc', 'status')
@@ -25,7 +149,7 @@ class MpesaTransactionAdmin(admin.ModelAdmin):
         ('M-Pesa Details', {
             'fields': (
                 'merchant_request_id', 'checkout_request_id', 
-                'mpesa_receipt_number', 'transaction_date'
+                'mpesa_receipt_number', 'transaction_date', 'paid_amount', 'paid_phone_number'
             )
         }),
         ('Result Information', {
@@ -44,14 +168,24 @@ class MpesaTransactionAdmin(admin.ModelAdmin):
 
 
 @admin.register(MpesaCallback)
-class MpesaCallbackAdmin(admin.ModelAdmin):
+class MpesaCallbackAdmin(LargeTableAdmin):
     list_display = [
         'transaction', 'merchant_request_id', 'checkout_request_id', 
-        'result_code', 'created_at'
+        'result_code', 'amount', 'mpesa_receipt_number', 'created_at'
     ]
-    list_filter = ['result_code', 'created_at']
-    search_fields = ['merchant_request_id', 'checkout_request_id']
-    readonly_fields = ['created_at']
+    list_select_related = ['transaction']
+    list_filter = [ResultCodeFilter]
+    date_hierarchy = 'created_at'
+    search_fields = ['=checkout_request_id', '=mpesa_receipt_number', '=phone_number']
+    readonly_fields = ['created_at', 'raw_callback']
+    
+    def get_queryset(self, request):
+        # The raw callback body is only loaded on the detail page
+        return super().get_queryset(request).defer('payload')
+    
+    @admin.display(description='Callback data')
+    def raw_callback(self, obj):
+        return json.dumps(obj.callback_data, indent=2)
     
     def has_add_permission(self, request):
         # Callbacks are created automatically
@@ -60,3 +194,65 @@ class MpesaCallbackAdmin(admin.ModelAdmin):
     def has_change_permission(self, request, obj=None):
         # Callbacks shouldn't be modified
         return False
+
+
+@admin.register(CallbackInbox)
+class CallbackInboxAdmin(LargeTableAdmin):
+    list_display = ['id', 'merchant_code', 'received_at', 'processed_at', 'attempts', 'last_error']
+    list_filter = ['processed_at']
+    readonly_fields = ['body', 'merchant_code', 'received_at', 'available_at', 'processed_at', 'attempts', 'last_error']
+    
+    def has_add_permission(self, request):
+        # Entries are created by the callback endpoint
+        return False
+
+
+@admin.register(TransactionRollup)
+class TransactionRollupAdmin(admin.ModelAdmin):
+    list_display = ['period', 'period_start', 'status', 'merchant_code', 'account_reference', 'count', 'amount']
+    list_filter = ['period', 'status', 'merchant_code']
+    date_hierarchy = 'period_start'
+    
+    def has_add_permission(self, request):
+        # Maintained by rollups.py and rebuild_rollups
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ArchivedTransaction)
+class ArchivedTransactionAdmin(TransactionSearchAdmin):
+    list_display = ['id', 'user', 'phone_number', 'amount', 'status', 'mpesa_receipt_number', 'created_at']
+    list_select_related = ['user']
+    list_filter = ['status']
+    search_help_text = 'Transaction or checkout request id, ' + TransactionSearchAdmin.search_help_text.lower()
+    date_hierarchy = 'created_at'
+    exclude = ['callbacks']
+    readonly_fields = ['archived_callbacks']
+    
+    def get_queryset(self, request):
+        # The compressed callbacks are only loaded on the detail page
+        return super().get_queryset(request).defer('callbacks')
+    
+    def get_search_results(self, request, queryset, search_term):
+        # Ids are pasted from status lookups and logs of transactions that moved here
+        term = search_term.strip()
+        try:
+            return queryset.filter(id=uuid.UUID(term)), False
+        except ValueError:
+            pass
+        if term.startswith('ws_CO_'):
+            return queryset.filter(checkout_request_id=term), False
+        return super().get_search_results(request, queryset, search_term)
+    
+    @admin.display(description='Callbacks')
+    def archived_callbacks(self, obj):
+        return json.dumps(obj.callback_records, indent=2)
+    
+    def has_add_permission(self, request):
+        # Rows are moved here by archive_transactions
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
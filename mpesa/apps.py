@@ -4,3 +4,20 @@ from django.apps import AppConfig
 class MpesaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mpesa'
+
+    def ready(self):
+        from django.db.models.signals import post_delete, post_save
+
+        from . import merchants, metrics, pubsub, rollups, status_cache
+        from .models import Merchant
+        from .signals import transaction_updated
+
+        metrics.register_default_gauges()
+
+        # Drop cached payloads before waking anyone who will re-read them
+        transaction_updated.connect(status_cache.on_transaction_updated, dispatch_uid='mpesa.status_cache')
+        transaction_updated.connect(pubsub.on_transaction_updated, dispatch_uid='mpesa.pubsub')
+        transaction_updated.connect(rollups.on_transaction_updated, dispatch_uid='mpesa.rollups')
+
+        post_save.connect(merchants.on_merchant_changed, sender=Merchant, dispatch_uid='mpesa.merchants.save')
+        post_delete.connect(merchants.on_merchant_changed, sender=Merchant, dispatch_uid='mpesa.merchants.delete')
@@ -0,0 +1,131 @@
+"""Tiered retention of settled transactions.
+
+Transactions live in three tiers:
+
+1. ``MpesaTransaction`` and ``MpesaCallback``, written by the payment flow.
+2. ``ArchivedTransaction``: settled transactions older than
+   ``MPESA_ARCHIVE_AFTER_DAYS``, with their callbacks, raw bodies included,
+   folded into one zlib-compressed JSON column. Status lookups and the admin fall back to it.
+3. Gzipped JSON Lines files written by ``archive_transactions --export``,
+   after which ``--purge-after`` may drop archived rows.
+
+``archive_transactions`` moves rows in small batches, each in its own short
+database transaction, skipping rows locked by live writers where the
+database supports it, so the hot tables are never locked for long. Only
+transactions already counted in the rollups are archived, and
+``rebuild_rollups`` reads both tiers; rebuilding a range whose archived
+rows were purged loses them.
+"""
+import json
+import logging
+import time
+import zlib
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction as db_transaction
+from django.utils import timezone
+
+from . import payloads
+from .models import ArchivedTransaction, MpesaCallback, MpesaTransaction
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED_FIELDS = [
+    field.attname for field in ArchivedTransaction._meta.concrete_fields
+    # phone_reversed is filled in on insert
+    if field.name not in ('archived_at', 'callbacks', 'phone_reversed')
+]
+CALLBACK_FIELDS = (
+    'merchant_request_id', 'checkout_request_id', 'result_code', 'result_desc', 'amount', 'phone_number',
+    'mpesa_receipt_number', 'transaction_date', 'balance', 'created_at',
+)
+
+
+def compress_callbacks(callbacks):
+    if not callbacks:
+        return None
+    return zlib.compress(json.dumps(callbacks, cls=DjangoJSONEncoder).encode('utf-8'))
+
+
+def archive_batch(cutoff, batch_size=500, export=None):
+    """Move one batch of settled transactions created before ``cutoff``. Returns how many moved
+
+    ``export`` is an optional text file that gets one JSON line per transaction.
+    """
+    with db_transaction.atomic():
+        settled = MpesaTransaction.objects.filter(
+            status__in=MpesaTransaction.TERMINAL_STATUSES,
+            created_at__lt=cutoff,
+            rolled_up_at__isnull=False,
+        ).order_by('created_at')
+        if connection.features.has_select_for_update_skip_locked:
+            settled = settled.select_for_update(skip_locked=True)
+        rows = list(settled.values(*ARCHIVED_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+        ids = [row['id'] for row in rows]
+
+        callbacks, payload_paths = defaultdict(list), set()
+        for callback in (
+            MpesaCallback.objects.filter(transaction_id__in=ids)
+            .order_by('created_at').values('transaction_id', 'payload', 'payload_path', *CALLBACK_FIELDS)
+        ):
+            payload, payload_path = callback.pop('payload'), callback.pop('payload_path')
+            callback['callback_data'] = payloads.load(payload, payload_path)
+            if payload_path:
+                payload_paths.add(payload_path)
+            callbacks[callback.pop('transaction_id')].append(callback)
+
+        ArchivedTransaction.objects.bulk_create([
+            ArchivedTransaction(**row, callbacks=compress_callbacks(callbacks.get(row['id'])))
+            for row in rows
+        ], ignore_conflicts=True)
+        if export is not None:
+            for row in rows:
+                export.write(json.dumps({**row, 'callbacks': callbacks.get(row['id'], [])}, cls=DjangoJSONEncoder))
+                export.write('\n')
+
+        MpesaCallback.objects.filter(transaction_id__in=ids).delete()
+        MpesaTransaction.objects.filter(id__in=ids).delete()
+        if payload_paths:
+            # Files are shared by identical bodies, so keep the ones still referenced
+            payload_paths -= set(
+                MpesaCallback.objects.filter(payload_path__in=payload_paths).values_list('payload_path', flat=True)
+            )
+            db_transaction.on_commit(lambda: payloads.delete(payload_paths))
+    return len(rows)
+
+
+def archive_transactions(older_than_days=None, batch_size=None, export=None, pause=0):
+    """Archive settled transactions older than ``older_than_days``, yielding each batch's size"""
+    if older_than_days is None:
+        older_than_days = getattr(settings, 'MPESA_ARCHIVE_AFTER_DAYS', 180)
+    batch_size = batch_size or getattr(settings, 'MPESA_ARCHIVE_BATCH_SIZE', 500)
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    while True:
+        moved = archive_batch(cutoff, batch_size, export)
+        if not moved:
+            return
+        yield moved
+        if moved < batch_size:
+            return
+        # Leave room for the payment flow between batches
+        time.sleep(pause)
+
+
+def purge_archive(older_than_days, batch_size=None):
+    """Delete archived transactions created more than ``older_than_days`` ago. Returns how many"""
+    batch_size = batch_size or getattr(settings, 'MPESA_ARCHIVE_BATCH_SIZE', 500)
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    purged = 0
+    while True:
+        ids = list(
+            ArchivedTransaction.objects.filter(created_at__lt=cutoff)
+            .order_by('created_at').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return purged
+        purged += ArchivedTransaction.objects.filter(id__in=ids).delete()[0]
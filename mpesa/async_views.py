@@ -0,0 +1,231 @@
+"""Native async versions of the Daraja-facing views.
+
+Under ASGI these let a single worker keep many STK pushes and queries in
+flight while it waits on Safaricom, instead of parking a thread per
+request. The status event stream likewise waits on the event loop rather
+than a thread. They are enabled with ``MPESA_ASYNC_VIEWS``; WSGI deployments
+keep using the sync views in ``views.py``.
+"""
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from . import metrics, pubsub
+from .callbacks import callback_mode, enqueue_callback
+from .client import TRANSPORT_ERRORS, get_async_client
+from .coalesce import acoalesced_query
+from .idempotency import IdempotencyError, begin_stk_push, get_request_key
+from .merchants import UnknownMerchant, aget_merchant, amerchant_for_checkout
+from .outbox import dispatch_mode, enqueue_stk_push
+from .resilience import UpstreamUnavailable
+from .signals import send_transaction_updated
+from .utils import (
+    apply_stk_push_response, apply_upstream_unavailable, build_stk_push_request, build_stk_query_request,
+    format_phone_number, generate_access_token,
+)
+from .models import MpesaTransaction
+from .views import (
+    event_stream_response, fail_stk_push, get_status_transaction, process_callback, query_status_body, status_event,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def aget_access_token(merchant):
+    """Return ``merchant``'s cached access token, refreshing it off the event loop if needed"""
+    return merchant.token_manager.peek() or await sync_to_async(
+        generate_access_token, thread_sensitive=False)(merchant)
+
+
+async def query_stk(checkout_request_id):
+    """Async version of ``views.query_stk``"""
+    with metrics.stage('query_stk', 'total'):
+        return await acoalesced_query(checkout_request_id, query_stk_upstream)
+
+
+async def query_stk_upstream(checkout_request_id):
+    """Async version of ``views.query_stk_upstream``"""
+    try:
+        merchant = await amerchant_for_checkout(checkout_request_id)
+        with metrics.stage('query_stk', 'token'):
+            access_token = await aget_access_token(merchant)
+        if not access_token:
+            return {'success': False, 'error': 'Failed to authenticate with M-Pesa'}
+
+        if not merchant.configured:
+            return {'success': False, 'error': 'Missing M-Pesa configuration'}
+
+        query_data = build_stk_query_request(checkout_request_id, merchant)
+        with metrics.stage('query_stk', 'daraja'):
+            response = await get_async_client(merchant).stk_query(query_data, access_token)
+        response_data = response.json()
+        metrics.result_codes.inc(
+            source='query', result_code=response_data.get('ResultCode', response_data.get('errorCode', 'Unknown')))
+
+        return {
+            'success': True,
+            'source': 'daraja',
+            'response_data': response_data,
+            'status_code': response.status_code
+        }
+
+    except UpstreamUnavailable as e:
+        return {'success': False, 'error': str(e), 'error_code': e.code}
+    except TRANSPORT_ERRORS as e:
+        logger.warning("STK query network error checkout_request_id=%s error=%s", checkout_request_id, e)
+        return {'success': False, 'error': f'Network error: {str(e)}'}
+    except Exception as e:
+        logger.exception("STK query failed checkout_request_id=%s", checkout_request_id)
+        return {'success': False, 'error': str(e)}
+
+
+async def process_stk_push(phone_number, amount, user=None, idempotency_key=None, merchant=None):
+    """Async version of ``views.process_stk_push``"""
+    transaction = None
+    merchant = merchant or await aget_merchant()
+    try:
+        with metrics.stage('process_stk_push', 'db_insert'):
+            transaction, replay = await sync_to_async(begin_stk_push)(
+                phone_number, amount, user, idempotency_key, merchant=merchant)
+        if replay is not None:
+            return replay
+
+        with metrics.stage('process_stk_push', 'token'):
+            token = await aget_access_token(merchant)
+        request_body = build_stk_push_request(phone_number, amount, transaction.account_reference, merchant)
+
+        with metrics.stage('process_stk_push', 'daraja'):
+            response = await get_async_client(merchant).stk_push(request_body, token)
+        result = apply_stk_push_response(transaction, response.status_code, response.json())
+        metrics.result_codes.inc(source='stk_push', result_code=transaction.result_code)
+
+        with metrics.stage('process_stk_push', 'db_update'):
+            await transaction.asave()
+        await sync_to_async(send_transaction_updated)(transaction.id)
+        logger.info("STK push transaction_id=%s status=%s result_code=%s",
+                    transaction.id, transaction.status, transaction.result_code)
+        return result
+
+    except IdempotencyError:
+        raise
+    except UpstreamUnavailable as e:
+        logger.warning("STK push not sent: %s", e)
+        result = apply_upstream_unavailable(transaction, e)
+        await transaction.asave()
+        await sync_to_async(send_transaction_updated)(transaction.id)
+        return result
+    except TRANSPORT_ERRORS as e:
+        logger.warning("STK push network error: %s", e)
+        return await sync_to_async(fail_stk_push)(transaction, f'Network error: {str(e)}')
+    except Exception as e:
+        logger.exception("STK push failed")
+        return await sync_to_async(fail_stk_push)(transaction, str(e))
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def stk_push_view(request):
+    """Async view to handle STK push requests"""
+    try:
+        data = json.loads(request.body)
+        phone_number = data.get('phone_number')
+        amount = data.get('amount')
+
+        if not phone_number or not amount:
+            return JsonResponse({'success': False, 'error': 'Phone number and amount are required'}, status=400)
+
+        merchant = await aget_merchant(data.get('merchant'))
+
+        if dispatch_mode() == 'queued':
+            result = await sync_to_async(enqueue_stk_push)(
+                phone_number=format_phone_number(phone_number),
+                amount=amount,
+                user=await request.auser(),
+                idempotency_key=get_request_key(request, data),
+                merchant=merchant
+            )
+            return JsonResponse(result, status=202)
+
+        result = await process_stk_push(
+            phone_number=format_phone_number(phone_number),
+            amount=amount,
+            user=await request.auser(),
+            idempotency_key=get_request_key(request, data),
+            merchant=merchant
+        )
+        return JsonResponse(result)
+
+    except IdempotencyError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=e.status)
+    except UnknownMerchant as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except json.JSONDecodeError:
+        return JsonResponse({'success': False, 'error': 'Invalid JSON data'}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def mpesa_callback(request, merchant=None):
+    """Async view to handle M-Pesa callback notifications"""
+    try:
+        route = await aget_merchant(merchant) if merchant else None
+    except UnknownMerchant:
+        return HttpResponse('Unknown merchant', status=404)
+    try:
+        if callback_mode() == 'queued':
+            await sync_to_async(enqueue_callback)(request.body, route)
+            return HttpResponse('OK')
+
+        callback_data = json.loads(request.body)
+        return await sync_to_async(process_callback)(callback_data, route)
+
+    except Exception as e:
+        logger.exception("Callback processing failed")
+        return HttpResponse(f'Error: {str(e)}', status=500)
+
+
+async def mpesa_query_status(request, checkout_request_id):
+    """Async view to query STK Push status from M-Pesa API"""
+    result = await query_stk(checkout_request_id)
+
+    if result['success']:
+        return JsonResponse(query_status_body(result))
+    return JsonResponse({'error': result['error']}, status=503 if result.get('error_code') else 500)
+
+
+async def transaction_events(request, transaction_id):
+    """Async version of ``views.transaction_events``; each stream waits on the event loop"""
+    version = await pubsub.acurrent_version(transaction_id)
+    transaction = await sync_to_async(get_status_transaction)(request, transaction_id)
+    max_seconds = getattr(settings, 'MPESA_SSE_MAX_SECONDS', 90)
+    keepalive = getattr(settings, 'MPESA_SSE_KEEPALIVE_SECONDS', 15)
+
+    async def stream(version):
+        yield 'retry: 3000\n\n'
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_seconds
+        current = transaction
+        while True:
+            yield status_event(current)
+            if current.status in MpesaTransaction.TERMINAL_STATUSES:
+                return
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return
+                new_version = await pubsub.await_update(transaction_id, version, min(keepalive, remaining))
+                if new_version != version:
+                    version = new_version
+                    break
+                yield ': keep-alive\n\n'
+            current = await MpesaTransaction.objects.aget(id=transaction_id)
+
+    return event_stream_response(stream(version))
@@ -0,0 +1,213 @@
+"""Bulk STK push for campaigns.
+
+``submit_stk_push_batch`` creates every ``MpesaTransaction`` of a batch with
+a single ``bulk_create``, sends the STK pushes through a bounded thread
+pool and writes the outcomes back with ``bulk_update`` in chunks. Results
+are yielded per item as soon as Safaricom answers, so callers can stream
+them. Pushes refused by the rate limiter or circuit breaker are not failed
+but left to ``dispatch_stk_pushes`` (see outbox.py), reported as ``queued``
+with their ``retry_after``.
+
+Merchants are resolved on the calling thread, so the worker threads never
+touch the database.
+"""
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.utils import timezone
+
+from .client import get_client
+from .merchants import UnknownMerchant, get_merchant, merchant_for_id
+from .models import MpesaTransaction
+from .resilience import UpstreamUnavailable
+from .signals import send_transaction_updated
+from .utils import (
+    apply_push_error, apply_requeue, apply_stk_push_response, build_stk_push_request,
+    format_phone_number, generate_access_token, validate_phone_number,
+)
+
+UPDATE_FIELDS = [
+    'status', 'result_code', 'result_desc', 'merchant_request_id',
+    'checkout_request_id', 'queued_at', 'claim_token', 'claimed_at', 'updated_at',
+]
+
+
+# Largest whole amount the ``amount`` column can hold
+_amount_field = MpesaTransaction._meta.get_field('amount')
+MAX_AMOUNT = Decimal(10) ** (_amount_field.max_digits - _amount_field.decimal_places) - 1
+
+
+class BatchError(ValueError):
+    """Raised when a batch request is malformed"""
+
+
+def parse_batch_item(item):
+    """Normalise a ``(phone, amount, reference)`` tuple or dict
+
+    Returns ``(phone_number, amount, account_reference, error)``.
+    """
+    if isinstance(item, dict):
+        phone, amount, reference = item.get('phone_number'), item.get('amount'), item.get('account_reference')
+    else:
+        try:
+            phone, amount, reference = (list(item) + [None])[:3]
+        except TypeError:
+            return None, None, None, 'Item must be an object or a (phone, amount, reference) list'
+
+    phone_number = format_phone_number(str(phone or ''))
+    if not validate_phone_number(phone_number):
+        return phone_number, amount, reference, 'Invalid phone number'
+    try:
+        amount = Decimal(str(amount))
+    except InvalidOperation:
+        return phone_number, amount, reference, 'Invalid amount'
+    # Daraja only takes whole shillings; a fraction would be silently dropped
+    if not amount.is_finite() or amount != amount.to_integral_value() or not 1 <= amount <= MAX_AMOUNT:
+        return phone_number, amount, reference, 'Invalid amount'
+    return phone_number, amount.quantize(Decimal(1)), reference, None
+
+
+def resolve_merchants(transactions):
+    """Map the ``merchant_id`` of each transaction to its ``MerchantRoute``, or the ``UnknownMerchant`` error
+
+    Call it before handing the transactions to worker threads, since loading
+    the merchant registry queries the database.
+    """
+    routes = {}
+    for transaction in transactions:
+        if transaction.merchant_id not in routes:
+            try:
+                routes[transaction.merchant_id] = merchant_for_id(transaction.merchant_id)
+            except UnknownMerchant as e:
+                routes[transaction.merchant_id] = e
+    return routes
+
+
+def send_stk_push(transaction, merchant):
+    """Send one STK push through ``merchant``. Runs on a worker thread and does not touch the database
+
+    ``merchant`` is an entry of ``resolve_merchants``. Returns
+    ``(status_code, response_data, error)`` for ``apply_send_result``.
+    """
+    try:
+        if isinstance(merchant, UnknownMerchant):
+            raise merchant
+        token = generate_access_token(merchant)
+        request_body = build_stk_push_request(
+            transaction.phone_number,
+            int(transaction.amount),
+            transaction.account_reference or None,
+            merchant,
+        )
+        response = get_client(merchant).stk_push(request_body, token)
+        return response.status_code, response.json(), None
+    except Exception as e:
+        return None, None, e
+
+
+def apply_send_result(transaction, status_code, response_data, error):
+    """Update a transaction from the outcome of ``send_stk_push``. The transaction is not saved"""
+    if error is not None:
+        if isinstance(error, UpstreamUnavailable):
+            result = apply_requeue(transaction, error)
+        else:
+            result = apply_push_error(transaction, f'Network error: {error}')
+    else:
+        result = apply_stk_push_response(transaction, status_code, response_data)
+    transaction.updated_at = timezone.now()
+    return result
+
+
+class StkPushBatch:
+    """A submitted batch. Iterate over it to dispatch the pushes and get per-item results"""
+
+    def __init__(self, items, user=None, max_workers=None, flush_every=None, merchant=None):
+        self.batch_id = uuid.uuid4()
+        self.user = user if user and user.is_authenticated else None
+        merchant = merchant or get_merchant()
+        self.merchant_id = merchant.id
+        self.max_workers = max_workers or getattr(settings, 'MPESA_BATCH_WORKERS', 8)
+        self.flush_every = flush_every or getattr(settings, 'MPESA_BATCH_FLUSH_EVERY', 100)
+        self.rejected = []
+        self.transactions = []
+
+        rows = []
+        for index, item in enumerate(items):
+            phone_number, amount, reference, error = parse_batch_item(item)
+            if error:
+                self.rejected.append({
+                    'index': index, 'success': False, 'phone_number': phone_number, 'error': error,
+                })
+                continue
+            rows.append((index, MpesaTransaction(
+                user=self.user,
+                merchant_id=self.merchant_id,
+                phone_number=phone_number,
+                amount=amount,
+                account_reference=reference or merchant.account_reference,
+                batch_id=self.batch_id,
+                status='INITIATED',
+            )))
+
+        self._indexes = {transaction.id: index for index, transaction in rows}
+        self.transactions = MpesaTransaction.objects.bulk_create([t for _, t in rows])
+
+    def __len__(self):
+        return len(self.transactions) + len(self.rejected)
+
+    def __iter__(self):
+        yield from self.rejected
+        if not self.transactions:
+            return
+
+        pending_updates, applied = [], set()
+        routes = resolve_merchants(self.transactions)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(send_stk_push, t, routes[t.merchant_id]): t for t in self.transactions}
+            try:
+                for future in as_completed(futures):
+                    transaction = futures[future]
+                    result = self._apply(transaction, *future.result())
+                    applied.add(transaction.id)
+                    pending_updates.append(transaction)
+                    if len(pending_updates) >= self.flush_every:
+                        self._flush(pending_updates)
+                    yield result
+            finally:
+                # Even if the consumer stops early, record every outcome
+                for future, transaction in futures.items():
+                    if transaction.id not in applied:
+                        self._apply(transaction, *future.result())
+                        pending_updates.append(transaction)
+                self._flush(pending_updates)
+
+    def _apply(self, transaction, status_code, response_data, error):
+        result = apply_send_result(transaction, status_code, response_data, error)
+        result['index'] = self._indexes[transaction.id]
+        result['phone_number'] = transaction.phone_number
+        return result
+
+    @staticmethod
+    def _flush(transactions):
+        if transactions:
+            MpesaTransaction.objects.bulk_update(transactions, UPDATE_FIELDS)
+            send_transaction_updated(*(t.id for t in transactions))
+            transactions.clear()
+
+
+def submit_stk_push_batch(items, user=None, max_workers=None, merchant=None):
+    """Create a batch of STK pushes
+
+    ``items`` is a list of ``(phone, amount, reference)`` tuples or dicts with
+    ``phone_number``, ``amount`` and ``account_reference``. The transactions
+    are created immediately; the pushes are sent while the returned batch is
+    iterated. ``merchant`` is the ``MerchantRoute`` paid, by default the default one.
+    """
+    max_items = getattr(settings, 'MPESA_BATCH_MAX_ITEMS', 5000)
+    if not items:
+        raise BatchError('At least one item is required')
+    if len(items) > max_items:
+        raise BatchError(f'A batch can have at most {max_items} items')
+    return StkPushBatch(items, user=user, max_workers=max_workers, merchant=merchant)
@@ -0,0 +1,281 @@
+"""STK callback handling and the queued ingestion mode.
+
+In ``inline`` mode (the default) ``mpesa_callback`` processes each callback
+before answering Safaricom. In ``queued`` mode it only appends the raw body
+to ``CallbackInbox`` and answers immediately; ``manage.py process_callbacks``
+then drains the inbox in batches with ``bulk_create``/``bulk_update``.
+
+Safaricom redelivers callbacks. Both modes keep one ``MpesaCallback`` per
+``(checkout_request_id, result_code)`` (enforced by a unique constraint)
+and only ever move a transaction out of PENDING, so a late or repeated
+callback can't overwrite a settled status. A callback received on a
+merchant's URL (``/callback/<merchant>/``) only settles that merchant's
+transactions.
+
+``CallbackMetadata`` is parsed once per callback by
+``parse_callback_metadata``; the callback row and the transaction keep the
+values in typed columns, and the raw body is stored compressed (see
+``payloads.py``).
+"""
+import json
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connection, transaction as db_transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from . import metrics
+from .merchants import UnknownMerchant, get_merchant
+from .models import CallbackInbox, MpesaCallback, MpesaTransaction
+from .signals import send_transaction_updated
+from .utils import format_phone_number, status_for_result_code
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_UPDATE_FIELDS = [
+    'status', 'result_code', 'result_desc', 'mpesa_receipt_number', 'transaction_date',
+    'paid_amount', 'paid_phone_number', 'updated_at',
+]
+
+
+def callback_mode():
+    return getattr(settings, 'MPESA_CALLBACK_MODE', 'inline')
+
+
+def is_duplicate_callback(stk_callback):
+    """Whether this outcome was already recorded. One lookup on the unique index"""
+    return MpesaCallback.objects.filter(
+        checkout_request_id=stk_callback.get('CheckoutRequestID'),
+        result_code=str(stk_callback.get('ResultCode')),
+    ).exists()
+
+
+def settle_transaction(transaction):
+    """Write the outcome set by ``apply_callback`` if the transaction is still PENDING
+
+    A conditional UPDATE rather than ``save()``, so concurrent or late
+    callbacks can't overwrite each other. Returns whether a row was updated.
+    """
+    values = {field: getattr(transaction, field) for field in TRANSACTION_UPDATE_FIELDS}
+    return MpesaTransaction.objects.filter(pk=transaction.pk, status='PENDING').update(**values) == 1
+
+
+def get_stk_callback(callback_data):
+    """Return the ``stkCallback`` object of a callback body, or ``{}`` if it has none"""
+    body = callback_data.get('Body') if isinstance(callback_data, dict) else None
+    stk_callback = body.get('stkCallback') if isinstance(body, dict) else None
+    return stk_callback if isinstance(stk_callback, dict) else {}
+
+
+def _parse_decimal(value):
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        logger.warning("Could not parse amount: %s", value)
+        return None
+
+
+def _parse_date(value):
+    try:
+        # Convert M-Pesa date format to datetime
+        return timezone.make_aware(datetime.strptime(str(value), '%Y%m%d%H%M%S'))
+    except ValueError:
+        logger.warning("Could not parse transaction date: %s", value)
+        return None
+
+
+def parse_callback_metadata(stk_callback):
+    """Return the ``CallbackMetadata`` items of an ``stkCallback`` as typed values
+
+    Keys are ``amount``, ``mpesa_receipt_number``, ``transaction_date``,
+    ``phone_number`` and ``balance``; items missing from the callback, as on
+    failed payments, are left out.
+    """
+    metadata = {}
+    for item in (stk_callback.get('CallbackMetadata') or {}).get('Item', []):
+        name = item.get('Name')
+        value = item.get('Value')
+        if value is None or value == '':
+            continue
+        if name == 'Amount':
+            metadata['amount'] = _parse_decimal(value)
+        elif name == 'MpesaReceiptNumber':
+            metadata['mpesa_receipt_number'] = str(value)
+        elif name == 'TransactionDate':
+            metadata['transaction_date'] = _parse_date(value)
+        elif name == 'PhoneNumber':
+            metadata['phone_number'] = format_phone_number(str(value))
+        elif name == 'Balance':
+            metadata['balance'] = _parse_decimal(value)
+    return metadata
+
+
+def build_callback_record(transaction, callback_data, metadata=None):
+    """Return an unsaved ``MpesaCallback`` for the callback body"""
+    stk_callback = get_stk_callback(callback_data)
+    if metadata is None:
+        metadata = parse_callback_metadata(stk_callback)
+    return MpesaCallback(
+        transaction=transaction,
+        merchant_request_id=stk_callback.get('MerchantRequestID') or '',
+        checkout_request_id=stk_callback.get('CheckoutRequestID'),
+        result_code=str(stk_callback.get('ResultCode')),
+        result_desc=stk_callback.get('ResultDesc'),
+        amount=metadata.get('amount'),
+        phone_number=metadata.get('phone_number', ''),
+        mpesa_receipt_number=metadata.get('mpesa_receipt_number'),
+        transaction_date=metadata.get('transaction_date'),
+        balance=metadata.get('balance'),
+        callback_data=callback_data,
+    )
+
+
+def apply_callback(transaction, stk_callback, metadata=None):
+    """Update a transaction from an ``stkCallback``. The transaction is not saved"""
+    result_code = stk_callback.get('ResultCode')
+    metrics.result_codes.inc(source='callback', result_code=result_code)
+    transaction.result_code = str(result_code)
+    transaction.result_desc = stk_callback.get('ResultDesc')
+    transaction.updated_at = timezone.now()
+
+    # Update transaction status based on result code
+    transaction.status = status_for_result_code(result_code)
+    if transaction.status != 'SUCCESS':
+        return
+
+    if metadata is None:
+        metadata = parse_callback_metadata(stk_callback)
+    if 'mpesa_receipt_number' in metadata:
+        transaction.mpesa_receipt_number = metadata['mpesa_receipt_number']
+    if metadata.get('transaction_date'):
+        transaction.transaction_date = metadata['transaction_date']
+    transaction.paid_amount = metadata.get('amount')
+    transaction.paid_phone_number = metadata.get('phone_number', '')
+
+
+def enqueue_callback(body, merchant=None):
+    """Durably store a raw callback body, and the ``MerchantRoute`` it was sent to, for later processing"""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return CallbackInbox.objects.create(body=body, merchant_code=merchant.code if merchant else '')
+
+
+def _merchant_error(entry, transaction, routes):
+    """Why a queued callback may not settle ``transaction``, or None if it may"""
+    if not entry.merchant_code:
+        return None
+    if entry.merchant_code not in routes:
+        try:
+            routes[entry.merchant_code] = get_merchant(entry.merchant_code)
+        except UnknownMerchant as e:
+            routes[entry.merchant_code] = e
+    route = routes[entry.merchant_code]
+    if isinstance(route, UnknownMerchant):
+        return str(route)
+    if transaction.merchant_id != route.id:
+        return f'Transaction does not belong to merchant {route.code!r}'
+    return None
+
+
+def drain_inbox(batch_size=500, max_attempts=None):
+    """Process one batch of queued callbacks. Returns the number of inbox rows handled"""
+    if max_attempts is None:
+        max_attempts = getattr(settings, 'MPESA_CALLBACK_MAX_ATTEMPTS', 5)
+
+    with db_transaction.atomic(), metrics.stage('drain_inbox', 'batch'):
+        now = timezone.now()
+        pending = CallbackInbox.objects.filter(
+            processed_at__isnull=True, available_at__lte=now,
+        ).order_by('available_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        entries = list(pending[:batch_size])
+        if not entries:
+            return 0
+
+        parsed = {}
+        for entry in entries:
+            try:
+                data = json.loads(entry.body)
+            except ValueError as e:
+                entry.last_error = f'Invalid JSON: {e}'
+                continue
+            if isinstance(data, dict):
+                parsed[entry.id] = data
+            else:
+                entry.last_error = 'Callback body is not a JSON object'
+
+        checkout_ids = {get_stk_callback(data).get('CheckoutRequestID') for data in parsed.values()} - {None}
+        transactions = MpesaTransaction.objects.filter(checkout_request_id__in=checkout_ids)
+        if connection.features.has_select_for_update:
+            # Hold settled/pending status steady until the batch commits
+            transactions = transactions.select_for_update()
+        transactions = {t.checkout_request_id: t for t in transactions}
+        seen = set(
+            MpesaCallback.objects.filter(checkout_request_id__in=checkout_ids)
+            .values_list('checkout_request_id', 'result_code')
+        )
+
+        retry_delay = getattr(settings, 'MPESA_CALLBACK_RETRY_DELAY', 5)
+        callbacks, updated, routes = [], {}, {}
+        for entry in entries:
+            entry.attempts += 1
+            data = parsed.get(entry.id)
+            if data is None:
+                entry.processed_at = now
+                continue
+
+            stk_callback = get_stk_callback(data)
+            outcome = (stk_callback.get('CheckoutRequestID'), str(stk_callback.get('ResultCode')))
+            if outcome in seen:
+                metrics.duplicate_callbacks.inc()
+                entry.processed_at = now
+                entry.last_error = None
+                continue
+
+            transaction = transactions.get(stk_callback.get('CheckoutRequestID'))
+            if transaction is None:
+                # The callback can beat the STK push response; retry on a later pass
+                entry.last_error = 'Transaction not found'
+                entry.available_at = now + timedelta(seconds=retry_delay * entry.attempts)
+                if entry.attempts >= max_attempts:
+                    entry.processed_at = now
+                continue
+
+            error = _merchant_error(entry, transaction, routes)
+            if error:
+                logger.warning("Queued callback for checkout_request_id=%s refused: %s", outcome[0], error)
+                entry.processed_at = now
+                entry.last_error = error
+                continue
+
+            seen.add(outcome)
+            metadata = parse_callback_metadata(stk_callback)
+            callbacks.append(build_callback_record(transaction, data, metadata))
+            if transaction.status == 'PENDING':
+                apply_callback(transaction, stk_callback, metadata)
+                updated[transaction.pk] = transaction
+            entry.processed_at = now
+            entry.last_error = None
+
+        MpesaCallback.objects.bulk_create(callbacks, ignore_conflicts=True)
+        MpesaTransaction.objects.bulk_update(list(updated.values()), TRANSACTION_UPDATE_FIELDS)
+        send_transaction_updated(*updated)
+        CallbackInbox.objects.bulk_update(entries, ['processed_at', 'available_at', 'attempts', 'last_error'])
+
+    return len(entries)
+
+
+def inbox_stats():
+    """Return the inbox depth and how long the oldest queued callback has waited"""
+    summary = CallbackInbox.objects.filter(processed_at__isnull=True).aggregate(
+        depth=Count('id'), oldest=Min('received_at'),
+    )
+    oldest = summary['oldest']
+    return {
+        'depth': summary['depth'],
+        'lag_seconds': (timezone.now() - oldest).total_seconds() if oldest else 0.0,
+    }
@@ -0,0 +1,318 @@
+"""Pooled HTTP clients for the Safaricom Daraja API.
+
+A single ``DarajaClient`` owns a ``requests.Session`` so TCP connections and
+TLS sessions are reused between calls instead of being set up for every
+payment. All requests carry connect/read timeouts, and idempotent calls
+(OAuth, STK query) are retried with jittered exponential backoff. The
+shared clients also go through the rate limiter and circuit breaker in
+``resilience.py``.
+
+``AsyncDarajaClient`` is the asyncio equivalent used by the async views. It
+needs ``aiohttp``; without it ``get_async_client`` falls back to running the
+sync client in a thread pool.
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+import time
+
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+from .metrics import upstream_seconds
+from .profiling import record_upstream
+from .resilience import daraja_breaker, rate_limiter
+
+try:
+    import aiohttp
+except ImportError:  # Optional: only needed for native async Daraja calls
+    aiohttp = None
+
+DEFAULT_BASE_URL = 'https://api.safaricom.co.ke'
+
+OAUTH_PATH = '/oauth/v1/generate?grant_type=client_credentials'
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+STK_QUERY_PATH = '/mpesa/stkpushquery/v1/query'
+
+# Endpoint labels for the upstream latency histogram
+ENDPOINT_NAMES = {OAUTH_PATH: 'oauth', STK_PUSH_PATH: 'stk_push', STK_QUERY_PATH: 'stk_query'}
+
+# Upstream responses worth retrying for idempotent calls
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Network-level errors raised by either client
+TRANSPORT_ERRORS = (requests.exceptions.RequestException, asyncio.TimeoutError) + (
+    (aiohttp.ClientError,) if aiohttp else ())
+
+
+def _backoff_delay(attempt, backoff, max_backoff):
+    # "Full jitter": spread retries from many workers across the window
+    return random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+
+
+def _basic_auth(consumer_key, consumer_secret):
+    auth_b64 = base64.b64encode(f'{consumer_key}:{consumer_secret}'.encode('utf-8')).decode('utf-8')
+    return {
+        'Authorization': f'Basic {auth_b64}',
+        'Content-Type': 'application/json'
+    }
+
+
+def _observe(path, started, outcome):
+    seconds = time.perf_counter() - started
+    upstream_seconds.observe(seconds, endpoint=ENDPOINT_NAMES.get(path, path), outcome=outcome)
+    record_upstream(seconds)
+
+
+def _succeeded(outcome):
+    """Whether an attempt counts as healthy for the circuit breaker"""
+    return outcome != 'error' and int(outcome) != 429 and int(outcome) < 500
+
+
+def _bearer(access_token):
+    return {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+
+
+def _parse_access_token(response):
+    if response.status_code != 200:
+        raise requests.exceptions.HTTPError(
+            f"Failed to get access token: {response.status_code} - {response.text}",
+            response=response,
+        )
+    data = response.json()
+    return data['access_token'], data.get('expires_in', 3599)
+
+
+class DarajaClient:
+    """Thread-safe Daraja client backed by a connection pool"""
+
+    def __init__(self, base_url=None, pool_size=10, connect_timeout=5, read_timeout=30,
+                 max_retries=2, backoff=0.5, max_backoff=5, rate_limiter=None, breaker=None):
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip('/')
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, idempotent=False, **kwargs):
+        """Send a request, retrying transient failures
+
+        Idempotent requests are retried on connection errors, timeouts and
+        retryable status codes. Other requests are only retried when the
+        connection could not be established, since the upstream never saw them.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        url = f'{self.base_url}{path}'
+        attempt = 0
+        while True:
+            try:
+                response = self._send(method, path, url, **kwargs)
+            except requests.exceptions.ConnectTimeout:
+                if attempt >= self.max_retries:
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+            else:
+                if not idempotent or response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                response.close()
+            time.sleep(_backoff_delay(attempt, self.backoff, self.max_backoff))
+            attempt += 1
+
+    def _send(self, method, path, url, **kwargs):
+        if self.rate_limiter:
+            self.rate_limiter.acquire(ENDPOINT_NAMES.get(path, path))
+        probe = self.breaker.allow() if self.breaker else False
+        started, outcome = time.perf_counter(), 'error'
+        try:
+            response = self.session.request(method, url, **kwargs)
+            outcome = str(response.status_code)
+            return response
+        finally:
+            _observe(path, started, outcome)
+            if self.breaker:
+                self.breaker.record(_succeeded(outcome), probe)
+
+    def get_access_token(self, consumer_key, consumer_secret):
+        """Fetch an OAuth token. Returns ``(access_token, expires_in)``"""
+        response = self.request('GET', OAUTH_PATH, idempotent=True,
+                                headers=_basic_auth(consumer_key, consumer_secret))
+        return _parse_access_token(response)
+
+    def stk_push(self, payload, access_token):
+        """Send an STK push request. Not retried: a duplicate would prompt the customer twice"""
+        return self.request('POST', STK_PUSH_PATH, json=payload, headers=_bearer(access_token))
+
+    def stk_query(self, payload, access_token):
+        """Query the status of an STK push"""
+        return self.request('POST', STK_QUERY_PATH, idempotent=True, json=payload,
+                            headers=_bearer(access_token))
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncResponse:
+    """Buffered async response exposing the parts of ``requests.Response`` we use"""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncDarajaClient:
+    """asyncio Daraja client backed by an ``aiohttp`` connection pool
+
+    An ``aiohttp.ClientSession`` is tied to the event loop it was created on,
+    so use ``get_async_client`` rather than sharing one instance across loops.
+    """
+
+    def __init__(self, base_url=None, pool_size=100, connect_timeout=5, read_timeout=30,
+                 max_retries=2, backoff=0.5, max_backoff=5, rate_limiter=None, breaker=None):
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip('/')
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            timeout=aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout),
+        )
+
+    async def request(self, method, path, idempotent=False, **kwargs):
+        """Send a request, retrying transient failures like ``DarajaClient.request``"""
+        url = f'{self.base_url}{path}'
+        attempt = 0
+        while True:
+            try:
+                result = await self._send(method, path, url, **kwargs)
+            except aiohttp.ClientConnectorError:
+                if attempt >= self.max_retries:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+            else:
+                if not idempotent or result.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return result
+            await asyncio.sleep(_backoff_delay(attempt, self.backoff, self.max_backoff))
+            attempt += 1
+
+    async def _send(self, method, path, url, **kwargs):
+        if self.rate_limiter:
+            await self.rate_limiter.aacquire(ENDPOINT_NAMES.get(path, path))
+        probe = await self.breaker.aallow() if self.breaker else False
+        started, outcome = time.perf_counter(), 'error'
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                result = AsyncResponse(response.status, await response.text())
+            outcome = str(result.status_code)
+            return result
+        finally:
+            _observe(path, started, outcome)
+            if self.breaker:
+                await self.breaker.arecord(_succeeded(outcome), probe)
+
+    async def get_access_token(self, consumer_key, consumer_secret):
+        """Fetch an OAuth token. Returns ``(access_token, expires_in)``"""
+        response = await self.request('GET', OAUTH_PATH, idempotent=True,
+                                      headers=_basic_auth(consumer_key, consumer_secret))
+        return _parse_access_token(response)
+
+    async def stk_push(self, payload, access_token):
+        """Send an STK push request. Not retried: a duplicate would prompt the customer twice"""
+        return await self.request('POST', STK_PUSH_PATH, json=payload, headers=_bearer(access_token))
+
+    async def stk_query(self, payload, access_token):
+        """Query the status of an STK push"""
+        return await self.request('POST', STK_QUERY_PATH, idempotent=True, json=payload,
+                                  headers=_bearer(access_token))
+
+    async def close(self):
+        await self.session.close()
+
+
+class ThreadedAsyncDarajaClient:
+    """Async facade over the sync client, used when aiohttp is not installed"""
+
+    def __init__(self, client):
+        self._client = client
+
+    async def get_access_token(self, consumer_key, consumer_secret):
+        return await sync_to_async(self._client.get_access_token, thread_sensitive=False)(
+            consumer_key, consumer_secret)
+
+    async def stk_push(self, payload, access_token):
+        return await sync_to_async(self._client.stk_push, thread_sensitive=False)(payload, access_token)
+
+    async def stk_query(self, payload, access_token):
+        return await sync_to_async(self._client.stk_query, thread_sensitive=False)(payload, access_token)
+
+    async def close(self):
+        pass
+
+
+def new_client(base_url=None):
+    """Create a pooled ``DarajaClient`` configured from settings"""
+    return DarajaClient(
+        base_url=base_url or os.getenv('MPESA_BASE_URL'),
+        pool_size=getattr(settings, 'MPESA_HTTP_POOL_SIZE', 10),
+        connect_timeout=getattr(settings, 'MPESA_HTTP_CONNECT_TIMEOUT', 5),
+        read_timeout=getattr(settings, 'MPESA_HTTP_READ_TIMEOUT', 30),
+        max_retries=getattr(settings, 'MPESA_HTTP_MAX_RETRIES', 2),
+        backoff=getattr(settings, 'MPESA_HTTP_BACKOFF', 0.5),
+        rate_limiter=rate_limiter,
+        breaker=daraja_breaker,
+    )
+
+
+def new_async_client(base_url=None, sync_client=None):
+    """Create an async client for the running event loop
+
+    Without aiohttp it wraps the client returned by ``sync_client()``.
+    """
+    if aiohttp is None:
+        return ThreadedAsyncDarajaClient(sync_client() if sync_client else new_client(base_url))
+    return AsyncDarajaClient(
+        base_url=base_url or os.getenv('MPESA_BASE_URL'),
+        pool_size=getattr(settings, 'MPESA_ASYNC_HTTP_POOL_SIZE', 100),
+        connect_timeout=getattr(settings, 'MPESA_HTTP_CONNECT_TIMEOUT', 5),
+        read_timeout=getattr(settings, 'MPESA_HTTP_READ_TIMEOUT', 30),
+        max_retries=getattr(settings, 'MPESA_HTTP_MAX_RETRIES', 2),
+        backoff=getattr(settings, 'MPESA_HTTP_BACKOFF', 0.5),
+        rate_limiter=rate_limiter,
+        breaker=daraja_breaker,
+    )
+
+
+def get_client(merchant=None):
+    """Return the pooled ``DarajaClient`` of ``merchant`` (a ``MerchantRoute``), by default the default merchant's"""
+    if merchant is None:
+        from .merchants import get_merchant
+        merchant = get_merchant()
+    return merchant.client
+
+
+def get_async_client(merchant):
+    """Return the async Daraja client of ``merchant`` for the running event loop
+
+    Async callers resolve the merchant with ``merchants.aget_merchant``,
+    which may need the database.
+    """
+    return merchant.async_client()
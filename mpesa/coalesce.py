@@ -0,0 +1,183 @@
+"""Coalescing of STK status queries.
+
+Several tabs or retrying clients polling the same ``checkout_request_id``
+should cost one ``stkpushquery`` call, not one each. A query is answered,
+in order:
+
+* from the database, if the transaction already reached a final status,
+  as a result with ``source='local'`` and the transaction's own status
+  rather than a Daraja ``response_data``;
+* from a short-lived cached result of a previous query;
+* by joining a query for the same checkout id that is already in flight
+  in this process (single flight);
+* by calling Safaricom, whose result is then cached for everyone else.
+"""
+import asyncio
+import threading
+import weakref
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+from .models import ArchivedTransaction, MpesaTransaction
+
+QUERY_FIELDS = ('status', 'result_code', 'result_desc', 'merchant_request_id', 'checkout_request_id')
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share its result"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """``SingleFlight`` for coroutines. Calls are shared per event loop"""
+
+    def __init__(self):
+        self._tasks = weakref.WeakKeyDictionary()
+        self.shared = 0
+
+    async def do(self, key, fn, *args):
+        tasks = self._tasks.setdefault(asyncio.get_running_loop(), {})
+        task = tasks.get(key)
+        if task is None:
+            task = tasks[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: tasks.pop(key, None))
+        else:
+            self.shared += 1
+        # A cancelled caller must not cancel the query for the others
+        return await asyncio.shield(task)
+
+
+query_flight = SingleFlight()
+async_query_flight = AsyncSingleFlight()
+
+
+def _cache():
+    return caches[getattr(settings, 'MPESA_STK_QUERY_CACHE', 'default')]
+
+
+def _key(checkout_request_id):
+    return f'mpesa:stkquery:{checkout_request_id}'
+
+
+def local_query_result(transaction):
+    """Answer a query from a transaction that is already final, or return None"""
+    if transaction is None or transaction.status not in MpesaTransaction.TERMINAL_STATUSES:
+        return None
+    if transaction.result_code is None:
+        return None
+    metrics.result_codes.inc(source='local', result_code=transaction.result_code)
+    return {
+        'success': True,
+        'source': 'local',
+        'status': transaction.status,
+        'result_code': transaction.result_code,
+        'result_desc': transaction.result_desc,
+        'merchant_request_id': transaction.merchant_request_id,
+        'checkout_request_id': transaction.checkout_request_id,
+    }
+
+
+def find_transaction(checkout_request_id):
+    """Look the checkout id up in the live table, then in the archive"""
+    for model in (MpesaTransaction, ArchivedTransaction):
+        transaction = model.objects.only(*QUERY_FIELDS).filter(checkout_request_id=checkout_request_id).first()
+        if transaction is not None:
+            return transaction
+    return None
+
+
+async def afind_transaction(checkout_request_id):
+    for model in (MpesaTransaction, ArchivedTransaction):
+        transaction = await model.objects.only(*QUERY_FIELDS).filter(checkout_request_id=checkout_request_id).afirst()
+        if transaction is not None:
+            return transaction
+    return None
+
+
+def get_cached_result(checkout_request_id):
+    return _cache().get(_key(checkout_request_id))
+
+
+def cache_result(checkout_request_id, result):
+    """Cache a query result for ``MPESA_STK_QUERY_CACHE_TTL`` seconds. Errors are not cached"""
+    if result.get('success'):
+        _cache().set(_key(checkout_request_id), result, timeout=getattr(settings, 'MPESA_STK_QUERY_CACHE_TTL', 5))
+    return result
+
+
+def _query_and_cache(checkout_request_id, query):
+    # Another flight may have just filled the cache
+    result = get_cached_result(checkout_request_id)
+    if result is None:
+        result = cache_result(checkout_request_id, query(checkout_request_id))
+    return result
+
+
+async def _aquery_and_cache(checkout_request_id, query):
+    result = await _cache().aget(_key(checkout_request_id))
+    if result is None:
+        result = await query(checkout_request_id)
+        if result.get('success'):
+            await _cache().aset(
+                _key(checkout_request_id), result, timeout=getattr(settings, 'MPESA_STK_QUERY_CACHE_TTL', 5),
+            )
+    return result
+
+
+def coalesced_query(checkout_request_id, query):
+    """Answer an STK query locally if possible, else through ``query`` with coalescing"""
+    result = local_query_result(find_transaction(checkout_request_id))
+    if result is None:
+        result = get_cached_result(checkout_request_id)
+    if result is None:
+        result = query_flight.do(checkout_request_id, _query_and_cache, checkout_request_id, query)
+    return result
+
+
+async def acoalesced_query(checkout_request_id, query):
+    """Async version of ``coalesced_query``; ``query`` is a coroutine function"""
+    result = local_query_result(await afind_transaction(checkout_request_id))
+    if result is None:
+        result = await _cache().aget(_key(checkout_request_id))
+    if result is None:
+        result = await async_query_flight.do(checkout_request_id, _aquery_and_cache, checkout_request_id, query)
+    return result
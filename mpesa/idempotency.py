@@ -0,0 +1,139 @@
+"""Idempotent STK push.
+
+Clients may send an ``Idempotency-Key`` header (or ``idempotency_key``
+body field) with an STK push. The key is stored, scoped to the user, in a
+unique column of the transaction it created, so a retried or double-clicked
+request is answered from that transaction with a single indexed read
+instead of prompting the customer again. Keys are released once they are
+older than ``MPESA_IDEMPOTENCY_WINDOW`` seconds.
+"""
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import IntegrityError, transaction as db_transaction
+from django.utils import timezone
+
+from .merchants import get_merchant
+from .models import MpesaTransaction
+from .utils import queued_result
+
+MAX_KEY_LENGTH = 200
+
+REPLAY_FIELDS = (
+    'id', 'user_id', 'phone_number', 'amount', 'status', 'result_code', 'result_desc',
+    'merchant_request_id', 'checkout_request_id', 'created_at', 'queued_at',
+)
+
+
+class IdempotencyError(Exception):
+    """A repeated request that can't be answered with the original result"""
+
+    def __init__(self, message, status=409):
+        super().__init__(message)
+        self.status = status
+
+
+def get_request_key(request, data):
+    """Return the client's idempotency key, or None. Raises IdempotencyError if it is malformed"""
+    key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    if key is None:
+        return None
+    key = str(key).strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(f'Idempotency key must be 1 to {MAX_KEY_LENGTH} characters', status=400)
+    return key
+
+
+def scoped_key(key, user=None):
+    """Namespace a client key by user so keys from different users never collide"""
+    owner = user.pk if user is not None and user.is_authenticated else 'anon'
+    return f'{owner}:{key}'
+
+
+def replay_result(transaction):
+    """Rebuild the ``process_stk_push`` result of an earlier request"""
+    if transaction.status == 'INITIATED':
+        return {**queued_result(transaction), 'idempotent_replay': True}
+    if transaction.checkout_request_id:
+        return {
+            'success': True,
+            'message': 'STK Push sent successfully',
+            'transaction_id': str(transaction.id),
+            'checkout_request_id': transaction.checkout_request_id,
+            'merchant_request_id': transaction.merchant_request_id,
+            'idempotent_replay': True,
+        }
+    return {
+        'success': False,
+        'error': transaction.result_desc,
+        'error_code': str(transaction.result_code),
+        'transaction_id': str(transaction.id),
+        'idempotent_replay': True,
+    }
+
+
+def _same_request(transaction, phone_number, amount):
+    try:
+        return transaction.phone_number == phone_number and transaction.amount == Decimal(str(amount))
+    except InvalidOperation:
+        return False
+
+
+def get_replay(key, phone_number, amount):
+    """Return the original result for a repeated key, or None if the key is new or expired"""
+    transaction = MpesaTransaction.objects.only(*REPLAY_FIELDS).filter(idempotency_key=key).first()
+    if transaction is None:
+        return None
+
+    window = getattr(settings, 'MPESA_IDEMPOTENCY_WINDOW', 86400)
+    if transaction.created_at < timezone.now() - timedelta(seconds=window):
+        # Expired: release the key so it can start a new payment
+        MpesaTransaction.objects.filter(id=transaction.id, idempotency_key=key).update(idempotency_key=None)
+        return None
+
+    if not _same_request(transaction, phone_number, amount):
+        raise IdempotencyError('Idempotency key was already used for a different payment', status=422)
+    if transaction.status == 'INITIATED' and transaction.queued_at is None:
+        raise IdempotencyError('A request with this idempotency key is still being processed')
+    return replay_result(transaction)
+
+
+def begin_stk_push(phone_number, amount, user=None, idempotency_key=None, queue=False, merchant=None,
+                   account_reference=None):
+    """Create the INITIATED transaction for an STK push
+
+    Returns ``(transaction, None)`` for a new request and ``(None, result)``
+    when the idempotency key was seen before. With ``queue`` the transaction
+    is left for ``dispatch_stk_pushes`` to send. ``merchant`` is the
+    ``MerchantRoute`` it is paid to, by default the default merchant. The
+    transaction keeps the account reference Daraja is sent, so rollups can
+    group by it.
+    """
+    merchant = merchant or get_merchant()
+    user = user if user and user.is_authenticated else None
+    key = scoped_key(idempotency_key, user) if idempotency_key else None
+    if key:
+        replay = get_replay(key, phone_number, amount)
+        if replay is not None:
+            return None, replay
+
+    try:
+        with db_transaction.atomic():
+            transaction = MpesaTransaction.objects.create(
+                user=user,
+                merchant_id=merchant.id,
+                phone_number=phone_number,
+                amount=amount,
+                account_reference=account_reference or merchant.account_reference,
+                status='INITIATED',
+                idempotency_key=key,
+                queued_at=timezone.now() if queue else None,
+            )
+    except IntegrityError:
+        # A concurrent request with the same key got there first
+        replay = get_replay(key, phone_number, amount) if key else None
+        if replay is None:
+            raise
+        return None, replay
+    return transaction, None
@@ -0,0 +1,38 @@
+import gzip
+
+from django.core.management.base import BaseCommand
+
+from mpesa.archive import archive_transactions, purge_archive
+
+
+class Command(BaseCommand):
+    help = "Move settled transactions and their callbacks out of the hot tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, help='Days after which settled transactions are archived')
+        parser.add_argument('--batch-size', type=int, help='Transactions moved per database transaction')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to wait between batches')
+        parser.add_argument('--export', help='Also write the archived transactions to this .jsonl.gz file')
+        parser.add_argument('--purge-after', type=int,
+                            help='Then delete archived transactions older than this many days')
+
+    def handle(self, *args, **options):
+        export = gzip.open(options['export'], 'at', encoding='utf-8') if options['export'] else None
+        archived = 0
+        try:
+            for count in archive_transactions(
+                older_than_days=options['older_than'],
+                batch_size=options['batch_size'],
+                export=export,
+                pause=options['pause'],
+            ):
+                archived += count
+                self.stdout.write(f'Archived {archived} transactions', ending='\r')
+        finally:
+            if export is not None:
+                export.close()
+        self.stdout.write(f'Archived {archived} transactions')
+
+        if options['purge_after'] is not None:
+            purged = purge_archive(options['purge_after'], batch_size=options['batch_size'])
+            self.stdout.write(f'Purged {purged} archived transactions')
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mpesa.outbox import dispatch_batch, fail_stale_claims, outbox_stats
+
+
+class Command(BaseCommand):
+    help = "Send STK pushes queued by MPESA_STK_DISPATCH = 'queued'"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Transactions claimed per batch')
+        parser.add_argument('--workers', type=int, help='Concurrent Daraja calls')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for queued pushes')
+        parser.add_argument('--interval', type=float, default=0.5, help='Seconds to sleep when nothing is queued')
+        parser.add_argument('--stats', action='store_true', help='Print queue depth and lag, then exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            stats = outbox_stats()
+            self.stdout.write(f"depth={stats['depth']} lag_seconds={stats['lag_seconds']:.1f}")
+            return
+
+        while True:
+            fail_stale_claims()
+            sent = 0
+            while True:
+                count = dispatch_batch(batch_size=options['batch_size'], max_workers=options['workers'])
+                sent += count
+                if not count:
+                    break
+            if sent:
+                self.stdout.write(f'Dispatched {sent} STK pushes')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mpesa.callbacks import drain_inbox, inbox_stats
+
+
+class Command(BaseCommand):
+    help = "Process M-Pesa callbacks queued by MPESA_CALLBACK_MODE = 'queued'"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true', help='Keep polling the inbox')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the inbox is empty')
+        parser.add_argument('--stats', action='store_true', help='Print queue depth and lag, then exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            stats = inbox_stats()
+            self.stdout.write(f"depth={stats['depth']} lag_seconds={stats['lag_seconds']:.1f}")
+            return
+
+        while True:
+            handled = 0
+            while True:
+                count = drain_inbox(batch_size=options['batch_size'])
+                handled += count
+                if count < options['batch_size']:
+                    break
+            if handled:
+                self.stdout.write(f'Processed {handled} callbacks')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,42 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from mpesa.rollups import rebuild_rollups, roll_up
+
+
+def parse_day(value):
+    try:
+        return timezone.make_aware(datetime.combine(datetime.strptime(value, '%Y-%m-%d').date(), time.min))
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+
+
+class Command(BaseCommand):
+    help = "Recompute the transaction rollups from history, or count transactions they missed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=parse_day, help='First day to rebuild (default: the first transaction)')
+        parser.add_argument('--until', type=parse_day, help='Day to stop before (default: now)')
+        parser.add_argument('--chunk-days', type=int, default=1, help='Days recomputed per database transaction')
+        parser.add_argument('--pending', action='store_true',
+                            help='Only add settled transactions not counted yet instead of rebuilding')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Transactions per batch with --pending')
+
+    def handle(self, *args, **options):
+        if options['pending']:
+            total = 0
+            while True:
+                count = roll_up(batch_size=options['batch_size'])
+                total += count
+                if count < options['batch_size']:
+                    break
+            self.stdout.write(f'Rolled up {total} transactions')
+            return
+
+        total = 0
+        for start, end, count in rebuild_rollups(options['since'], options['until'], options['chunk_days']):
+            total += count
+            self.stdout.write(f'{start:%Y-%m-%d} to {end:%Y-%m-%d}: {count} transactions', ending='\r')
+        self.stdout.write(f'\nRebuilt rollups from {total} transactions')
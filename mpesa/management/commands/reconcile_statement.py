@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mpesa.reconcile import StatementError, reconcile_statement
+
+
+class Command(BaseCommand):
+    help = "Reconcile an M-Pesa statement CSV against local transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', help='Statement CSV exported from the M-Pesa portal')
+        parser.add_argument('--report', help='Write the discrepancies to this CSV file (default: stdout)')
+        parser.add_argument('--apply', action='store_true',
+                            help='Settle local transactions that the statement shows as paid')
+        parser.add_argument('--window', type=int, help='Seconds between statement and local times for a match')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Corrections per bulk_update')
+
+    def handle(self, *args, **options):
+        report = open(options['report'], 'w', newline='') if options['report'] else sys.stdout
+        try:
+            with open(options['statement'], newline='', encoding='utf-8-sig') as statement:
+                counts = reconcile_statement(
+                    statement, report,
+                    apply=options['apply'], window=options['window'], batch_size=options['batch_size'],
+                )
+        except StatementError as e:
+            raise CommandError(str(e))
+        finally:
+            if report is not sys.stdout:
+                report.close()
+
+        summary = ' '.join(f'{kind}={count}' for kind, count in sorted(counts.items()))
+        self.stderr.write(f'Reconciled: {summary}')
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mpesa.sweeper import sweep_pending
+
+
+class Command(BaseCommand):
+    help = "Query Safaricom for stale PENDING transactions and apply their final status"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=500, help='Transactions per pass')
+        parser.add_argument('--older-than', type=int, help='Seconds a transaction must have been pending')
+        parser.add_argument('--timeout-after', type=int, help='Seconds after which an unanswered transaction times out')
+        parser.add_argument('--workers', type=int, help='Concurrent STK queries')
+        parser.add_argument('--rate', type=float, help='Maximum STK queries per second')
+        parser.add_argument('--loop', action='store_true', help='Keep sweeping')
+        parser.add_argument('--interval', type=float, default=60.0, help='Seconds between passes')
+
+    def handle(self, *args, **options):
+        while True:
+            counts = sweep_pending(
+                older_than=options['older_than'],
+                timeout_after=options['timeout_after'],
+                limit=options['limit'],
+                max_workers=options['workers'],
+                rate=options['rate'],
+            )
+            if counts:
+                summary = ' '.join(f'{status}={count}' for status, count in sorted(counts.items()))
+                self.stdout.write(f'Resolved {sum(counts.values())} transactions: {summary}')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
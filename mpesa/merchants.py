@@ -0,0 +1,244 @@
+"""Per-merchant Daraja configuration, token caches and connection pools.
+
+Each active ``Merchant`` is a till or paybill with its own Daraja app. The
+registry loads them all in one query into dicts keyed by code and id, so
+resolving the merchant of a request or a transaction is a dict lookup.
+Every merchant gets a ``MerchantRoute`` with its settings, its own
+``AccessTokenManager`` and its own HTTP connection pools, opened on first use.
+
+Saving or deleting a merchant clears this process's registry and bumps a
+version key in the Django cache; other processes notice it within
+``MPESA_MERCHANT_RELOAD_SECONDS`` and reload. Routes of unchanged merchants
+are kept across reloads, with their tokens and connections.
+
+Requests that name no merchant, and transactions without one, use the
+merchant marked ``is_default``. Without one, a ``default`` merchant is built
+from the ``.env`` credentials, so single-till deployments need no rows.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from dotenv import load_dotenv
+
+from .client import new_async_client, new_client
+from .models import Merchant, MpesaTransaction
+from .tokens import AccessTokenManager
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CODE = 'default'
+
+Routes = namedtuple('Routes', 'by_code by_id default')
+
+
+class UnknownMerchant(ValueError):
+    """Raised for a merchant that is not configured or not active"""
+
+
+def env_merchant():
+    """The merchant configured in ``.env``, as an unsaved ``Merchant``"""
+    return Merchant(
+        code=DEFAULT_CODE,
+        name='Default',
+        shortcode=os.getenv('MPESA_SHORTCODE') or '',
+        # The till this app was first deployed for
+        party_b=os.getenv('MPESA_PARTY_B', '9445283'),
+        consumer_key=os.getenv('CONSUMER_KEY') or '',
+        consumer_secret=os.getenv('CONSUMER_SECRET') or '',
+        passkey=os.getenv('MPESA_PASSKEY') or '',
+        callback_url=os.getenv('CALLBACK_URL') or '',
+        account_reference='INNOVESTRA TECH ENTERPRISES',
+        transaction_desc='Payment purchase of bingwa products',
+        base_url=os.getenv('MPESA_BASE_URL') or '',
+    )
+
+
+class MerchantRoute:
+    """A merchant's settings with its own token cache and Daraja connection pools"""
+
+    def __init__(self, merchant):
+        self.id = merchant.pk
+        self.code = merchant.code
+        self.version = merchant.updated_at
+        self.shortcode = merchant.shortcode
+        self.party_b = merchant.party_b or merchant.shortcode
+        self.transaction_type = merchant.transaction_type
+        self.passkey = merchant.passkey
+        self.callback_url = merchant.callback_url
+        self.account_reference = merchant.account_reference
+        self.transaction_desc = merchant.transaction_desc
+        self.base_url = merchant.base_url or None
+        self._credentials = (merchant.consumer_key, merchant.consumer_secret)
+
+        self.token_manager = AccessTokenManager(
+            self.request_access_token,
+            cache_alias=getattr(settings, 'MPESA_TOKEN_CACHE', 'default'),
+            cache_key=f'mpesa:oauth:token:{self.code}',
+            refresh_margin=getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 300),
+        )
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def __repr__(self):
+        return f'<MerchantRoute {self.code}>'
+
+    @property
+    def configured(self):
+        return bool(self.shortcode and self.passkey)
+
+    @property
+    def client(self):
+        """This merchant's ``DarajaClient``, created on first use"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = new_client(self.base_url)
+        return self._client
+
+    def async_client(self):
+        """This merchant's async client for the running event loop"""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = new_async_client(self.base_url, lambda: self.client)
+        return client
+
+    def request_access_token(self):
+        """Fetch a fresh access token from Daraja. Returns ``(access_token, expires_in)``"""
+        return self.client.get_access_token(*self._credentials)
+
+
+class MerchantRegistry:
+    """In-process index of the active merchants, reloaded when they change"""
+
+    version_key = 'mpesa:merchants:version'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = None
+        self._stale = False
+        self._version = None
+        self._checked_at = 0.0
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'MPESA_TOKEN_CACHE', 'default')]
+
+    def needs_reload(self):
+        if self._routes is None or self._stale:
+            return True
+        now = time.monotonic()
+        if now - self._checked_at < getattr(settings, 'MPESA_MERCHANT_RELOAD_SECONDS', 30):
+            return False
+        self._checked_at = now
+        return self.cache.get(self.version_key) != self._version
+
+    def routes(self):
+        if self.needs_reload():
+            return self.reload()
+        return self._routes
+
+    def reload(self):
+        with self._lock:
+            self._stale = False
+            version = self.cache.get(self.version_key)
+            previous = self._routes.by_code if self._routes else {}
+            by_code, default = {}, None
+            for merchant in Merchant.objects.filter(is_active=True):
+                route = previous.get(merchant.code)
+                if route is None or (route.id, route.version) != (merchant.pk, merchant.updated_at):
+                    route = MerchantRoute(merchant)
+                by_code[route.code] = route
+                if merchant.is_default:
+                    default = route
+            if default is None:
+                default = previous.get(DEFAULT_CODE)
+                if default is None or default.id is not None:
+                    default = MerchantRoute(env_merchant())
+                by_code.setdefault(DEFAULT_CODE, default)
+
+            routes = self._routes = Routes(
+                by_code=by_code,
+                by_id={route.id: route for route in by_code.values() if route.id is not None},
+                default=default,
+            )
+            self._version = version
+            self._checked_at = time.monotonic()
+        logger.info("Loaded %s merchants, default %s", len(by_code), default.code)
+        return routes
+
+    def invalidate(self):
+        """Reload this process's routes on next use and tell the other processes to reload theirs"""
+        self._stale = True
+        self.cache.set(self.version_key, uuid.uuid4().hex, timeout=None)
+
+
+registry = MerchantRegistry()
+
+
+def get_merchant(code=None):
+    """Return the route of merchant ``code``, or the default one. Raises UnknownMerchant"""
+    routes = registry.routes()
+    if not code:
+        return routes.default
+    try:
+        return routes.by_code[code]
+    except KeyError:
+        raise UnknownMerchant(f'Unknown merchant {code!r}')
+
+
+async def aget_merchant(code=None):
+    """Async version of ``get_merchant``; loads the registry off the event loop when needed"""
+    if registry.needs_reload():
+        await sync_to_async(registry.reload)()
+    return get_merchant(code)
+
+
+def merchant_for_id(merchant_id):
+    """Return the route for a transaction's ``merchant_id``; None means the default"""
+    routes = registry.routes()
+    if merchant_id is None:
+        return routes.default
+    try:
+        return routes.by_id[merchant_id]
+    except KeyError:
+        raise UnknownMerchant(f'Merchant {merchant_id} is not active')
+
+
+def merchant_for_checkout(checkout_request_id):
+    """Return the route an STK push was sent through, from its checkout id"""
+    merchant_id = (
+        MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id)
+        .values_list('merchant_id', flat=True).first()
+    )
+    return merchant_for_id(merchant_id)
+
+
+async def amerchant_for_checkout(checkout_request_id):
+    merchant_id = await (
+        MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id)
+        .values_list('merchant_id', flat=True).afirst()
+    )
+    if registry.needs_reload():
+        await sync_to_async(registry.reload)()
+    return merchant_for_id(merchant_id)
+
+
+def all_merchants():
+    return list(registry.routes().by_code.values())
+
+
+def on_merchant_changed(sender, **kwargs):
+    registry.invalidate()
@@ -0,0 +1,240 @@
+"""In-process metrics for the payment flow, in the Prometheus text format.
+
+Counters and histograms are kept per process, so each worker reports its
+own numbers; gauges and observed counters are computed when ``/metrics/`` is scraped. Recording is a dict lookup and an
+addition under a lock, cheap enough for the request path.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._label_values(labels), 0)
+
+    def collect(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, value, **labels):
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += 1
+            state[-1] += value
+
+    def count(self, **labels):
+        state = self._values.get(self._label_values(labels))
+        return state[-2] if state else 0
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self):
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        lines = self.header()
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            lines.append(f'{self.name}_bucket{labels} {state[-2]}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_count{labels} {state[-2]}')
+            lines.append(f'{self.name}_sum{labels} {_format_value(state[-1])}')
+        return lines
+
+
+class Gauge(Metric):
+    """A value computed at scrape time by ``fn``, which returns a number or a ``{labels: value}`` dict"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, fn, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def collect(self):
+        value = self.fn()
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        return self.header() + [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in values
+        ]
+
+
+class ObservedCounter(Gauge):
+    """A running total kept elsewhere and read at scrape time by ``fn``, exported as a counter so ``rate()`` works"""
+    type = 'counter'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.register(Histogram(
+    'mpesa_stage_seconds', 'Time spent in each stage of the payment flow', ['operation', 'stage'],
+))
+upstream_seconds = REGISTRY.register(Histogram(
+    'mpesa_upstream_seconds', 'Latency of Daraja API calls, per attempt', ['endpoint', 'outcome'],
+))
+result_codes = REGISTRY.register(Counter(
+    'mpesa_result_codes_total', 'Result codes seen, by source (stk_push, callback, query, local)', ['source', 'result_code'],
+))
+duplicate_callbacks = REGISTRY.register(Counter(
+    'mpesa_duplicate_callbacks_total', 'Redelivered callbacks that were ignored',
+))
+
+
+def stage(operation, name):
+    """Time a stage of ``operation``: ``with stage('process_stk_push', 'daraja'): ...``"""
+    return stage_seconds.time(operation=operation, stage=name)
+
+
+_default_gauges_registered = False
+
+
+def register_default_gauges():
+    """Register the gauges and observed counters backed by the database, the token caches, the query coalescer and the breaker"""
+    global _default_gauges_registered
+    if _default_gauges_registered:
+        return
+    _default_gauges_registered = True
+
+    from .coalesce import async_query_flight, query_flight
+    from .callbacks import inbox_stats
+    from .merchants import all_merchants
+    from .models import MpesaTransaction
+    from .outbox import outbox_stats
+    from .resilience import daraja_breaker, rate_limiter
+
+    REGISTRY.register(Gauge(
+        'mpesa_pending_transactions', 'Transactions waiting for their final status',
+        lambda: MpesaTransaction.objects.filter(status='PENDING').count(),
+    ))
+    REGISTRY.register(Gauge(
+        'mpesa_callback_inbox_depth', 'Queued callbacks not processed yet',
+        lambda: inbox_stats()['depth'],
+    ))
+    REGISTRY.register(Gauge(
+        'mpesa_stk_outbox_depth', 'Queued STK pushes not claimed by a dispatcher yet',
+        lambda: outbox_stats()['depth'],
+    ))
+    REGISTRY.register(Gauge(
+        'mpesa_callback_inbox_lag_seconds', 'Age of the oldest queued callback',
+        lambda: inbox_stats()['lag_seconds'],
+    ))
+    REGISTRY.register(Gauge(
+        'mpesa_stk_outbox_lag_seconds', 'Time the oldest due STK push has waited for a dispatcher',
+        lambda: outbox_stats()['lag_seconds'],
+    ))
+    REGISTRY.register(ObservedCounter(
+        'mpesa_token_cache_events_total', 'Access token cache activity of this process, per merchant',
+        lambda: {
+            (merchant.code, name): value
+            for merchant in all_merchants()
+            for name, value in merchant.token_manager.stats().items() if name != 'expires_in'
+        },
+        ['merchant', 'event'],
+    ))
+    REGISTRY.register(Gauge(
+        'mpesa_circuit_open', 'Whether calls to Daraja are paused (1 open, 0.5 probing, 0 closed)',
+        lambda: {'closed': 0, 'half_open': 0.5, 'open': 1}[daraja_breaker.state()['state']],
+    ))
+    REGISTRY.register(Gauge(
+        'mpesa_circuit_window_calls', 'Daraja calls in the current circuit breaker window',
+        lambda: {(outcome,): daraja_breaker.state()[outcome] for outcome in ('calls', 'failures')},
+        ['outcome'],
+    ))
+    REGISTRY.register(Gauge(
+        'mpesa_rate_limit_used', 'Daraja calls made in the current second, across workers',
+        lambda: {(endpoint,): used for endpoint, used in rate_limiter.usage().items()},
+        ['endpoint'],
+    ))
+    REGISTRY.register(ObservedCounter(
+        'mpesa_coalesced_queries_total', 'STK queries that joined an in-flight query instead of calling Daraja',
+        lambda: query_flight.shared + async_query_flight.shared,
+    ))
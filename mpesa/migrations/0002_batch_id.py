@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='batch_id',
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='status',
+            field=models.CharField(choices=[('INITIATED', 'Initiated'), ('PENDING', 'Pending'), ('SUCCESS', 'Success'), ('FAILED', 'Failed'), ('CANCELLED', 'Cancelled'), ('TIMEOUT', 'Timeout')], default='PENDING', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='mpesacallback',
+            index=models.Index(fields=['checkout_request_id'], name='mpesa_mpesa_checkou_451054_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesacallback',
+            index=models.Index(fields=['result_code'], name='mpesa_mpesa_result__211cd5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['checkout_request_id'], name='mpesa_mpesa_checkou_ad0fa5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['status'], name='mpesa_mpesa_status_b7937d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['created_at'], name='mpesa_mpesa_created_6792c5_idx'),
+        ),
+    ]
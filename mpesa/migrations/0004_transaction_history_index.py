@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0003_callbackinbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='mpesa_txn_user_history_idx'),
+        ),
+    ]
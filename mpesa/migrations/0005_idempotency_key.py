@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0004_transaction_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:01
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_callbacks(apps, schema_editor):
+    """Keep the first delivery of each (checkout_request_id, result_code)"""
+    MpesaCallback = apps.get_model('mpesa', 'MpesaCallback')
+    duplicates = (
+        MpesaCallback.objects.values('checkout_request_id', 'result_code')
+        .annotate(first_id=Min('id'), deliveries=Count('id'))
+        .filter(deliveries__gt=1)
+    )
+    for group in list(duplicates):
+        MpesaCallback.objects.filter(
+            checkout_request_id=group['checkout_request_id'], result_code=group['result_code'],
+        ).exclude(id=group['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0005_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_callbacks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='mpesacallback',
+            constraint=models.UniqueConstraint(fields=('checkout_request_id', 'result_code'), name='mpesa_callback_unique_result'),
+        ),
+    ]
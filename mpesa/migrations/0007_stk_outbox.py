@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0006_callback_unique_result'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='claim_token',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(condition=models.Q(('claim_token__isnull', True), ('status', 'INITIATED')), fields=['queued_at'], name='mpesa_txn_outbox_idx'),
+        ),
+    ]
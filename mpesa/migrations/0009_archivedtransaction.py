@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0008_transaction_rollups'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('phone_number', models.CharField(max_length=15)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('account_reference', models.CharField(max_length=100)),
+                ('transaction_desc', models.CharField(max_length=200)),
+                ('batch_id', models.UUIDField(blank=True, null=True)),
+                ('merchant_request_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('checkout_request_id', models.CharField(blank=True, db_index=True, max_length=100, null=True)),
+                ('mpesa_receipt_number', models.CharField(blank=True, db_index=True, max_length=100, null=True)),
+                ('transaction_date', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('INITIATED', 'Initiated'), ('PENDING', 'Pending'), ('SUCCESS', 'Success'), ('FAILED', 'Failed'), ('CANCELLED', 'Cancelled'), ('TIMEOUT', 'Timeout')], max_length=20)),
+                ('result_code', models.CharField(blank=True, max_length=10, null=True)),
+                ('result_desc', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(db_index=True)),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('callbacks', models.BinaryField(blank=True, null=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
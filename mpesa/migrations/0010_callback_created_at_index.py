@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0009_archivedtransaction'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesacallback',
+            index=models.Index(fields=['created_at'], name='mpesa_mpesa_created_5a35be_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:15
+
+import mpesa.models
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Reverse
+
+
+def fill_phone_reversed(apps, schema_editor):
+    """Backfill phone_reversed in chunks so no single UPDATE holds the table for long"""
+    MpesaTransaction = apps.get_model('mpesa', 'MpesaTransaction')
+    while True:
+        ids = list(
+            MpesaTransaction.objects.filter(phone_reversed='').exclude(phone_number='')
+            .values_list('id', flat=True)[:1000]
+        )
+        if not ids:
+            return
+        MpesaTransaction.objects.filter(id__in=ids).update(phone_reversed=Reverse('phone_number'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0010_callback_created_at_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='phone_reversed',
+            field=mpesa.models.ReversedCharField(blank=True, editable=False, max_length=15, source='phone_number'),
+        ),
+        migrations.RunPython(fill_phone_reversed, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['phone_number', '-created_at'], name='mpesa_txn_phone_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['phone_reversed'], name='mpesa_txn_phone_suffix_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['mpesa_receipt_number'], name='mpesa_txn_receipt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['account_reference'], name='mpesa_txn_reference_idx'),
+        ),
+    ]
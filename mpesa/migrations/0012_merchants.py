@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0011_transaction_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Merchant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.SlugField(help_text='Routing key used by the API and callback URL', unique=True)),
+                ('name', models.CharField(max_length=100)),
+                ('shortcode', models.CharField(help_text='BusinessShortCode', max_length=20)),
+                ('party_b', models.CharField(blank=True, help_text='Till or paybill receiving the funds; defaults to the shortcode', max_length=20)),
+                ('transaction_type', models.CharField(choices=[('CustomerBuyGoodsOnline', 'Buy goods (till)'), ('CustomerPayBillOnline', 'Pay bill')], default='CustomerBuyGoodsOnline', max_length=30)),
+                ('consumer_key', models.CharField(max_length=200)),
+                ('consumer_secret', models.CharField(max_length=200)),
+                ('passkey', models.CharField(max_length=200)),
+                ('callback_url', models.URLField()),
+                ('account_reference', models.CharField(blank=True, help_text='Used when a push has no reference of its own', max_length=100)),
+                ('transaction_desc', models.CharField(blank=True, max_length=200)),
+                ('base_url', models.URLField(blank=True, help_text='Daraja base URL; defaults to MPESA_BASE_URL')),
+                ('is_active', models.BooleanField(default=True)),
+                ('is_default', models.BooleanField(default=False, help_text='Used for requests that name no merchant')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['code'],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('is_default', True)), fields=('is_default',), name='mpesa_merchant_single_default')],
+            },
+        ),
+        migrations.AddField(
+            model_name='archivedtransaction',
+            name='merchant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='mpesa.merchant'),
+        ),
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='merchant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='transactions', to='mpesa.merchant'),
+        ),
+    ]
@@ -0,0 +1,166 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:25
+
+import json
+import zlib
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def _metadata(callback_data):
+    """A frozen copy of callbacks.parse_callback_metadata"""
+    stk_callback = (callback_data or {}).get('Body', {}).get('stkCallback', {})
+    metadata = {}
+    for item in (stk_callback.get('CallbackMetadata') or {}).get('Item', []):
+        name, value = item.get('Name'), item.get('Value')
+        if value is None or value == '':
+            continue
+        try:
+            if name in ('Amount', 'Balance'):
+                metadata['amount' if name == 'Amount' else 'balance'] = Decimal(str(value))
+            elif name == 'MpesaReceiptNumber':
+                metadata['mpesa_receipt_number'] = str(value)
+            elif name == 'TransactionDate':
+                metadata['transaction_date'] = timezone.make_aware(datetime.strptime(str(value), '%Y%m%d%H%M%S'))
+            elif name == 'PhoneNumber':
+                phone = str(value).lstrip('+')
+                metadata['phone_number'] = '254' + phone[1:] if phone.startswith('0') else phone
+        except (InvalidOperation, ValueError):
+            continue
+    return metadata
+
+
+def split_callback_data(apps, schema_editor):
+    """Compress callback_data into payload and copy its metadata to columns, in chunks"""
+    MpesaCallback = apps.get_model('mpesa', 'MpesaCallback')
+    MpesaTransaction = apps.get_model('mpesa', 'MpesaTransaction')
+    last_id = 0
+    while True:
+        callbacks = list(
+            MpesaCallback.objects.filter(id__gt=last_id).order_by('id')
+            .only('id', 'transaction_id', 'result_code', 'callback_data')[:1000]
+        )
+        if not callbacks:
+            return
+        last_id = callbacks[-1].id
+        paid = {}
+        for callback in callbacks:
+            metadata = _metadata(callback.callback_data)
+            callback.payload = zlib.compress(json.dumps(callback.callback_data, separators=(',', ':')).encode('utf-8'))
+            callback.amount = metadata.get('amount')
+            callback.phone_number = metadata.get('phone_number', '')
+            callback.mpesa_receipt_number = metadata.get('mpesa_receipt_number')
+            callback.transaction_date = metadata.get('transaction_date')
+            callback.balance = metadata.get('balance')
+            if callback.result_code == '0':
+                paid[callback.transaction_id] = MpesaTransaction(
+                    id=callback.transaction_id,
+                    paid_amount=metadata.get('amount'),
+                    paid_phone_number=metadata.get('phone_number', ''),
+                )
+        MpesaCallback.objects.bulk_update(callbacks, [
+            'payload', 'amount', 'phone_number', 'mpesa_receipt_number', 'transaction_date', 'balance',
+        ])
+        MpesaTransaction.objects.bulk_update(list(paid.values()), ['paid_amount', 'paid_phone_number'])
+
+
+def join_callback_data(apps, schema_editor):
+    """Restore callback_data from payload; bodies stored as files are not read back"""
+    MpesaCallback = apps.get_model('mpesa', 'MpesaCallback')
+    last_id = 0
+    while True:
+        callbacks = list(
+            MpesaCallback.objects.filter(id__gt=last_id).order_by('id').only('id', 'payload')[:1000]
+        )
+        if not callbacks:
+            return
+        last_id = callbacks[-1].id
+        for callback in callbacks:
+            callback.callback_data = json.loads(zlib.decompress(bytes(callback.payload))) if callback.payload else {}
+        MpesaCallback.objects.bulk_update(callbacks, ['callback_data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0012_merchants'),
+    ]
+
+    operations = [
+        # Nullable while it is moved, so the migration can be reversed
+        migrations.AlterField(
+            model_name='mpesacallback',
+            name='callback_data',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedtransaction',
+            name='paid_amount',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedtransaction',
+            name='paid_phone_number',
+            field=models.CharField(blank=True, max_length=15),
+        ),
+        migrations.AddField(
+            model_name='mpesacallback',
+            name='amount',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='mpesacallback',
+            name='balance',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=14, null=True),
+        ),
+        migrations.AddField(
+            model_name='mpesacallback',
+            name='mpesa_receipt_number',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='mpesacallback',
+            name='payload',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mpesacallback',
+            name='payload_path',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='mpesacallback',
+            name='phone_number',
+            field=models.CharField(blank=True, max_length=15),
+        ),
+        migrations.AddField(
+            model_name='mpesacallback',
+            name='transaction_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='paid_amount',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='mpesatransaction',
+            name='paid_phone_number',
+            field=models.CharField(blank=True, max_length=15),
+        ),
+        migrations.RunPython(split_callback_data, join_callback_data),
+        migrations.RemoveField(
+            model_name='mpesacallback',
+            name='callback_data',
+        ),
+        migrations.AddIndex(
+            model_name='mpesacallback',
+            index=models.Index(fields=['mpesa_receipt_number'], name='mpesa_callback_receipt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesacallback',
+            index=models.Index(fields=['phone_number', 'created_at'], name='mpesa_callback_phone_idx'),
+        ),
+    ]
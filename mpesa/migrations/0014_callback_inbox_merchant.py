@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0013_structured_callbacks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callbackinbox',
+            name='merchant_code',
+            field=models.SlugField(blank=True),
+        ),
+    ]
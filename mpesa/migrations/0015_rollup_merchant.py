@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+
+# Existing rollups land under the blank merchant; run rebuild_rollups to split them
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mpesa', '0014_callback_inbox_merchant'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='transactionrollup',
+            name='mpesa_rollup_unique_key',
+        ),
+        migrations.AddField(
+            model_name='transactionrollup',
+            name='merchant_code',
+            field=models.SlugField(blank=True),
+        ),
+        migrations.AddConstraint(
+            model_name='transactionrollup',
+            constraint=models.UniqueConstraint(fields=('period', 'period_start', 'status', 'merchant_code', 'account_reference'), name='mpesa_rollup_merchant_key'),
+        ),
+    ]
@@ -1,7 +1,67 @@
 # models.py - FIXED VERSION
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+import json
 import uuid
+import zlib
+
+from . import payloads
+
+class ReversedCharField(models.CharField):
+    """Holds ``source`` reversed, kept in sync on save and bulk_create
+
+    Suffix searches ("last 4 digits") become prefix range scans on its index.
+    """
+
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = (getattr(model_instance, self.source) or '')[::-1]
+        setattr(model_instance, self.attname, value)
+        return value
+
+class Merchant(models.Model):
+    """A till or paybill with its own Daraja app credentials, see merchants.py"""
+    TRANSACTION_TYPE_CHOICES = [
+        ('CustomerBuyGoodsOnline', 'Buy goods (till)'),
+        ('CustomerPayBillOnline', 'Pay bill'),
+    ]
+
+    code = models.SlugField(max_length=50, unique=True, help_text='Routing key used by the API and callback URL')
+    name = models.CharField(max_length=100)
+    shortcode = models.CharField(max_length=20, help_text='BusinessShortCode')
+    party_b = models.CharField(max_length=20, blank=True, help_text='Till or paybill receiving the funds; defaults to the shortcode')
+    transaction_type = models.CharField(max_length=30, choices=TRANSACTION_TYPE_CHOICES, default='CustomerBuyGoodsOnline')
+    consumer_key = models.CharField(max_length=200)
+    consumer_secret = models.CharField(max_length=200)
+    passkey = models.CharField(max_length=200)
+    callback_url = models.URLField()
+    account_reference = models.CharField(max_length=100, blank=True, help_text='Used when a push has no reference of its own')
+    transaction_desc = models.CharField(max_length=200, blank=True)
+    base_url = models.URLField(blank=True, help_text='Daraja base URL; defaults to MPESA_BASE_URL')
+    is_active = models.BooleanField(default=True)
+    is_default = models.BooleanField(default=False, help_text='Used for requests that name no merchant')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['code']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['is_default'], condition=models.Q(is_default=True), name='mpesa_merchant_single_default',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.shortcode})"
 
 class MpesaTransaction(models.Model):
     STATUS_CHOICES = [
@@ -12,19 +72,37 @@ class MpesaTransaction(models.Model):
         ('CANCELLED', 'Cancelled'),  # Added
         ('TIMEOUT', 'Timeout'),      # Added
     ]
+    # Statuses that never change again
+    TERMINAL_STATUSES = ('SUCCESS', 'FAILED', 'CANCELLED', 'TIMEOUT')
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    # Null for the default merchant configured from the environment
+    merchant = models.ForeignKey(Merchant, on_delete=models.PROTECT, null=True, blank=True, related_name='transactions')
     phone_number = models.CharField(max_length=15)
+    # For suffix searches, see search.py
+    phone_reversed = ReversedCharField(max_length=15, source='phone_number', blank=True, editable=False)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     account_reference = models.CharField(max_length=100)
     transaction_desc = models.CharField(max_length=200)
+    batch_id = models.UUIDField(blank=True, null=True, db_index=True)
+    # Client-supplied key scoped by user, see idempotency.py
+    idempotency_key = models.CharField(max_length=255, blank=True, null=True, unique=True, editable=False)
+    # Queued STK push dispatch, see outbox.py
+    queued_at = models.DateTimeField(blank=True, null=True, editable=False)
+    claimed_at = models.DateTimeField(blank=True, null=True, editable=False)
+    claim_token = models.UUIDField(blank=True, null=True, editable=False)
+    # Set once the final status is counted in TransactionRollup, see rollups.py
+    rolled_up_at = models.DateTimeField(blank=True, null=True, editable=False)
     
     # M-Pesa specific fields
     merchant_request_id = models.CharField(max_length=100, blank=True, null=True)
     checkout_request_id = models.CharField(max_length=100, blank=True, null=True)
     mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True)
     transaction_date = models.DateTimeField(blank=True, null=True)
+    # What the callback says was paid, and by whom
+    paid_amount = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    paid_phone_number = models.CharField(max_length=15, blank=True)
     
     # Status tracking
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
@@ -41,19 +119,46 @@ class MpesaTransaction(models.Model):
             models.Index(fields=['checkout_request_id']),
             models.Index(fields=['status']),
             models.Index(fields=['created_at']),
+            # Keyset pagination of a user's history, see pagination.py
+            models.Index(fields=['user', '-created_at', '-id'], name='mpesa_txn_user_history_idx'),
+            # Support searches, see search.py
+            models.Index(fields=['phone_number', '-created_at'], name='mpesa_txn_phone_idx'),
+            models.Index(fields=['phone_reversed'], name='mpesa_txn_phone_suffix_idx'),
+            models.Index(fields=['mpesa_receipt_number'], name='mpesa_txn_receipt_idx'),
+            models.Index(fields=['account_reference'], name='mpesa_txn_reference_idx'),
+            # Unclaimed rows waiting for dispatch_stk_pushes
+            models.Index(
+                fields=['queued_at'],
+                condition=models.Q(status='INITIATED', claim_token__isnull=True),
+                name='mpesa_txn_outbox_idx',
+            ),
+            # Rows not counted in the rollups yet
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(rolled_up_at__isnull=True),
+                name='mpesa_txn_rollup_pending_idx',
+            ),
         ]
     
     def __str__(self):
         return f"{self.mpesa_receipt_number or 'N/A'} - {self.phone_number} - {self.amount}"
 
 class MpesaCallback(models.Model):
-    """Store raw callback data from M-Pesa"""
+    """A callback from M-Pesa: its metadata in columns, the raw body compressed"""
     transaction = models.ForeignKey(MpesaTransaction, on_delete=models.CASCADE, related_name='callbacks')
     merchant_request_id = models.CharField(max_length=100)
     checkout_request_id = models.CharField(max_length=100)
     result_code = models.CharField(max_length=10)
     result_desc = models.TextField()
-    callback_data = models.JSONField()  # Store the full callback JSON
+    # CallbackMetadata items, set on successful payments
+    amount = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    phone_number = models.CharField(max_length=15, blank=True)
+    mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True)
+    transaction_date = models.DateTimeField(blank=True, null=True)
+    balance = models.DecimalField(max_digits=14, decimal_places=2, blank=True, null=True)
+    # Raw body, see payloads.py; read and write it through callback_data
+    payload = models.BinaryField(blank=True, null=True)
+    payload_path = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -61,7 +166,128 @@ class MpesaCallback(models.Model):
         indexes = [
             models.Index(fields=['checkout_request_id']),
             models.Index(fields=['result_code']),
+            models.Index(fields=['created_at']),
+            models.Index(fields=['mpesa_receipt_number'], name='mpesa_callback_receipt_idx'),
+            models.Index(fields=['phone_number', 'created_at'], name='mpesa_callback_phone_idx'),
+        ]
+        constraints = [
+            # Safaricom redelivers callbacks; keep one row per outcome
+            models.UniqueConstraint(
+                fields=['checkout_request_id', 'result_code'], name='mpesa_callback_unique_result',
+            ),
         ]
     
     def __str__(self):
-        return f"Callback for {self.transaction.id} - Code: {self.result_code}"
\ No newline at end of file
+        return f"Callback for {self.transaction_id} - Code: {self.result_code}"
+
+    @property
+    def callback_data(self):
+        """The callback body as received"""
+        return payloads.load(self.payload, self.payload_path)
+
+    @callback_data.setter
+    def callback_data(self, data):
+        self.payload, self.payload_path = payloads.store(data)
+
+class CallbackInbox(models.Model):
+    """Raw callbacks queued for background processing"""
+    body = models.TextField()
+    # Code of the merchant whose callback URL received it, blank for plain /callback/
+    merchant_code = models.SlugField(max_length=50, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(
+                fields=['available_at'],
+                condition=models.Q(processed_at__isnull=True),
+                name='mpesa_inbox_pending_idx',
+            ),
+        ]
+        verbose_name_plural = 'callback inbox'
+
+    def __str__(self):
+        return f"Inbox #{self.pk} - {'processed' if self.processed_at else 'pending'}"
+
+class TransactionRollup(models.Model):
+    """Count and amount of settled transactions per period, status, merchant and account reference"""
+    PERIOD_CHOICES = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    ]
+
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    period_start = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=MpesaTransaction.STATUS_CHOICES)
+    # Code of the transactions' merchant, blank for those without one
+    merchant_code = models.SlugField(max_length=50, blank=True)
+    account_reference = models.CharField(max_length=100, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['period', 'period_start']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['period', 'period_start', 'status', 'merchant_code', 'account_reference'],
+                name='mpesa_rollup_merchant_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.period_start:%Y-%m-%d %H:%M} {self.status} - {self.count}"
+
+
+class ArchivedTransaction(models.Model):
+    """A settled transaction moved out of MpesaTransaction by archive_transactions
+
+    Its callbacks are kept as one zlib-compressed JSON list, see archive.py.
+    """
+    id = models.UUIDField(primary_key=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    merchant = models.ForeignKey(Merchant, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    phone_number = models.CharField(max_length=15)
+    # For suffix searches, see search.py
+    phone_reversed = ReversedCharField(max_length=15, source='phone_number', blank=True, editable=False)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    account_reference = models.CharField(max_length=100)
+    transaction_desc = models.CharField(max_length=200)
+    batch_id = models.UUIDField(blank=True, null=True)
+    merchant_request_id = models.CharField(max_length=100, blank=True, null=True)
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+    mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+    transaction_date = models.DateTimeField(blank=True, null=True)
+    paid_amount = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    paid_phone_number = models.CharField(max_length=15, blank=True)
+    status = models.CharField(max_length=20, choices=MpesaTransaction.STATUS_CHOICES)
+    result_code = models.CharField(max_length=10, blank=True, null=True)
+    result_desc = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(db_index=True)
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    callbacks = models.BinaryField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # Support searches, see search.py
+            models.Index(fields=['phone_number', '-created_at'], name='mpesa_archive_phone_idx'),
+            models.Index(fields=['phone_reversed'], name='mpesa_archive_phone_suffix_idx'),
+            models.Index(fields=['account_reference'], name='mpesa_archive_reference_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.mpesa_receipt_number or 'N/A'} - {self.phone_number} - {self.amount} (archived)"
+
+    @property
+    def callback_records(self):
+        """The archived callbacks as a list of dicts"""
+        if not self.callbacks:
+            return []
+        return json.loads(zlib.decompress(bytes(self.callbacks)))
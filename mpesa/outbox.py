@@ -0,0 +1,142 @@
+"""Queued STK push dispatch.
+
+With ``MPESA_STK_DISPATCH = 'queued'`` the STK push views only insert the
+``MpesaTransaction`` as INITIATED, stamped with ``queued_at``, and return
+its id; the customer's request never waits on Safaricom. One or more
+``manage.py dispatch_stk_pushes`` processes then claim queued rows in
+batches, send them through a bounded thread pool and write the outcomes
+back with ``bulk_update``, so upstream throughput scales with the number
+of dispatchers rather than web workers.
+
+Rows are claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the
+database supports it, and in every case by a conditional UPDATE that sets
+a ``claim_token`` only on unclaimed rows, so two dispatchers never send
+the same push. A dispatcher that dies after claiming leaves its rows
+INITIATED; once the claim is older than ``MPESA_DISPATCH_CLAIM_TIMEOUT``
+they are failed rather than sent again, since Safaricom may already have
+prompted the customer.
+
+Pushes refused by the rate limiter or circuit breaker never reached
+Safaricom, so they are not failed: their claim is released and
+``queued_at`` pushed back by the ``retry_after`` of the refusal, and a
+later batch sends them.
+"""
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction as db_transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from . import metrics
+from .batch import UPDATE_FIELDS, apply_send_result, resolve_merchants, send_stk_push
+from .idempotency import begin_stk_push
+from .models import MpesaTransaction
+from .signals import send_transaction_updated
+from .utils import queued_result
+
+logger = logging.getLogger(__name__)
+
+
+def dispatch_mode():
+    return getattr(settings, 'MPESA_STK_DISPATCH', 'inline')
+
+
+def enqueue_stk_push(phone_number, amount, user=None, idempotency_key=None, merchant=None):
+    """Create a queued STK push and return the ``process_stk_push``-style result"""
+    with metrics.stage('enqueue_stk_push', 'db_insert'):
+        transaction, replay = begin_stk_push(
+            phone_number, amount, user, idempotency_key, queue=True, merchant=merchant)
+    if replay is not None:
+        return replay
+    logger.info("STK push queued transaction_id=%s", transaction.id)
+    return queued_result(transaction)
+
+
+def claim_batch(batch_size=50):
+    """Claim up to ``batch_size`` queued transactions for this dispatcher"""
+    token = uuid.uuid4()
+    with db_transaction.atomic():
+        queued = MpesaTransaction.objects.filter(
+            status='INITIATED', queued_at__lte=timezone.now(), claim_token__isnull=True,
+        ).order_by('queued_at')
+        if connection.features.has_select_for_update_skip_locked:
+            queued = queued.select_for_update(skip_locked=True)
+        ids = list(queued.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        # Also guards databases without SKIP LOCKED: only unclaimed rows are taken
+        MpesaTransaction.objects.filter(id__in=ids, claim_token__isnull=True).update(
+            claim_token=token, claimed_at=timezone.now(),
+        )
+    return list(MpesaTransaction.objects.filter(claim_token=token, status='INITIATED'))
+
+
+def fail_stale_claims(timeout=None):
+    """Fail claimed transactions whose dispatcher didn't finish within ``timeout`` seconds"""
+    if timeout is None:
+        timeout = getattr(settings, 'MPESA_DISPATCH_CLAIM_TIMEOUT', 300)
+    stale = MpesaTransaction.objects.filter(
+        status='INITIATED', claim_token__isnull=False,
+        claimed_at__lt=timezone.now() - timedelta(seconds=timeout),
+    )
+    ids = list(stale.values_list('id', flat=True))
+    if not ids:
+        return 0
+    count = MpesaTransaction.objects.filter(id__in=ids, status='INITIATED').update(
+        status='FAILED',
+        result_code='Unknown',
+        result_desc='Dispatch interrupted; the STK push may not have been sent',
+        updated_at=timezone.now(),
+    )
+    logger.warning("Failed %s STK pushes whose dispatcher stopped", count)
+    send_transaction_updated(*ids)
+    return count
+
+
+def dispatch_batch(batch_size=None, max_workers=None):
+    """Claim and send one batch of queued STK pushes. Returns the number sent"""
+    batch_size = batch_size or getattr(settings, 'MPESA_DISPATCH_BATCH_SIZE', 50)
+    max_workers = max_workers or getattr(settings, 'MPESA_DISPATCH_WORKERS', 8)
+
+    with metrics.stage('dispatch_stk_push', 'claim'):
+        transactions = claim_batch(batch_size)
+    if not transactions:
+        return 0
+
+    routes = resolve_merchants(transactions)
+    with metrics.stage('dispatch_stk_push', 'daraja'):
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(transactions))) as pool:
+            outcomes = list(pool.map(lambda t: send_stk_push(t, routes[t.merchant_id]), transactions))
+    sent, deferred = [], []
+    for transaction, outcome in zip(transactions, outcomes):
+        apply_send_result(transaction, *outcome)
+        if transaction.status == 'INITIATED':
+            # Refused by the rate limiter or circuit breaker, see apply_requeue
+            deferred.append(transaction)
+            continue
+        metrics.result_codes.inc(source='stk_push', result_code=transaction.result_code)
+        sent.append(transaction)
+
+    with metrics.stage('dispatch_stk_push', 'db_update'):
+        MpesaTransaction.objects.bulk_update(transactions, UPDATE_FIELDS)
+    if deferred:
+        logger.warning("Requeued %s STK pushes refused before reaching Daraja", len(deferred))
+    send_transaction_updated(*(t.id for t in sent))
+    return len(sent)
+
+
+def outbox_stats():
+    """Return the number of queued STK pushes and how long the oldest has waited"""
+    summary = MpesaTransaction.objects.filter(
+        status='INITIATED', queued_at__isnull=False, claim_token__isnull=True,
+    ).aggregate(depth=Count('id'), oldest=Min('queued_at'))
+    oldest = summary['oldest']
+    return {
+        'depth': summary['depth'],
+        # Requeued pushes can be scheduled in the future
+        'lag_seconds': max((timezone.now() - oldest).total_seconds(), 0.0) if oldest else 0.0,
+    }
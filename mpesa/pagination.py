@@ -0,0 +1,102 @@
+"""Keyset (cursor) pagination over ``(created_at, id)``, newest first.
+
+Unlike OFFSET pagination every page costs the same: the cursor is the
+position of the last row served, and the next page is an index range scan
+starting right after it. ``cursor_page`` serves one page of such a
+query as ``{"transactions": [...], "next_cursor": ...}``.
+
+``EstimatedCountPaginator`` is for the admin, where page numbers are
+needed but an exact ``COUNT(*)`` of a large table is not.
+"""
+import base64
+import json
+import uuid
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+
+class InvalidPage(ValueError):
+    pass
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+def encode_cursor(created_at, pk):
+    raw = f'{created_at.isoformat()}|{pk}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return ``(created_at, pk)`` from a cursor produced by ``encode_cursor``"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, pk = raw.split('|', 1)
+        created_at = parse_datetime(created_at)
+        pk = uuid.UUID(pk)
+    except (ValueError, UnicodeError):
+        raise InvalidCursor('Invalid cursor')
+    if created_at is None:
+        raise InvalidCursor('Invalid cursor')
+    return created_at, pk
+
+
+def after_cursor(queryset, cursor):
+    """Order newest first and skip everything up to and including the cursor row"""
+    queryset = queryset.order_by('-created_at', '-id')
+    if not cursor:
+        return queryset
+    created_at, pk = decode_cursor(cursor)
+    return queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+
+def cursor_page(rows, limit=50, serialize=dict):
+    """Return the first page of ``.values()`` rows from ``after_cursor``, with the cursor of the next
+
+    ``limit`` is the requested page size, capped by
+    ``MPESA_HISTORY_MAX_PAGE_SIZE``. Raises ``InvalidPage`` for a bad limit.
+    """
+    max_limit = getattr(settings, 'MPESA_HISTORY_MAX_PAGE_SIZE', 500)
+    try:
+        limit = min(max(int(limit), 1), max_limit)
+    except ValueError:
+        raise InvalidPage('Invalid limit')
+
+    # Fetch one extra row to know whether there is a next page
+    rows = list(rows[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    return {
+        'transactions': [serialize(row) for row in rows],
+        'next_cursor': next_cursor,
+    }
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that stops counting after ``MPESA_ADMIN_COUNT_LIMIT`` rows
+
+    Counts up to the limit exactly with a bounded ``COUNT(*)`` over a
+    ``LIMIT`` subquery. Past it, PostgreSQL's planner estimate for the
+    query is used, and elsewhere the count is reported as the limit.
+    """
+
+    @cached_property
+    def count(self):
+        limit = getattr(settings, 'MPESA_ADMIN_COUNT_LIMIT', 10000)
+        queryset = self.object_list.order_by()
+        exact = queryset[:limit + 1].count()
+        if exact <= limit:
+            return exact
+        if connections[queryset.db].vendor == 'postgresql':
+            plan = json.loads(queryset.explain(format='json'))
+            plan = plan[0] if isinstance(plan, list) else plan
+            return max(int(plan['Plan']['Plan Rows']), limit)
+        return limit
@@ -0,0 +1,62 @@
+"""Compressed storage of raw callback bodies.
+
+``MpesaCallback`` keeps the fields worth querying in typed columns and the
+raw body only for audits, compressed so the table stays narrow. With
+``MPESA_CALLBACK_PAYLOAD_STORAGE = 'db'`` (the default) the body is stored
+as zlib-compressed JSON in ``payload``. With ``'file'`` it is written as a
+gzipped JSON file under ``MPESA_CALLBACK_PAYLOAD_DIR``, named by its
+SHA-256 so redeliveries share a file, and the row keeps only its relative
+path in ``payload_path``.
+"""
+import gzip
+import hashlib
+import json
+import os
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+def _payload_dir():
+    return str(getattr(settings, 'MPESA_CALLBACK_PAYLOAD_DIR', os.path.join(settings.BASE_DIR, 'callback_payloads')))
+
+
+def store(data):
+    """Encode a callback body. Returns ``(payload, payload_path)`` for the model fields"""
+    if data is None:
+        return None, ''
+    raw = json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')).encode('utf-8')
+    if getattr(settings, 'MPESA_CALLBACK_PAYLOAD_STORAGE', 'db') != 'file':
+        return zlib.compress(raw), ''
+
+    digest = hashlib.sha256(raw).hexdigest()
+    path = os.path.join(digest[:2], f'{digest}.json.gz')
+    full_path = os.path.join(_payload_dir(), path)
+    if not os.path.exists(full_path):
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # Write then rename, so readers never see a partial file
+        partial = f'{full_path}.{os.getpid()}.tmp'
+        with gzip.open(partial, 'wb') as f:
+            f.write(raw)
+        os.replace(partial, full_path)
+    return None, path
+
+
+def load(payload, payload_path):
+    """Decode a callback body stored by ``store``; None if there is none"""
+    if payload_path:
+        with gzip.open(os.path.join(_payload_dir(), payload_path), 'rb') as f:
+            return json.loads(f.read())
+    if payload:
+        return json.loads(zlib.decompress(bytes(payload)))
+    return None
+
+
+def delete(paths):
+    """Remove payload files no longer referenced by any callback"""
+    for path in paths:
+        try:
+            os.remove(os.path.join(_payload_dir(), path))
+        except FileNotFoundError:
+            pass
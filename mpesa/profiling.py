@@ -0,0 +1,203 @@
+"""Opt-in per-view profiling of database and Daraja time.
+
+``ProfilingMiddleware`` is listed in ``MIDDLEWARE`` but removes itself at
+startup unless ``MPESA_PROFILING`` is set, so it costs nothing when off.
+When on, every request to the ``mpesa`` views records its wall time, the
+number and duration of SQL queries and of Daraja calls, aggregated per view
+in process memory. Queries are counted by a ``connection.execute_wrapper``
+and Daraja calls by ``DarajaClient``; both find the current request through
+a context variable, so work done in ``sync_to_async`` threads is included.
+
+A fraction ``MPESA_PROFILE_SAMPLE_RATE`` of sync requests also run under
+``cProfile``, one at a time per process; those slower than
+``MPESA_PROFILE_SLOW_SECONDS`` keep their top functions, the last
+``MPESA_PROFILE_KEEP`` of them. The summaries are per process and are served
+to staff at ``/reports/profile/``.
+"""
+import cProfile
+import contextvars
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('mpesa_request_profile', default=None)
+
+
+class RequestProfile:
+    __slots__ = ('queries', 'query_seconds', 'http_calls', 'http_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.http_calls = 0
+        self.http_seconds = 0.0
+
+
+def record_upstream(seconds):
+    """Count a Daraja call against the request being profiled, if any"""
+    profile = _current.get()
+    if profile is not None:
+        profile.http_calls += 1
+        profile.http_seconds += seconds
+
+
+def _count_query(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.queries += 1
+        profile.query_seconds += time.perf_counter() - started
+
+
+def _install_query_counter(sender=None, connection=None, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class ProfileStats:
+    """Per-view totals and the most recent slow request profiles"""
+
+    FIELDS = ('requests', 'seconds', 'max_seconds', 'queries', 'query_seconds', 'http_calls', 'http_seconds')
+
+    def __init__(self, keep=20):
+        self._lock = threading.Lock()
+        self._views = {}
+        self.slow = deque(maxlen=keep)
+
+    def record(self, view, seconds, profile):
+        with self._lock:
+            totals = self._views.get(view)
+            if totals is None:
+                totals = self._views[view] = dict.fromkeys(self.FIELDS, 0)
+            totals['requests'] += 1
+            totals['seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            totals['queries'] += profile.queries
+            totals['query_seconds'] += profile.query_seconds
+            totals['http_calls'] += profile.http_calls
+            totals['http_seconds'] += profile.http_seconds
+
+    def add_slow(self, view, path, seconds, profile, text):
+        with self._lock:
+            self.slow.append({
+                'view': view,
+                'path': path,
+                'at': timezone.now().isoformat(),
+                'seconds': round(seconds, 4),
+                'queries': profile.queries,
+                'http_calls': profile.http_calls,
+                'profile': text,
+            })
+
+    def summary(self):
+        """Return per-view averages, slowest total time first"""
+        with self._lock:
+            views = {view: dict(totals) for view, totals in self._views.items()}
+        rows = []
+        for view, totals in sorted(views.items(), key=lambda item: -item[1]['seconds']):
+            count = totals['requests']
+            rows.append({
+                'view': view,
+                'requests': count,
+                'avg_seconds': round(totals['seconds'] / count, 4),
+                'max_seconds': round(totals['max_seconds'], 4),
+                'avg_queries': round(totals['queries'] / count, 2),
+                'avg_query_seconds': round(totals['query_seconds'] / count, 4),
+                'avg_http_calls': round(totals['http_calls'] / count, 2),
+                'avg_http_seconds': round(totals['http_seconds'] / count, 4),
+            })
+        return rows
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+            self.slow.clear()
+
+
+stats = ProfileStats(keep=getattr(settings, 'MPESA_PROFILE_KEEP', 20))
+
+# cProfile can't nest, so only one request per process is sampled at a time
+_sampling = threading.Lock()
+
+
+def _format_profile(profiler, limit=30):
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+class ProfilingMiddleware:
+    """Record query and Daraja time per ``mpesa`` view, see the module docstring"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'MPESA_PROFILING', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'MPESA_PROFILE_SAMPLE_RATE', 0.0)
+        self.slow_seconds = getattr(settings, 'MPESA_PROFILE_SLOW_SECONDS', 1.0)
+        connection_created.connect(_install_query_counter, dispatch_uid='mpesa.profiling')
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _start(self):
+        # Connections opened before the middleware loaded missed connection_created
+        for connection in connections.all(initialized_only=True):
+            _install_query_counter(connection=connection)
+        profile = RequestProfile()
+        return profile, _current.set(profile), time.perf_counter()
+
+    def _finish(self, request, profile, token, started, profiler=None):
+        seconds = time.perf_counter() - started
+        _current.reset(token)
+        match = getattr(request, 'resolver_match', None)
+        if match is None or 'mpesa' not in match.app_names:
+            return
+        stats.record(match.view_name, seconds, profile)
+        if profiler is not None and seconds >= self.slow_seconds:
+            stats.add_slow(match.view_name, request.path, seconds, profile, _format_profile(profiler))
+            logger.info("Slow request %s took %.3fs with %s queries", request.path, seconds, profile.queries)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profile, token, started = self._start()
+        profiler = None
+        if self.sample_rate and random.random() < self.sample_rate and _sampling.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        try:
+            if profiler is None:
+                return self.get_response(request)
+            try:
+                return profiler.runcall(self.get_response, request)
+            finally:
+                _sampling.release()
+        finally:
+            self._finish(request, profile, token, started, profiler)
+
+    async def __acall__(self, request):
+        # cProfile would mix in every coroutine sharing the event loop, so async requests aren't sampled
+        profile, token, started = self._start()
+        try:
+            return await self.get_response(request)
+        finally:
+            self._finish(request, profile, token, started)
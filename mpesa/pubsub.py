@@ -0,0 +1,107 @@
+"""Lightweight pub/sub for transaction status changes.
+
+Every change bumps a per-transaction version counter in the Django cache
+and wakes waiters in this process. Waiters in other processes see the new
+version on their next cache poll, so a shared cache (``REDIS_URL``) is
+enough to fan updates out across workers.
+
+``wait_for_update`` blocks a thread; ``await_update`` is its asyncio
+counterpart for the async views, woken from ``publish`` through the
+waiter's event loop.
+"""
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+_condition = threading.Condition()
+_async_waiters = set()
+_async_waiters_lock = threading.Lock()
+
+
+def _cache():
+    return caches[getattr(settings, 'MPESA_PUBSUB_CACHE', 'default')]
+
+
+def _version_key(transaction_id):
+    return f'mpesa:txn-version:{transaction_id}'
+
+
+def current_version(transaction_id):
+    """Return the change counter of a transaction (0 if it never changed)"""
+    return _cache().get(_version_key(transaction_id), 0)
+
+
+async def acurrent_version(transaction_id):
+    return await _cache().aget(_version_key(transaction_id), 0)
+
+
+def publish(transaction_id):
+    """Record a change to a transaction and wake anyone waiting on it"""
+    cache = _cache()
+    key = _version_key(transaction_id)
+    cache.add(key, 0, timeout=getattr(settings, 'MPESA_PUBSUB_VERSION_TTL', 3600))
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key expired between add() and incr()
+        cache.set(key, 1, timeout=getattr(settings, 'MPESA_PUBSUB_VERSION_TTL', 3600))
+    with _condition:
+        _condition.notify_all()
+    with _async_waiters_lock:
+        waiters = list(_async_waiters)
+    for loop, event in waiters:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass  # The loop was closed
+
+
+def wait_for_update(transaction_id, version, timeout, poll_interval=None):
+    """Block until the transaction's version differs from ``version`` or ``timeout`` passes
+
+    Returns the current version.
+    """
+    if poll_interval is None:
+        poll_interval = getattr(settings, 'MPESA_PUBSUB_POLL_INTERVAL', 1.0)
+    deadline = time.monotonic() + timeout
+    while True:
+        current = current_version(transaction_id)
+        remaining = deadline - time.monotonic()
+        if current != version or remaining <= 0:
+            return current
+        with _condition:
+            _condition.wait(min(poll_interval, remaining))
+
+
+async def await_update(transaction_id, version, timeout, poll_interval=None):
+    """Async version of ``wait_for_update``"""
+    if poll_interval is None:
+        poll_interval = getattr(settings, 'MPESA_PUBSUB_POLL_INTERVAL', 1.0)
+    loop = asyncio.get_running_loop()
+    waiter = (loop, asyncio.Event())
+    with _async_waiters_lock:
+        _async_waiters.add(waiter)
+    try:
+        deadline = loop.time() + timeout
+        while True:
+            # Cleared before reading, so a publish in between still wakes us
+            waiter[1].clear()
+            current = await acurrent_version(transaction_id)
+            remaining = deadline - loop.time()
+            if current != version or remaining <= 0:
+                return current
+            try:
+                await asyncio.wait_for(waiter[1].wait(), min(poll_interval, remaining))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        with _async_waiters_lock:
+            _async_waiters.discard(waiter)
+
+
+def on_transaction_updated(sender, transaction_ids, **kwargs):
+    for transaction_id in transaction_ids:
+        publish(transaction_id)
@@ -0,0 +1,293 @@
+"""Reconciliation of M-Pesa statements against local transactions.
+
+The statement CSV is streamed once and split into one spill file per day,
+so memory is bounded by the busiest day rather than the whole statement.
+Days are then reconciled in order. For each day the local transactions
+are loaded in a single ``values_list`` pass and matched through two hash
+indexes: first on receipt number, then on ``(phone, amount)``, taking the
+closest local row within ``MPESA_RECONCILE_TIME_WINDOW`` seconds. Rows
+near midnight that are still unmatched carry over to the next day.
+
+The outcome of each row is one of:
+
+``missing``
+    Paid on the statement with no local transaction.
+``extra``
+    SUCCESS locally but not on the statement.
+``mismatched``
+    Matched, but the amount, status or receipt number differs.
+``unsettled``
+    Matched by phone, amount and time, but not SUCCESS locally.
+
+With ``apply``, rows paid on the statement are settled locally with
+``bulk_update`` (amount differences are only reported) and the rollups of
+the affected days are rebuilt.
+
+Only live transactions are reconciled; archived ones are already final.
+"""
+import csv
+import logging
+import os
+import re
+import tempfile
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import MpesaTransaction
+from .rollups import rebuild_rollups
+from .signals import send_transaction_updated
+from .utils import format_phone_number
+
+logger = logging.getLogger(__name__)
+
+StatementRow = namedtuple('StatementRow', 'receipt time amount phone')
+LocalRow = namedtuple('LocalRow', 'id status amount phone receipt time created_at')
+
+LOCAL_FIELDS = ('id', 'status', 'amount', 'phone_number', 'mpesa_receipt_number', 'transaction_date', 'created_at')
+
+# Accepted header names, lower-cased, for each statement column
+COLUMN_ALIASES = {
+    'receipt': ('receipt', 'receipt no.', 'receipt no', 'receipt_number', 'mpesa_receipt_number'),
+    'time': ('time', 'completion time', 'transaction_time', 'transaction_date', 'date'),
+    'amount': ('amount', 'paid in'),
+    'phone': ('phone', 'phone_number', 'msisdn', 'other party info'),
+    'status': ('status', 'transaction status'),
+}
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%d-%m-%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%Y%m%d%H%M%S')
+PHONE_PATTERN = re.compile(r'\+?\d{9,12}')
+
+REPORT_FIELDS = [
+    'kind', 'receipt', 'statement_time', 'statement_amount', 'statement_phone',
+    'transaction_id', 'local_status', 'local_amount', 'local_receipt', 'detail',
+]
+CORRECTION_FIELDS = ['status', 'result_code', 'result_desc', 'mpesa_receipt_number', 'transaction_date', 'updated_at']
+
+
+class StatementError(ValueError):
+    """Raised when the statement file can't be read"""
+
+
+def _parse_time(value, tz):
+    for fmt in TIME_FORMATS:
+        try:
+            return timezone.make_aware(datetime.strptime(value.strip(), fmt), tz)
+        except ValueError:
+            continue
+    raise StatementError(f'Unrecognised time {value!r}')
+
+
+def _parse_phone(value):
+    match = PHONE_PATTERN.search(value or '')
+    return format_phone_number(match.group()) if match else ''
+
+
+def read_statement(lines, tz=None):
+    """Yield completed payments from a statement CSV as ``StatementRow``s"""
+    tz = tz or ZoneInfo(getattr(settings, 'MPESA_STATEMENT_TIMEZONE', 'Africa/Nairobi'))
+    reader = csv.reader(lines)
+    header = [name.strip().lower() for name in next(reader, [])]
+    columns = {}
+    for column, aliases in COLUMN_ALIASES.items():
+        columns[column] = next((header.index(alias) for alias in aliases if alias in header), None)
+    missing = [column for column in ('receipt', 'time', 'amount') if columns[column] is None]
+    if missing:
+        raise StatementError(f"Statement has no {', '.join(missing)} column")
+
+    for line_number, record in enumerate(reader, start=2):
+        if not record:
+            continue
+        if columns['status'] is not None and record[columns['status']].strip().lower() != 'completed':
+            continue
+        try:
+            amount = Decimal(record[columns['amount']].replace(',', '').strip() or 0)
+        except InvalidOperation:
+            raise StatementError(f'Line {line_number}: invalid amount {record[columns["amount"]]!r}')
+        if amount <= 0:
+            continue  # Withdrawals and charges
+        yield StatementRow(
+            receipt=record[columns['receipt']].strip().upper(),
+            time=_parse_time(record[columns['time']], tz),
+            amount=amount,
+            phone=_parse_phone(record[columns['phone']]) if columns['phone'] is not None else '',
+        )
+
+
+def partition_by_day(rows, directory):
+    """Spill statement rows into one CSV per local day. Returns ``{day: path}``"""
+    files, writers, paths = {}, {}, {}
+    try:
+        for row in rows:
+            day = timezone.localtime(row.time).date()
+            if day not in files:
+                paths[day] = os.path.join(directory, f'{day.isoformat()}.csv')
+                files[day] = open(paths[day], 'w', newline='')
+                writers[day] = csv.writer(files[day])
+            writers[day].writerow([row.receipt, row.time.isoformat(), row.amount, row.phone])
+    finally:
+        for f in files.values():
+            f.close()
+    return paths
+
+
+def _read_spill(path):
+    with open(path, newline='') as f:
+        for receipt, moment, amount, phone in csv.reader(f):
+            yield StatementRow(receipt, datetime.fromisoformat(moment), Decimal(amount), phone)
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+class Reconciler:
+    """Reconcile spilled statement days against ``MpesaTransaction``, writing a report"""
+
+    def __init__(self, report, apply=False, window=None, batch_size=1000):
+        self.report = csv.DictWriter(report, fieldnames=REPORT_FIELDS)
+        self.report.writeheader()
+        self.apply = apply
+        self.window = timedelta(seconds=window or getattr(settings, 'MPESA_RECONCILE_TIME_WINDOW', 600))
+        self.batch_size = batch_size
+        self.counts = Counter()
+        self.corrections = []
+        self.corrected_days = set()
+        self.carried_statement = []
+        self.carried_local = []
+
+    def run(self, days):
+        """Reconcile ``{day: spill path}`` for every day between the first and the last"""
+        if days:
+            day, last = min(days), max(days)
+            while day <= last:
+                self.reconcile_day(day, _read_spill(days[day]) if day in days else [])
+                day += timedelta(days=1)
+        self.finish()
+        return self.counts
+
+    def load_local(self, start, end):
+        return [
+            LocalRow(id, status, amount, phone, receipt, transaction_date or created_at, created_at)
+            for id, status, amount, phone, receipt, transaction_date, created_at in (
+                MpesaTransaction.objects.filter(created_at__gte=start, created_at__lt=end)
+                .order_by().values_list(*LOCAL_FIELDS).iterator(chunk_size=5000)
+            )
+        ]
+
+    def reconcile_day(self, day, statement_rows):
+        start, end = _day_bounds(day)
+        local = self.carried_local + self.load_local(start, end)
+        statement = self.carried_statement + list(statement_rows)
+        self.counts['statement_rows'] += len(statement) - len(self.carried_statement)
+        self.carried_local, self.carried_statement = [], []
+
+        by_receipt = {row.receipt: row for row in local if row.receipt}
+        by_payment = defaultdict(list)
+        for row in local:
+            if not row.receipt:
+                by_payment[(row.phone, row.amount)].append(row)
+        matched = set()
+
+        unmatched = []
+        for row in statement:
+            match = by_receipt.get(row.receipt)
+            if match is None:
+                unmatched.append(row)
+                continue
+            matched.add(match.id)
+            if match.amount != row.amount:
+                self.record('mismatched', row, match, f'Amount {match.amount} locally, {row.amount} on statement')
+            elif match.status != 'SUCCESS':
+                self.record('mismatched', row, match, f'Status {match.status} locally')
+                self.correct(row, match)
+            else:
+                self.counts['matched'] += 1
+
+        for row in unmatched:
+            candidates = [c for c in by_payment.get((row.phone, row.amount), ()) if c.id not in matched]
+            match = min(candidates, key=lambda c: abs(c.time - row.time), default=None)
+            if match is None or abs(match.time - row.time) > self.window:
+                if row.time >= end - self.window:
+                    self.carried_statement.append(row)
+                else:
+                    self.record('missing', row)
+                continue
+            matched.add(match.id)
+            if match.status == 'SUCCESS':
+                self.record('mismatched', row, match, 'No receipt number locally')
+            else:
+                self.record('unsettled', row, match, f'Status {match.status} locally')
+            self.correct(row, match)
+
+        for row in local:
+            if row.id in matched:
+                continue
+            if row.created_at >= end - self.window:
+                self.carried_local.append(row)
+            elif row.status == 'SUCCESS':
+                self.record('extra', local=row, detail='Not on the statement')
+
+    def record(self, kind, statement=None, local=None, detail=''):
+        self.counts[kind] += 1
+        self.report.writerow({
+            'kind': kind,
+            'receipt': statement.receipt if statement else local.receipt,
+            'statement_time': statement.time.isoformat() if statement else '',
+            'statement_amount': statement.amount if statement else '',
+            'statement_phone': statement.phone if statement else '',
+            'transaction_id': local.id if local else '',
+            'local_status': local.status if local else '',
+            'local_amount': local.amount if local else '',
+            'local_receipt': local.receipt or '' if local else '',
+            'detail': detail,
+        })
+
+    def correct(self, statement, local):
+        """Queue a local transaction to be settled from its statement row"""
+        if not self.apply:
+            return
+        self.corrections.append(MpesaTransaction(
+            id=local.id,
+            status='SUCCESS',
+            result_code='0',
+            result_desc='Settled from the M-Pesa statement',
+            mpesa_receipt_number=statement.receipt,
+            transaction_date=statement.time,
+            updated_at=timezone.now(),
+        ))
+        self.corrected_days.add(timezone.localtime(local.created_at).date())
+        if len(self.corrections) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.corrections:
+            MpesaTransaction.objects.bulk_update(self.corrections, CORRECTION_FIELDS)
+            send_transaction_updated(*(t.id for t in self.corrections))
+            self.counts['corrected'] += len(self.corrections)
+            self.corrections = []
+
+    def finish(self):
+        """Report what is still carried over, write pending corrections and fix their rollups"""
+        for row in self.carried_statement:
+            self.record('missing', row)
+        for row in self.carried_local:
+            if row.status == 'SUCCESS':
+                self.record('extra', local=row, detail='Not on the statement')
+        self.carried_statement, self.carried_local = [], []
+        self.flush()
+        for day in sorted(self.corrected_days):
+            start, end = _day_bounds(day)
+            for _ in rebuild_rollups(start, end):
+                pass
+
+
+def reconcile_statement(lines, report, apply=False, window=None, batch_size=1000):
+    """Reconcile a statement CSV against local transactions. Returns the outcome counts"""
+    with tempfile.TemporaryDirectory(prefix='mpesa-reconcile-') as directory:
+        days = partition_by_day(read_statement(lines), directory)
+        return Reconciler(report, apply=apply, window=window, batch_size=batch_size).run(days)
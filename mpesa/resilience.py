@@ -0,0 +1,216 @@
+"""Outbound rate limiting and circuit breaking for Daraja calls.
+
+Both keep their state in the Django cache, so with a shared backend (Redis)
+every worker sees the same quota and the same breaker. With the default
+local-memory cache they only apply per process.
+
+``RateLimiter`` caps calls per second per endpoint. The cache API has no
+compare-and-set, so instead of a token bucket it counts calls in the
+current one-second window with atomic ``add``/``incr``; callers over the
+limit wait for the next window, up to ``max_wait``.
+
+``CircuitBreaker`` opens when the share of failed calls (transport errors,
+429 and 5xx) in the current window crosses a threshold. While open, calls
+fail immediately with ``CircuitOpen``; after a cooldown one probe call is
+let through and its outcome closes or re-opens the breaker.
+"""
+import asyncio
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamUnavailable(Exception):
+    """Daraja is not being called right now; retry after ``retry_after`` seconds"""
+    code = 'UNAVAILABLE'
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(UpstreamUnavailable):
+    code = 'CB_OPEN'
+
+
+class RateLimited(UpstreamUnavailable):
+    code = 'RATE_LIMIT'
+
+
+def _cache():
+    return caches[getattr(settings, 'MPESA_RESILIENCE_CACHE', 'default')]
+
+
+def _incr(cache, key, timeout):
+    """Atomically increment a counter that expires ``timeout`` seconds after creation"""
+    if cache.add(key, 1, timeout=timeout):
+        return 1
+    try:
+        return cache.incr(key)
+    except ValueError:  # Expired between add and incr
+        cache.add(key, 1, timeout=timeout)
+        return 1
+
+
+class RateLimiter:
+    """Per-second call limits by endpoint name, from ``MPESA_RATE_LIMITS``"""
+
+    def __init__(self, prefix='mpesa:ratelimit'):
+        self.prefix = prefix
+
+    def limit(self, name):
+        return getattr(settings, 'MPESA_RATE_LIMITS', {}).get(name)
+
+    def _try_acquire(self, name, limit):
+        """Take a slot in the current window. Returns 0, or the seconds until the next window"""
+        now = time.time()
+        window = int(now)
+        try:
+            used = _incr(_cache(), f'{self.prefix}:{name}:{window}', timeout=2)
+        except Exception:
+            logger.exception("Rate limiter cache error, letting the call through")
+            return 0
+        return 0 if used <= limit else window + 1 - now
+
+    def acquire(self, name):
+        """Wait for a slot for ``name``, raising ``RateLimited`` after ``MPESA_RATE_LIMIT_MAX_WAIT``"""
+        limit = self.limit(name)
+        if not limit:
+            return
+        deadline = time.monotonic() + getattr(settings, 'MPESA_RATE_LIMIT_MAX_WAIT', 2.0)
+        while True:
+            delay = self._try_acquire(name, limit)
+            if not delay:
+                return
+            if time.monotonic() + delay > deadline:
+                raise RateLimited(f'Daraja {name} rate limit of {limit}/s reached', retry_after=1)
+            time.sleep(delay)
+
+    async def aacquire(self, name):
+        """Async version of ``acquire``"""
+        limit = self.limit(name)
+        if not limit:
+            return
+        deadline = time.monotonic() + getattr(settings, 'MPESA_RATE_LIMIT_MAX_WAIT', 2.0)
+        while True:
+            delay = await sync_to_async(self._try_acquire, thread_sensitive=False)(name, limit)
+            if not delay:
+                return
+            if time.monotonic() + delay > deadline:
+                raise RateLimited(f'Daraja {name} rate limit of {limit}/s reached', retry_after=1)
+            await asyncio.sleep(delay)
+
+    def usage(self):
+        """Calls made in the current second, by endpoint"""
+        window = int(time.time())
+        limits = getattr(settings, 'MPESA_RATE_LIMITS', {})
+        keys = {f'{self.prefix}:{name}:{window}': name for name in limits}
+        values = _cache().get_many(list(keys))
+        return {name: values.get(key, 0) for key, name in keys.items()}
+
+
+class CircuitBreaker:
+    """Failure-rate circuit breaker for one upstream, configured by ``MPESA_CIRCUIT_*`` settings"""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name):
+        self.name = name
+        self.prefix = f'mpesa:circuit:{name}'
+
+    @property
+    def window(self):
+        return getattr(settings, 'MPESA_CIRCUIT_WINDOW', 30)
+
+    @property
+    def cooldown(self):
+        return getattr(settings, 'MPESA_CIRCUIT_COOLDOWN', 30)
+
+    def _window_keys(self):
+        window = int(time.time() // self.window)
+        return f'{self.prefix}:{window}:calls', f'{self.prefix}:{window}:failures'
+
+    def allow(self):
+        """Return whether the call is a half-open probe. Raises ``CircuitOpen`` while open"""
+        try:
+            cache = _cache()
+            opened_at = cache.get(f'{self.prefix}:opened_at')
+            if opened_at is None:
+                return False
+            remaining = opened_at + self.cooldown - time.time()
+            # After the cooldown, exactly one caller gets to probe
+            if remaining <= 0 and cache.add(f'{self.prefix}:probe', 1, timeout=self.cooldown):
+                return True
+        except Exception:
+            logger.exception("Circuit breaker cache error, letting the call through")
+            return False
+        raise CircuitOpen(
+            f'Daraja is failing; calls are paused for up to {self.cooldown}s',
+            retry_after=max(1, int(remaining) + 1),
+        )
+
+    def record(self, ok, probe=False):
+        """Record the outcome of a call let through by ``allow``"""
+        try:
+            cache = _cache()
+            if probe:
+                if ok:
+                    cache.delete_many([f'{self.prefix}:opened_at', f'{self.prefix}:probe'])
+                    logger.info("Circuit %s closed", self.name)
+                else:
+                    self._open(cache)
+                return
+
+            calls_key, failures_key = self._window_keys()
+            calls = _incr(cache, calls_key, timeout=self.window * 2)
+            if ok:
+                return
+            failures = _incr(cache, failures_key, timeout=self.window * 2)
+            if (calls >= getattr(settings, 'MPESA_CIRCUIT_MIN_CALLS', 20)
+                    and failures / calls >= getattr(settings, 'MPESA_CIRCUIT_FAILURE_RATIO', 0.5)):
+                self._open(cache)
+        except Exception:
+            logger.exception("Circuit breaker cache error")
+
+    def _open(self, cache):
+        cache.set(f'{self.prefix}:opened_at', time.time(), timeout=None)
+        cache.delete(f'{self.prefix}:probe')
+        logger.warning("Circuit %s opened for %ss", self.name, self.cooldown)
+
+    def reset(self):
+        cache = _cache()
+        cache.delete_many([f'{self.prefix}:opened_at', f'{self.prefix}:probe', *self._window_keys()])
+
+    async def aallow(self):
+        return await sync_to_async(self.allow, thread_sensitive=False)()
+
+    async def arecord(self, ok, probe=False):
+        await sync_to_async(self.record, thread_sensitive=False)(ok, probe)
+
+    def state(self):
+        """Return the breaker state and the current window's counts"""
+        cache = _cache()
+        calls_key, failures_key = self._window_keys()
+        values = cache.get_many([f'{self.prefix}:opened_at', f'{self.prefix}:probe', calls_key, failures_key])
+        opened_at = values.get(f'{self.prefix}:opened_at')
+        if opened_at is None:
+            state = self.CLOSED
+        elif time.time() - opened_at >= self.cooldown or f'{self.prefix}:probe' in values:
+            state = self.HALF_OPEN
+        else:
+            state = self.OPEN
+        return {
+            'state': state,
+            'opened_at': opened_at,
+            'calls': values.get(calls_key, 0),
+            'failures': values.get(failures_key, 0),
+        }
+
+
+rate_limiter = RateLimiter()
+daraja_breaker = CircuitBreaker('daraja')
@@ -0,0 +1,187 @@
+"""Pre-aggregated transaction totals for finance reports.
+
+``TransactionRollup`` keeps the count and amount of settled transactions
+per hour and per day, status, merchant and account reference, so reports read a
+bounded number of rows however large ``MpesaTransaction`` grows. Periods
+follow ``created_at`` in the current time zone.
+
+Rollups are updated incrementally: ``transaction_updated`` triggers
+``roll_up`` for the changed transactions, which counts the ones that
+reached a final status and stamps them ``rolled_up_at`` in the same
+database transaction, so each is counted exactly once. ``manage.py
+rebuild_rollups`` recomputes them from history a day at a time, and with
+``--pending`` catches up transactions missed by the signal.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction as db_transaction
+from django.db.models import Count, F, Min, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import ArchivedTransaction, Merchant, MpesaTransaction, TransactionRollup
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'hour': TruncHour, 'day': TruncDay}
+
+
+def period_start(period, moment):
+    """Start of the hour or day containing ``moment``, in the current time zone"""
+    moment = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0) if period == 'day' else moment
+
+
+def _increment(totals):
+    """Add ``{(period, period_start, status, merchant_code, account_reference): [count, amount]}`` to the rollups"""
+    TransactionRollup.objects.bulk_create([
+        TransactionRollup(
+            period=period, period_start=start, status=status, merchant_code=merchant_code, account_reference=reference,
+        )
+        for period, start, status, merchant_code, reference in totals
+    ], ignore_conflicts=True)
+    for (period, start, status, merchant_code, reference), (count, amount) in totals.items():
+        TransactionRollup.objects.filter(
+            period=period, period_start=start, status=status, merchant_code=merchant_code, account_reference=reference,
+        ).update(count=F('count') + count, amount=F('amount') + amount, updated_at=timezone.now())
+
+
+def roll_up(transaction_ids=None, batch_size=1000):
+    """Count settled transactions not rolled up yet. Returns how many were counted"""
+    with db_transaction.atomic():
+        settled = MpesaTransaction.objects.filter(
+            status__in=MpesaTransaction.TERMINAL_STATUSES, rolled_up_at__isnull=True,
+        )
+        if transaction_ids is not None:
+            settled = settled.filter(id__in=transaction_ids)
+        if connection.features.has_select_for_update:
+            settled = settled.select_for_update()
+        rows = list(
+            settled.order_by('created_at')
+            .values('id', 'created_at', 'status', 'merchant_id', 'account_reference', 'amount')[:batch_size]
+        )
+        if not rows:
+            return 0
+        # Looked up apart: FOR UPDATE can't lock the nullable side of a join on PostgreSQL
+        codes = dict(Merchant.objects.filter(
+            id__in={row['merchant_id'] for row in rows} - {None},
+        ).values_list('id', 'code'))
+
+        # Stamp first: on SQLite a concurrent roll_up of the same rows fails here instead of counting twice
+        MpesaTransaction.objects.filter(id__in=[row['id'] for row in rows]).update(rolled_up_at=timezone.now())
+        totals = defaultdict(lambda: [0, Decimal(0)])
+        for row in rows:
+            for period in PERIODS:
+                key = (
+                    period, period_start(period, row['created_at']), row['status'],
+                    codes.get(row['merchant_id'], ''), row['account_reference'],
+                )
+                totals[key][0] += 1
+                totals[key][1] += row['amount']
+        _increment(totals)
+    return len(rows)
+
+
+def on_transaction_updated(sender, transaction_ids, **kwargs):
+    try:
+        roll_up(transaction_ids)
+    except Exception:
+        # rebuild_rollups --pending picks these up later
+        logger.exception("Rolling up transactions failed")
+
+
+def rebuild_rollups(start=None, end=None, chunk_days=1):
+    """Recompute the rollups between two dates from live and archived transactions
+
+    Works through ``chunk_days`` days per database transaction and yields
+    each chunk's ``(start, end, transactions)``. Defaults to the whole history.
+    """
+    if start is None:
+        firsts = [model.objects.aggregate(first=Min('created_at'))['first']
+                  for model in (MpesaTransaction, ArchivedTransaction)]
+        start = min((first for first in firsts if first is not None), default=None)
+        if start is None:
+            return
+    start = period_start('day', start)
+    end = end or timezone.now()
+
+    while start < end:
+        chunk_end = start + timedelta(days=chunk_days)
+        with db_transaction.atomic():
+            TransactionRollup.objects.filter(period_start__gte=start, period_start__lt=chunk_end).delete()
+            settled = MpesaTransaction.objects.filter(
+                created_at__gte=start, created_at__lt=chunk_end, status__in=MpesaTransaction.TERMINAL_STATUSES,
+            )
+            archived = ArchivedTransaction.objects.filter(
+                created_at__gte=start, created_at__lt=chunk_end, status__in=MpesaTransaction.TERMINAL_STATUSES,
+            )
+            counted = settled.update(rolled_up_at=timezone.now()) + archived.count()
+            for period, trunc in PERIODS.items():
+                totals = defaultdict(lambda: [0, Decimal(0)])
+                for rows in (settled, archived):
+                    for row in (
+                        rows.annotate(period_start=trunc('created_at'))
+                        .values('period_start', 'status', 'merchant__code', 'account_reference')
+                        .annotate(count=Count('id'), amount=Sum('amount'))
+                        .order_by()
+                    ):
+                        key = (row['period_start'], row['status'], row['merchant__code'] or '', row['account_reference'])
+                        totals[key][0] += row['count']
+                        totals[key][1] += row['amount']
+                TransactionRollup.objects.bulk_create([
+                    TransactionRollup(
+                        period=period, period_start=moment, status=status, merchant_code=merchant_code,
+                        account_reference=reference, count=count, amount=amount,
+                    )
+                    for (moment, status, merchant_code, reference), (count, amount) in totals.items()
+                ])
+        yield start, chunk_end, counted
+        start = chunk_end
+
+
+def parse_bound(value):
+    """Parse an ISO date or datetime from a report query. Raises ValueError"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'Invalid date {value!r}')
+        moment = datetime.combine(day, time.min)
+    return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+
+def summarize(period, start, end, account_reference=None, merchant_code=None):
+    """Return per-period totals from the rollups, with success rates
+
+    Reads at most one row per period, status, merchant and account reference
+    in the range, independent of the number of transactions.
+    """
+    rows = TransactionRollup.objects.filter(period=period, period_start__gte=start, period_start__lt=end)
+    if merchant_code is not None:
+        rows = rows.filter(merchant_code=merchant_code)
+    if account_reference is not None:
+        rows = rows.filter(account_reference=account_reference)
+    buckets = {}
+    for row in rows.values('period_start', 'status').annotate(count=Sum('count'), amount=Sum('amount')).order_by():
+        bucket = buckets.setdefault(row['period_start'], {'counts': {}, 'amounts': {}})
+        bucket['counts'][row['status']] = row['count']
+        bucket['amounts'][row['status']] = row['amount']
+
+    summary = []
+    for moment in sorted(buckets):
+        counts, amounts = buckets[moment]['counts'], buckets[moment]['amounts']
+        settled = sum(counts.values())
+        summary.append({
+            'period_start': moment.isoformat(),
+            'count': settled,
+            'success_count': counts.get('SUCCESS', 0),
+            'success_amount': f"{amounts.get('SUCCESS', 0):.2f}",
+            'success_rate': round(counts.get('SUCCESS', 0) / settled, 4) if settled else None,
+            'counts': counts,
+            'amounts': {status: f'{amount:.2f}' for status, amount in amounts.items()},
+        })
+    return summary
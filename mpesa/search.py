@@ -0,0 +1,117 @@
+"""Indexed transaction search for support staff.
+
+Every lookup is answered from an index rather than a ``LIKE '%...%'`` scan:
+
+* phone numbers, exact or by prefix, on ``phone_number`` after
+  normalising with ``format_phone_number``;
+* the last digits of a phone number on ``phone_reversed``, which holds the
+  number reversed so a suffix becomes a prefix;
+* receipt numbers and account references, exact.
+
+Prefixes are matched with a ``>= prefix AND < next prefix`` range, which
+every database can serve from a plain B-tree index whatever its collation.
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from .utils import format_phone_number
+
+
+class SearchError(ValueError):
+    """Raised for a search term that can't be answered from an index"""
+
+
+def _digits(value):
+    return ''.join(filter(str.isdigit, value))
+
+
+def _min_digits():
+    return getattr(settings, 'MPESA_SEARCH_MIN_DIGITS', 3)
+
+
+def prefix_range(field, prefix):
+    """``Q`` matching values of ``field`` starting with ``prefix``, as an indexable range"""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': upper})
+
+
+def phone_query(value):
+    """Exact match for a full phone number, in any format ``format_phone_number`` accepts"""
+    phone = format_phone_number(value)
+    if len(phone) != 12:
+        raise SearchError(f'{value!r} is not a full phone number')
+    return Q(phone_number=phone)
+
+
+def phone_prefix_query(value):
+    """Phone numbers starting with ``value``, e.g. ``0712`` or ``+254712``"""
+    prefix = format_phone_number(value)
+    if not prefix.startswith('254'):
+        prefix = '254' + prefix
+    if len(prefix) < 3 + _min_digits():
+        raise SearchError(f'Phone prefixes need at least {_min_digits()} digits after 254')
+    return Q(phone_number=prefix) if len(prefix) >= 12 else prefix_range('phone_number', prefix)
+
+
+def phone_suffix_query(value):
+    """Phone numbers ending with the digits of ``value``"""
+    suffix = _digits(value)
+    if len(suffix) < _min_digits():
+        raise SearchError(f'Phone suffixes need at least {_min_digits()} digits')
+    return prefix_range('phone_reversed', suffix[::-1])
+
+
+def receipt_query(value):
+    return Q(mpesa_receipt_number=value.strip().upper())
+
+
+def reference_query(value):
+    return Q(account_reference=value.strip())
+
+
+def parse_search(term):
+    """Turn a free-text search into a ``Q``
+
+    ``*5678`` searches phone suffixes; digits starting with ``0``, ``254`` or
+    ``+`` are a phone number or prefix, other digits a suffix; anything else
+    is a receipt number or account reference.
+    """
+    term = term.strip()
+    if not term:
+        raise SearchError('Empty search')
+    if term.startswith('*'):
+        return phone_suffix_query(term[1:])
+    if not _digits(term) or any(c.isalpha() for c in term):
+        return receipt_query(term) | reference_query(term)
+    if term.startswith(('0', '254', '+')):
+        if len(format_phone_number(term)) == 12:
+            return phone_query(term)
+        return phone_prefix_query(term)
+    return phone_suffix_query(term)
+
+
+SEARCH_PARAMS = {
+    'phone': phone_query,
+    'phone_prefix': phone_prefix_query,
+    'phone_suffix': phone_suffix_query,
+    'receipt': receipt_query,
+    'account_reference': reference_query,
+}
+
+
+def search_transactions(queryset, term=None, **params):
+    """Filter ``queryset`` by a free-text ``term`` and/or ``SEARCH_PARAMS`` lookups
+
+    Raises ``SearchError`` when nothing is searched for or a term is too short.
+    """
+    unknown = set(params) - set(SEARCH_PARAMS)
+    if unknown:
+        raise SearchError(f"Unknown search parameters: {', '.join(sorted(unknown))}")
+    queries = [SEARCH_PARAMS[name](value) for name, value in params.items() if value]
+    if term:
+        queries.append(parse_search(term))
+    if not queries:
+        raise SearchError('Nothing to search for')
+    for query in queries:
+        queryset = queryset.filter(query)
+    return queryset
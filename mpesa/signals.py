@@ -0,0 +1,16 @@
+from django.db import transaction as db_transaction
+from django.dispatch import Signal
+
+from .models import MpesaTransaction
+
+# Sent after transactions change status. Arguments: ``transaction_ids``.
+transaction_updated = Signal()
+
+
+def send_transaction_updated(*transaction_ids):
+    """Send ``transaction_updated`` once the current database transaction commits"""
+    if not transaction_ids:
+        return
+    db_transaction.on_commit(lambda: transaction_updated.send(
+        sender=MpesaTransaction, transaction_ids=transaction_ids,
+    ))
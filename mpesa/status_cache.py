@@ -0,0 +1,80 @@
+"""Read-through cache of transaction status payloads.
+
+``transaction_status`` is polled heavily while a payment is in flight, so
+the serialized payload is cached per transaction together with its ETag.
+Entries are dropped whenever ``transaction_updated`` fires; final statuses
+are kept for a long time since they never change.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import ArchivedTransaction, MpesaTransaction
+
+STATUS_FIELDS = (
+    'id', 'user_id', 'status', 'amount', 'phone_number', 'mpesa_receipt_number',
+    'transaction_date', 'result_desc', 'result_code',
+)
+
+
+def _cache():
+    return caches[getattr(settings, 'MPESA_STATUS_CACHE', 'default')]
+
+
+def _key(transaction_id):
+    return f'mpesa:status:{transaction_id}'
+
+
+def serialize_transaction_status(transaction):
+    """Build the status payload shared by the status and events endpoints"""
+    # FIXED: Include result_code in response for better error handling
+    return {
+        'transaction_id': str(transaction.id),
+        'status': transaction.status,
+        'amount': str(transaction.amount),
+        'phone_number': transaction.phone_number,
+        'mpesa_receipt_number': transaction.mpesa_receipt_number,
+        'transaction_date': transaction.transaction_date.isoformat() if transaction.transaction_date else None,
+        'result_desc': transaction.result_desc,
+        'result_code': transaction.result_code  # Include this for frontend error handling
+    }
+
+
+def get_status_entry(transaction_id):
+    """Return ``{'user_id', 'status', 'body', 'etag'}`` for a transaction, or None if it doesn't exist"""
+    cache = _cache()
+    key = _key(transaction_id)
+    entry = cache.get(key)
+    if entry is not None:
+        return entry
+
+    transaction = (
+        MpesaTransaction.objects.only(*STATUS_FIELDS).filter(id=transaction_id).first()
+        or ArchivedTransaction.objects.only(*STATUS_FIELDS).filter(id=transaction_id).first()
+    )
+    if transaction is None:
+        return None
+
+    body = json.dumps(serialize_transaction_status(transaction)).encode('utf-8')
+    entry = {
+        'user_id': transaction.user_id,
+        'status': transaction.status,
+        'body': body,
+        'etag': f'"{hashlib.md5(body).hexdigest()}"',
+    }
+    if transaction.status in MpesaTransaction.TERMINAL_STATUSES:
+        timeout = getattr(settings, 'MPESA_STATUS_CACHE_FINAL_TTL', 86400)
+    else:
+        timeout = getattr(settings, 'MPESA_STATUS_CACHE_PENDING_TTL', 30)
+    cache.set(key, entry, timeout=timeout)
+    return entry
+
+
+def invalidate(*transaction_ids):
+    _cache().delete_many([_key(transaction_id) for transaction_id in transaction_ids])
+
+
+def on_transaction_updated(sender, transaction_ids, **kwargs):
+    invalidate(*transaction_ids)
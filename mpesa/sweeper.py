@@ -0,0 +1,128 @@
+"""Reconciliation of transactions whose callback never arrived.
+
+``sweep_pending`` picks PENDING transactions older than a grace period,
+asks Safaricom for their outcome with ``query_stk`` (through a small
+thread pool, throttled to a fixed number of queries per second) and writes
+the final states back with one ``bulk_update``. Transactions that Daraja
+still reports as being processed past a hard deadline are marked
+``TIMEOUT``. Any other answer without a ``ResultCode`` (network,
+credential or configuration failures, a paused circuit, Daraja errors such
+as "System is busy") leaves transactions PENDING, so a late callback can
+still settle them.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from .models import MpesaTransaction
+from .signals import send_transaction_updated
+from .utils import status_for_result_code
+from .views import query_stk
+
+logger = logging.getLogger(__name__)
+
+UPDATE_FIELDS = ['status', 'result_code', 'result_desc', 'updated_at']
+
+# Daraja's STK query answer while the customer hasn't completed the prompt
+PROCESSING_ERROR_CODE = '500.001.1001'
+
+
+class Throttle:
+    """Space out calls from several threads to at most ``rate`` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _query(throttle, transaction):
+    throttle.wait()
+    return query_stk(transaction.checkout_request_id)
+
+
+def resolve(transaction, result, deadline):
+    """Apply a ``query_stk`` result to a transaction. Returns True if it changed
+
+    The transaction is not saved.
+    """
+    if not result.get('success'):
+        # Daraja wasn't reached: that says nothing about the payment
+        return False
+    response_data = result.get('response_data') or {}
+    result_code = response_data.get('ResultCode')
+    if result_code is not None:
+        transaction.status = status_for_result_code(result_code)
+        transaction.result_code = str(result_code)
+        transaction.result_desc = response_data.get('ResultDesc')
+    elif response_data.get('errorCode') == PROCESSING_ERROR_CODE and transaction.created_at <= deadline:
+        # Still "being processed" long after the prompt expired
+        transaction.status = 'TIMEOUT'
+        transaction.result_code = 'Timeout'
+        transaction.result_desc = 'No result received before the sweep deadline'
+    else:
+        return False
+    transaction.updated_at = timezone.now()
+    return True
+
+
+def sweep_pending(older_than=None, timeout_after=None, limit=500, max_workers=None, rate=None):
+    """Reconcile one batch of stale PENDING transactions. Returns a Counter of new statuses"""
+    if older_than is None:
+        older_than = getattr(settings, 'MPESA_SWEEP_AFTER_SECONDS', 120)
+    if timeout_after is None:
+        timeout_after = getattr(settings, 'MPESA_SWEEP_TIMEOUT_SECONDS', 900)
+    max_workers = max_workers or getattr(settings, 'MPESA_SWEEP_WORKERS', 4)
+    if rate is None:
+        rate = getattr(settings, 'MPESA_SWEEP_QUERIES_PER_SECOND', 5)
+
+    now = timezone.now()
+    deadline = now - timedelta(seconds=timeout_after)
+    stale = list(
+        MpesaTransaction.objects.filter(
+            status='PENDING', created_at__lte=now - timedelta(seconds=older_than),
+            checkout_request_id__isnull=False,
+        ).order_by('created_at').only('id', 'status', 'checkout_request_id', 'created_at')[:limit]
+    )
+    if not stale:
+        return Counter()
+
+    throttle = Throttle(rate)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda t: _query(throttle, t), stale))
+
+    resolved = {}
+    for transaction, result in zip(stale, results):
+        if not result.get('success'):
+            logger.warning("STK query for %s failed: %s", transaction.checkout_request_id, result.get('error'))
+        if resolve(transaction, result, deadline):
+            resolved[transaction.id] = transaction
+
+    with db_transaction.atomic():
+        # A callback may have settled some of them while we were querying
+        still_pending = set(
+            MpesaTransaction.objects.select_for_update()
+            .filter(id__in=resolved, status='PENDING').values_list('id', flat=True)
+        )
+        updated = [resolved[pk] for pk in still_pending]
+        MpesaTransaction.objects.bulk_update(updated, UPDATE_FIELDS)
+        send_transaction_updated(*still_pending)
+
+    return Counter(transaction.status for transaction in updated)
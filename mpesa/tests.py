@@ -1,3 +1,1265 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.core.handlers.asgi import ASGIHandler
+from django.core.cache import cache
+from django.contrib import admin
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from django.utils import timezone
+from django.test import (
+    AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+
+from . import (
+    archive, async_views, batch, coalesce, merchants, metrics, outbox, profiling, pubsub, reconcile, rollups, search, sweeper, views,
+)
+from .client import AsyncResponse, DarajaClient
+from .callbacks import drain_inbox, inbox_stats
+from .pagination import EstimatedCountPaginator
+from .models import (
+    ArchivedTransaction, CallbackInbox, Merchant, MpesaCallback, MpesaTransaction, TransactionRollup,
+)
+from .resilience import CircuitBreaker, CircuitOpen, RateLimited, RateLimiter
+from .tokens import AccessTokenManager
+
+
+class SlowFetch:
+    """Token fetcher that counts calls and takes a while to respond"""
+
+    def __init__(self, delay=0.05, expires_in=3599):
+        self.delay = delay
+        self.expires_in = expires_in
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            n = self.calls
+        time.sleep(self.delay)
+        return f'token-{n}', self.expires_in
+
+
+class AccessTokenManagerTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_token_is_cached(self):
+        fetch = SlowFetch(delay=0)
+        manager = AccessTokenManager(fetch)
+        self.assertEqual(manager.get_token(), 'token-1')
+        self.assertEqual(manager.get_token(), 'token-1')
+        self.assertEqual(fetch.calls, 1)
+        stats = manager.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['refreshes'], 1)
+
+    def test_concurrent_callers_share_one_refresh(self):
+        fetch = SlowFetch()
+        manager = AccessTokenManager(fetch)
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fetch.calls, 1)
+        self.assertEqual(set(tokens), {'token-1'})
+
+    def test_token_shared_between_workers(self):
+        fetch = SlowFetch(delay=0)
+        AccessTokenManager(fetch).get_token()
+        other_worker = AccessTokenManager(fetch)
+        self.assertEqual(other_worker.get_token(), 'token-1')
+        self.assertEqual(fetch.calls, 1)
+        self.assertEqual(other_worker.stats()['shared_hits'], 1)
+
+    def test_refreshes_in_background_before_expiry(self):
+        fetch = SlowFetch(delay=0, expires_in=60)
+        manager = AccessTokenManager(fetch, refresh_margin=120)
+        self.assertEqual(manager.get_token(), 'token-1')
+        # Inside the refresh margin the current token is served while a new one is fetched
+        self.assertEqual(manager.get_token(), 'token-1')
+        for _ in range(50):
+            if manager.stats()['background_refreshes']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(fetch.calls, 2)
+        self.assertEqual(manager.peek(), 'token-2')
+
+
+def fake_response(status_code, data=None):
+    response = mock.Mock(status_code=status_code)
+    response.json.return_value = data or {}
+    return response
+
+
+class DarajaClientTests(SimpleTestCase):
+    def setUp(self):
+        self.daraja = DarajaClient(base_url='http://daraja.test/', backoff=0)
+
+    def test_idempotent_call_retried_on_server_error(self):
+        responses = [fake_response(503), fake_response(200, {'ResponseCode': '0'})]
+        with mock.patch.object(self.daraja.session, 'request', side_effect=responses) as request:
+            response = self.daraja.stk_query({'CheckoutRequestID': 'ws_CO_1'}, 'token')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(request.call_args.args[1], 'http://daraja.test/mpesa/stkpushquery/v1/query')
+        self.assertEqual(request.call_args.kwargs['timeout'], self.daraja.timeout)
+
+    def test_stk_push_not_retried_after_request_was_sent(self):
+        with mock.patch.object(self.daraja.session, 'request',
+                               side_effect=requests.exceptions.ReadTimeout) as request:
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                self.daraja.stk_push({}, 'token')
+        self.assertEqual(request.call_count, 1)
+
+    def test_stk_push_retried_when_connection_never_opened(self):
+        responses = [requests.exceptions.ConnectTimeout(), fake_response(200)]
+        with mock.patch.object(self.daraja.session, 'request', side_effect=responses) as request:
+            self.daraja.stk_push({}, 'token')
+        self.assertEqual(request.call_count, 2)
+
+
+STK_PUSH_ACCEPTED = {
+    'MerchantRequestID': '29115-34620561-1',
+    'CheckoutRequestID': 'ws_CO_191220191020363925',
+    'ResponseCode': '0',
+    'ResponseDescription': 'Success. Request accepted for processing',
+}
+
+
+class AsyncViewTests(TestCase):
+    async def test_stk_push_view(self):
+        daraja = mock.Mock()
+        daraja.stk_push = mock.AsyncMock(return_value=AsyncResponse(200, json.dumps(STK_PUSH_ACCEPTED)))
+        request = AsyncRequestFactory().post(
+            '/stk-push/', {'phone_number': '0712345678', 'amount': 10}, content_type='application/json')
+        request.auser = mock.AsyncMock(return_value=AnonymousUser())
+
+        with mock.patch.object(async_views, 'get_async_client', return_value=daraja), \
+                mock.patch.object(async_views, 'aget_access_token', mock.AsyncMock(return_value='token')):
+            response = await async_views.stk_push_view(request)
+
+        result = json.loads(response.content)
+        self.assertTrue(result['success'])
+        transaction = await MpesaTransaction.objects.aget(id=result['transaction_id'])
+        self.assertEqual(transaction.status, 'PENDING')
+        self.assertEqual(transaction.phone_number, '254712345678')
+        self.assertEqual(transaction.checkout_request_id, STK_PUSH_ACCEPTED['CheckoutRequestID'])
+        self.assertEqual(daraja.stk_push.await_args.args[0]['PhoneNumber'], '254712345678')
+
+
+class StkPushBatchTests(TestCase):
+    def setUp(self):
+        self.daraja = mock.Mock()
+        self.daraja.stk_push.side_effect = self.fake_push
+        patches = [
+            mock.patch.object(batch, 'get_client', return_value=self.daraja),
+            mock.patch.object(batch, 'generate_access_token', return_value='token'),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def fake_push(payload, token):
+        if payload['PhoneNumber'].endswith('9'):
+            return fake_response(400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid PhoneNumber'})
+        return fake_response(200, dict(STK_PUSH_ACCEPTED, CheckoutRequestID=f"ws_CO_{payload['PhoneNumber']}"))
+
+    def test_batch_creates_and_updates_rows(self):
+        items = [
+            ('0712345671', 10, 'PROMO'),
+            {'phone_number': '0712345679', 'amount': 20},
+            ('12345', 10, 'PROMO'),
+        ]
+        submitted = batch.submit_stk_push_batch(items, max_workers=2)
+        results = sorted(submitted, key=lambda r: r['index'])
+
+        self.assertEqual([r['success'] for r in results], [True, False, False])
+        self.assertEqual(results[2]['error'], 'Invalid phone number')
+        self.assertEqual(self.daraja.stk_push.call_count, 2)
+
+        rows = {t.phone_number: t for t in MpesaTransaction.objects.filter(batch_id=submitted.batch_id)}
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows['254712345671'].status, 'PENDING')
+        self.assertEqual(rows['254712345671'].account_reference, 'PROMO')
+        self.assertEqual(rows['254712345679'].account_reference, 'INNOVESTRA TECH ENTERPRISES')
+        self.assertEqual(rows['254712345671'].checkout_request_id, 'ws_CO_254712345671')
+        self.assertEqual(rows['254712345679'].status, 'FAILED')
+        self.assertEqual(rows['254712345679'].result_code, '400.002.02')
+
+    def test_invalid_amounts_are_rejected(self):
+        for amount in ('10.50', 'NaN', 'Infinity', '1e20', '0', 'ten'):
+            with self.subTest(amount=amount):
+                self.assertEqual(batch.parse_batch_item(('0712345671', amount, 'A'))[3], 'Invalid amount')
+        self.assertEqual(batch.parse_batch_item(('0712345671', '10.00', 'A'))[1], 10)
+
+    def test_refused_pushes_are_queued_and_merchants_resolved_up_front(self):
+        calls = []
+        self.daraja.stk_push.side_effect = RateLimited('Too many STK pushes', retry_after=5)
+        with mock.patch.object(batch, 'merchant_for_id', side_effect=lambda merchant_id: (
+                calls.append(threading.current_thread()) or merchants.get_merchant())):
+            results = list(batch.submit_stk_push_batch([('0712345671', 10, 'A'), ('0712345672', 10, 'B')]))
+
+        self.assertEqual(calls, [threading.current_thread()])
+        self.assertEqual({(r['success'], r['queued'], r['retry_after']) for r in results}, {(False, True, 5)})
+        for transaction in MpesaTransaction.objects.all():
+            self.assertEqual(transaction.status, 'INITIATED')
+            self.assertGreater(transaction.queued_at, timezone.now())
+
+    def test_early_exit_still_records_every_outcome(self):
+        submitted = batch.submit_stk_push_batch([('0712345671', 10, 'A'), ('0712345672', 10, 'B')])
+        next(iter(submitted))
+        self.assertFalse(MpesaTransaction.objects.filter(batch_id=submitted.batch_id, status='INITIATED').exists())
+
+    def test_batch_size_is_limited(self):
+        with self.settings(MPESA_BATCH_MAX_ITEMS=1), self.assertRaises(batch.BatchError):
+            batch.submit_stk_push_batch([('0712345671', 10, 'A'), ('0712345672', 10, 'B')])
+
+
+@override_settings(MPESA_STK_DISPATCH='queued')
+class StkOutboxTests(TestCase):
+    def setUp(self):
+        self.daraja = mock.Mock()
+        self.daraja.stk_push.side_effect = StkPushBatchTests.fake_push
+        patches = [
+            mock.patch.object(batch, 'get_client', return_value=self.daraja),
+            mock.patch.object(batch, 'generate_access_token', return_value='token'),
+            mock.patch.object(views, 'get_client', return_value=self.daraja),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def push(self, phone_number='0712345671', key=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return self.client.post(
+            '/stk-push/', {'phone_number': phone_number, 'amount': 10}, content_type='application/json', **headers,
+        )
+
+    def test_queued_push_answers_without_calling_daraja(self):
+        response = self.push(key='order-1')
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.json()['queued'])
+        self.daraja.stk_push.assert_not_called()
+
+        transaction = MpesaTransaction.objects.get(id=response.json()['transaction_id'])
+        self.assertEqual(transaction.status, 'INITIATED')
+        self.assertIsNotNone(transaction.queued_at)
+        # A retry while queued gets the same transaction back
+        replay = self.push(key='order-1').json()
+        self.assertEqual(replay['transaction_id'], str(transaction.id))
+        self.assertTrue(replay['idempotent_replay'])
+
+    def test_dispatch_sends_queued_pushes_only(self):
+        self.push('0712345671')
+        self.push('0712345679')
+        inline = MpesaTransaction.objects.create(phone_number='254712345672', amount=10, status='INITIATED')
+
+        self.assertEqual(outbox.dispatch_batch(), 2)
+        self.assertEqual(outbox.dispatch_batch(), 0)
+        rows = {t.phone_number: t for t in MpesaTransaction.objects.all()}
+        self.assertEqual(rows['254712345671'].status, 'PENDING')
+        self.assertEqual(rows['254712345671'].checkout_request_id, 'ws_CO_254712345671')
+        self.assertEqual(rows['254712345679'].status, 'FAILED')
+        self.assertEqual(rows['254712345672'].status, inline.status)
+
+    def test_pushes_refused_by_open_circuit_stay_queued(self):
+        self.push()
+        self.daraja.stk_push.side_effect = CircuitOpen('Daraja is failing', retry_after=30)
+        self.assertEqual(outbox.dispatch_batch(), 0)
+        transaction = MpesaTransaction.objects.get()
+        self.assertEqual(transaction.status, 'INITIATED')
+        self.assertIsNone(transaction.claim_token)
+        self.assertGreater(transaction.queued_at, timezone.now())
+        self.assertEqual(outbox.dispatch_batch(), 0)  # Not due yet
+
+        MpesaTransaction.objects.update(queued_at=timezone.now())
+        self.daraja.stk_push.side_effect = StkPushBatchTests.fake_push
+        self.assertEqual(outbox.dispatch_batch(), 1)
+        self.assertEqual(MpesaTransaction.objects.get().status, 'PENDING')
+
+    def test_claimed_rows_are_not_claimed_again_and_stale_claims_fail(self):
+        self.push()
+        self.assertEqual(len(outbox.claim_batch()), 1)
+        self.assertEqual(outbox.claim_batch(), [])
+
+        self.assertEqual(outbox.fail_stale_claims(timeout=-1), 1)
+        self.assertEqual(MpesaTransaction.objects.get().status, 'FAILED')
+        self.daraja.stk_push.assert_not_called()
+
+
+def stk_callback_body(checkout_request_id, result_code=0, receipt='NLJ7RT61SV'):
+    callback = {
+        'MerchantRequestID': '29115-34620561-1',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0 else 'Request cancelled by user',
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 10.0},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': 20191219102115},
+            {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+
+class CallbackTests(TestCase):
+    def setUp(self):
+        self.transaction = MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=10, status='PENDING', checkout_request_id='ws_CO_1',
+        )
+
+    def post_callback(self, body):
+        return self.client.post('/callback/', json.dumps(body), content_type='application/json')
+
+    def test_inline_callback_updates_transaction(self):
+        response = self.post_callback(stk_callback_body('ws_CO_1'))
+        self.assertEqual(response.status_code, 200)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'SUCCESS')
+        self.assertEqual(self.transaction.mpesa_receipt_number, 'NLJ7RT61SV')
+        self.assertEqual(self.transaction.transaction_date.year, 2019)
+        self.assertEqual(self.transaction.callbacks.count(), 1)
+
+    def test_callback_metadata_is_stored_in_columns(self):
+        self.post_callback(stk_callback_body('ws_CO_1'))
+        callback = MpesaCallback.objects.get()
+        self.assertEqual(callback.amount, Decimal('10.00'))
+        self.assertEqual(callback.phone_number, '254712345678')
+        self.assertEqual(callback.mpesa_receipt_number, 'NLJ7RT61SV')
+        self.assertEqual(callback.transaction_date.year, 2019)
+        self.assertIsNone(callback.balance)
+        self.assertEqual(callback.callback_data, stk_callback_body('ws_CO_1'))
+        self.assertEqual(MpesaCallback.objects.filter(phone_number='254712345678').count(), 1)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.paid_amount, Decimal('10.00'))
+        self.assertEqual(self.transaction.paid_phone_number, '254712345678')
+
+    def test_raw_callback_can_be_stored_as_a_file(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+            MPESA_CALLBACK_PAYLOAD_STORAGE='file', MPESA_CALLBACK_PAYLOAD_DIR=directory,
+        ):
+            CallbackInbox.objects.create(body=json.dumps(stk_callback_body('ws_CO_1', result_code=1032)))
+            drain_inbox()
+            callback = MpesaCallback.objects.get()
+            self.assertIsNone(callback.payload)
+            self.assertTrue(os.path.exists(os.path.join(directory, callback.payload_path)))
+            self.assertEqual(callback.callback_data, stk_callback_body('ws_CO_1', result_code=1032))
+            self.assertIsNone(callback.amount)
+
+    def test_redelivered_callback_is_ignored(self):
+        self.post_callback(stk_callback_body('ws_CO_1'))
+        with self.assertNumQueries(1):
+            response = self.post_callback(stk_callback_body('ws_CO_1', receipt='OTHER'))
+        self.assertEqual(response.status_code, 200)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.mpesa_receipt_number, 'NLJ7RT61SV')
+        self.assertEqual(self.transaction.callbacks.count(), 1)
+
+    def test_late_failure_does_not_overwrite_success(self):
+        self.post_callback(stk_callback_body('ws_CO_1'))
+        self.post_callback(stk_callback_body('ws_CO_1', result_code=1032))
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'SUCCESS')
+        self.assertEqual(self.transaction.result_code, '0')
+        self.assertEqual(self.transaction.callbacks.count(), 2)
+
+    def test_drained_duplicates_are_recorded_once(self):
+        body = json.dumps(stk_callback_body('ws_CO_1'))
+        CallbackInbox.objects.bulk_create([CallbackInbox(body=body) for _ in range(3)])
+        self.assertEqual(drain_inbox(), 3)
+        self.assertEqual(MpesaCallback.objects.count(), 1)
+        self.assertEqual(inbox_stats()['depth'], 0)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'SUCCESS')
+
+    def test_queued_callback_is_acknowledged_then_drained(self):
+        with self.settings(MPESA_CALLBACK_MODE='queued'):
+            response = self.post_callback(stk_callback_body('ws_CO_1', result_code=1032))
+        self.assertEqual(response.status_code, 200)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'PENDING')
+        self.assertEqual(inbox_stats()['depth'], 1)
+
+        self.assertEqual(drain_inbox(), 1)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'CANCELLED')
+        self.assertEqual(self.transaction.result_code, '1032')
+        self.assertEqual(MpesaCallback.objects.count(), 1)
+        self.assertEqual(inbox_stats()['depth'], 0)
+
+    def test_queued_non_object_bodies_do_not_block_the_inbox(self):
+        for body in ('[]', '"x"', 'null', '{'):
+            CallbackInbox.objects.create(body=body)
+        CallbackInbox.objects.create(body=json.dumps(stk_callback_body('ws_CO_1')))
+        self.assertEqual(drain_inbox(), 5)
+        self.assertEqual(inbox_stats()['depth'], 0)
+        self.assertEqual(CallbackInbox.objects.exclude(last_error=None).count(), 4)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'SUCCESS')
+
+    def test_queued_callback_for_unknown_transaction_is_retried(self):
+        CallbackInbox.objects.create(body=json.dumps(stk_callback_body('ws_CO_unknown')))
+        drain_inbox()
+        entry = CallbackInbox.objects.get()
+        self.assertIsNone(entry.processed_at)
+        self.assertEqual(entry.attempts, 1)
+        self.assertGreater(entry.available_at, entry.received_at)
+
+
+class QueryCoalescingTests(TestCase):
+    PROCESSING = {'success': True, 'status_code': 500,
+                  'response_data': {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}}
+
+    def setUp(self):
+        cache.clear()
+
+    def test_final_transaction_is_answered_locally(self):
+        MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=10, status='CANCELLED', checkout_request_id='ws_CO_1',
+            result_code='1032', result_desc='Request cancelled by user',
+        )
+        counted = metrics.result_codes.value(source='local', result_code='1032')
+        with mock.patch.object(views, 'query_stk_upstream') as upstream:
+            result = views.query_stk('ws_CO_1')
+        upstream.assert_not_called()
+        self.assertEqual((result['source'], result['status'], result['result_code']), ('local', 'CANCELLED', '1032'))
+        self.assertNotIn('response_data', result)
+        self.assertEqual(metrics.result_codes.value(source='local', result_code='1032'), counted + 1)
+
+        response = self.client.get('/query/ws_CO_1/').json()
+        self.assertEqual((response['source'], response['status']), ('local', 'CANCELLED'))
+
+    def test_concurrent_queries_share_one_upstream_call(self):
+        release = threading.Event()
+
+        def slow_upstream(checkout_request_id):
+            release.wait(1)
+            return self.PROCESSING
+
+        results = []
+        with mock.patch.object(views, 'query_stk_upstream', side_effect=slow_upstream) as upstream:
+            threads = [threading.Thread(target=lambda: results.append(views.query_stk('ws_CO_2'))) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+            # Served from the short-lived cache
+            views.query_stk('ws_CO_2')
+
+        self.assertEqual(upstream.call_count, 1)
+        self.assertEqual(results, [self.PROCESSING] * 5)
+
+    async def test_async_queries_share_one_upstream_call(self):
+        upstream = mock.AsyncMock(return_value=self.PROCESSING)
+        with mock.patch.object(async_views, 'query_stk_upstream', upstream):
+            results = await asyncio.gather(*(async_views.query_stk('ws_CO_3') for _ in range(5)))
+        self.assertEqual(upstream.await_count, 1)
+        self.assertEqual(results, [self.PROCESSING] * 5)
+
+
+class SweepPendingTests(TransactionTestCase):
+    def setUp(self):
+
+        self.now = timezone.now()
+        self.cancelled, self.processing, self.expired, self.fresh = [
+            MpesaTransaction.objects.create(
+                phone_number='254712345678', amount=10, status='PENDING', checkout_request_id=f'ws_CO_{i}',
+            )
+            for i in range(4)
+        ]
+        for transaction, age in [(self.cancelled, 300), (self.processing, 300), (self.expired, 3600), (self.fresh, 10)]:
+            MpesaTransaction.objects.filter(id=transaction.id).update(created_at=self.now - timedelta(seconds=age))
+
+    def fake_query(self, checkout_request_id):
+        if checkout_request_id == 'ws_CO_0':
+            return {'success': True, 'response_data': {'ResultCode': '1032', 'ResultDesc': 'Request cancelled by user'}}
+        return {'success': True, 'response_data': {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}}
+
+    def test_stale_transactions_are_resolved_or_timed_out(self):
+        with mock.patch.object(sweeper, 'query_stk', side_effect=self.fake_query) as query:
+            counts = sweeper.sweep_pending(older_than=120, timeout_after=900, rate=0)
+
+        self.assertEqual(query.call_count, 3)
+        self.assertEqual(counts, {'CANCELLED': 1, 'TIMEOUT': 1})
+        statuses = dict(MpesaTransaction.objects.values_list('checkout_request_id', 'status'))
+        self.assertEqual(statuses, {'ws_CO_0': 'CANCELLED', 'ws_CO_1': 'PENDING', 'ws_CO_2': 'TIMEOUT', 'ws_CO_3': 'PENDING'})
+
+    def test_callback_settled_during_sweep_is_not_overwritten(self):
+        def query(checkout_request_id):
+            MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id).update(status='SUCCESS')
+            return self.fake_query(checkout_request_id)
+
+        with mock.patch.object(sweeper, 'query_stk', side_effect=query):
+            counts = sweeper.sweep_pending(older_than=120, timeout_after=900, max_workers=1, rate=0)
+
+        self.assertEqual(counts, {})
+        self.assertEqual(MpesaTransaction.objects.filter(status='SUCCESS').count(), 3)
+
+    def test_daraja_errors_leave_transactions_pending(self):
+        for status_code, error_code, message in [
+            (500, '500.003.02', 'System is busy. Please try again in few minutes.'),
+            (503, '503.001.01', 'Service Unavailable'),
+            (401, '404.001.03', 'Invalid Access Token'),
+        ]:
+            answer = {'success': True, 'status_code': status_code,
+                      'response_data': {'errorCode': error_code, 'errorMessage': message}}
+            with self.subTest(status_code=status_code), mock.patch.object(sweeper, 'query_stk', return_value=answer):
+                self.assertEqual(sweeper.sweep_pending(older_than=120, timeout_after=900, rate=0), {})
+        self.assertFalse(MpesaTransaction.objects.exclude(status='PENDING').exists())
+
+    def test_failed_query_leaves_transaction_for_a_late_callback(self):
+        failure = {'success': False, 'error': 'Network error: Read timed out'}
+        with mock.patch.object(sweeper, 'query_stk', return_value=failure):
+            counts = sweeper.sweep_pending(older_than=120, timeout_after=900, rate=0)
+        self.assertEqual(counts, {})
+
+        self.client.post('/callback/', json.dumps(stk_callback_body('ws_CO_2')), content_type='application/json')
+        self.expired.refresh_from_db()
+        self.assertEqual(self.expired.status, 'SUCCESS')
+
+
+class TransactionEventsTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.transaction = MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=10, status='PENDING', checkout_request_id='ws_CO_1',
+        )
+
+    def test_callback_publishes_update(self):
+        self.client.post('/callback/', json.dumps(stk_callback_body('ws_CO_1')), content_type='application/json')
+        self.assertEqual(pubsub.current_version(self.transaction.id), 1)
+
+    def test_waiter_is_woken_by_publish(self):
+        threading.Timer(0.05, pubsub.publish, args=[self.transaction.id]).start()
+        started = time.monotonic()
+        self.assertEqual(pubsub.wait_for_update(self.transaction.id, 0, timeout=5), 1)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_stream_ends_on_final_status(self):
+        MpesaTransaction.objects.filter(id=self.transaction.id).update(status='SUCCESS')
+        response = self.client.get(f'/transaction/{self.transaction.id}/events/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = b''.join(response.streaming_content).decode()
+        self.assertIn('event: status', events)
+        self.assertIn('"status": "SUCCESS"', events)
+
+    def test_stream_sends_changes(self):
+        def settle():
+            MpesaTransaction.objects.filter(id=self.transaction.id).update(status='FAILED')
+            pubsub.publish(self.transaction.id)
+
+        threading.Timer(0.05, settle).start()
+        response = self.client.get(f'/transaction/{self.transaction.id}/events/')
+        events = b''.join(response.streaming_content).decode()
+        self.assertEqual(events.count('event: status'), 2)
+        self.assertIn('"status": "FAILED"', events)
+
+    @override_settings(MPESA_SSE_MAX_SECONDS=2)
+    def test_update_published_before_streaming_is_not_missed(self):
+        response = self.client.get(f'/transaction/{self.transaction.id}/events/')
+        MpesaTransaction.objects.filter(id=self.transaction.id).update(status='FAILED')
+        pubsub.publish(self.transaction.id)
+        started = time.monotonic()
+        events = b''.join(response.streaming_content).decode()
+        self.assertIn('"status": "FAILED"', events)
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class AsyncEventsUrls:
+    urlpatterns = [path('transaction/<uuid:transaction_id>/events/', async_views.transaction_events)]
+
+
+@override_settings(ROOT_URLCONF=AsyncEventsUrls, MPESA_SSE_MAX_SECONDS=3)
+class AsyncTransactionEventsTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.transaction = MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=10, status='PENDING', checkout_request_id='ws_CO_1',
+        )
+
+    def test_asgi_stream_sends_each_event_as_it_happens(self):
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': f'/transaction/{self.transaction.id}/events/',
+            'query_string': b'', 'headers': [(b'host', b'testserver')], 'asgi': {'version': '3.0'},
+        }
+        events = []
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            requested = False
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await asyncio.Future()  # The client stays connected
+
+            async def send(message):
+                body = message.get('body', b'')
+                if b'event: status' in body:
+                    events.append((loop.time() - started, body.decode()))
+                    if len(events) == 1:
+                        await sync_to_async(self.settle)()
+
+            await ASGIHandler()(scope, receive, send)
+
+        asyncio.run(run())
+        self.assertEqual(len(events), 2)
+        self.assertIn('"status": "PENDING"', events[0][1])
+        self.assertIn('"status": "FAILED"', events[1][1])
+        self.assertLess(events[1][0], 2)
+
+    def settle(self):
+        MpesaTransaction.objects.filter(id=self.transaction.id).update(status='FAILED')
+        pubsub.publish(self.transaction.id)
+
+
+class TransactionStatusTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.transaction = MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=10, status='PENDING', checkout_request_id='ws_CO_1',
+        )
+        self.url = f'/transaction/{self.transaction.id}/status/'
+
+    def test_status_is_cached_and_supports_etags(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['status'], 'PENDING')
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_callback_invalidates_cached_status(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/callback/', json.dumps(stk_callback_body('ws_CO_1')), content_type='application/json')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'SUCCESS')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_unknown_transaction_is_404(self):
+        response = self.client.get(f'/transaction/{uuid.uuid4()}/status/')
+        self.assertEqual(response.status_code, 404)
+
+
+class TransactionHistoryTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.user = User.objects.create_user('merchant', password='secret')
+        MpesaTransaction.objects.bulk_create([
+            MpesaTransaction(user=self.user, phone_number='254712345678', amount=i + 1, status='SUCCESS')
+            for i in range(5)
+        ])
+        self.client.force_login(self.user)
+
+    def test_cursor_pages_cover_every_transaction_once(self):
+        seen, cursor = [], None
+        while True:
+            params = {'limit': 2, **({'cursor': cursor} if cursor else {})}
+            data = self.client.get('/transactions/', params).json()
+            seen.extend(t['id'] for t in data['transactions'])
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        expected = MpesaTransaction.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        self.assertEqual(seen, [str(pk) for pk in expected])
+
+    def test_invalid_cursor_is_400(self):
+        response = self.client.get('/transactions/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_ndjson_and_csv_exports_stream_all_rows(self):
+        response = self.client.get('/transactions/', {'format': 'ndjson'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])['status'], 'SUCCESS')
+
+        response = self.client.get('/transactions/', {'format': 'csv'})
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(rows[0].split(',')[0], 'id')
+        self.assertEqual(len(rows), 6)
+
+
+class MetricsTests(TestCase):
+    def test_stk_push_stages_and_result_codes_are_exposed(self):
+        daraja = mock.Mock()
+        daraja.stk_push.return_value = mock.Mock(status_code=200, json=lambda: STK_PUSH_ACCEPTED)
+        pushes = metrics.stage_seconds.count(operation='process_stk_push', stage='daraja')
+
+        with mock.patch.object(views, 'get_client', return_value=daraja), \
+                mock.patch.object(views, 'generate_access_token', return_value='token'):
+            views.process_stk_push('254712345678', 10)
+
+        self.assertEqual(metrics.stage_seconds.count(operation='process_stk_push', stage='daraja'), pushes + 1)
+        body = self.client.get('/metrics/').content.decode()
+        self.assertIn('mpesa_stage_seconds_bucket{operation="process_stk_push",stage="db_insert",le="+Inf"}', body)
+        self.assertIn('mpesa_result_codes_total{source="stk_push",result_code="0"}', body)
+        self.assertIn('mpesa_pending_transactions 1', body)
+        self.assertIn('mpesa_callback_inbox_lag_seconds 0.0', body)
+        self.assertIn('mpesa_stk_outbox_lag_seconds 0.0', body)
+        self.assertIn('# TYPE mpesa_coalesced_queries_total counter', body)
+        self.assertIn('# TYPE mpesa_token_cache_events_total counter', body)
+
+    def test_metrics_token_is_required_when_configured(self):
+        with self.settings(MPESA_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics/').status_code, 401)
+            response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+class IdempotentStkPushTests(TestCase):
+    def setUp(self):
+        self.daraja = mock.Mock()
+        self.daraja.stk_push.return_value = mock.Mock(status_code=200, json=lambda: STK_PUSH_ACCEPTED)
+        patches = [
+            mock.patch.object(views, 'get_client', return_value=self.daraja),
+            mock.patch.object(views, 'generate_access_token', return_value='token'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def push(self, key, amount=10):
+        return self.client.post(
+            '/stk-push/', {'phone_number': '0712345678', 'amount': amount},
+            content_type='application/json', HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_repeated_key_returns_original_result_without_calling_daraja(self):
+        first = self.push('order-1').json()
+        second = self.push('order-1').json()
+
+        self.assertEqual(self.daraja.stk_push.call_count, 1)
+        self.assertEqual(MpesaTransaction.objects.count(), 1)
+        self.assertEqual(second['transaction_id'], first['transaction_id'])
+        self.assertEqual(second['checkout_request_id'], first['checkout_request_id'])
+        self.assertTrue(second['idempotent_replay'])
+
+    def test_key_reused_for_a_different_payment_is_rejected(self):
+        self.push('order-2')
+        self.assertEqual(self.push('order-2', amount=20).status_code, 422)
+
+    def test_expired_key_starts_a_new_payment(self):
+        self.push('order-3')
+        with self.settings(MPESA_IDEMPOTENCY_WINDOW=-1):
+            self.push('order-3')
+        self.assertEqual(self.daraja.stk_push.call_count, 2)
+        self.assertEqual(MpesaTransaction.objects.filter(idempotency_key__isnull=False).count(), 1)
+
+    def test_key_can_be_retried_after_a_network_error(self):
+        self.daraja.stk_push.side_effect = [requests.exceptions.ReadTimeout('timed out'), self.daraja.stk_push.return_value]
+        first = self.push('order-4').json()
+        self.assertFalse(first['success'])
+        self.assertEqual(MpesaTransaction.objects.get(id=first['transaction_id']).status, 'FAILED')
+
+        second = self.push('order-4')
+        self.assertEqual(second.status_code, 200)
+        self.assertTrue(second.json()['success'])
+        self.assertEqual(self.daraja.stk_push.call_count, 2)
+        self.assertEqual(MpesaTransaction.objects.get(idempotency_key__endswith=':order-4').status, 'PENDING')
+
+
+@override_settings(MPESA_CIRCUIT_MIN_CALLS=4, MPESA_CIRCUIT_FAILURE_RATIO=0.5, MPESA_CIRCUIT_COOLDOWN=30)
+class ResilienceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker('test')
+
+    def test_breaker_opens_on_failures_and_closes_after_successful_probe(self):
+        for ok in (True, False, False, False):
+            self.breaker.allow()
+            self.breaker.record(ok)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.allow()
+
+        with mock.patch('mpesa.resilience.time.time', return_value=time.time() + 31):
+            self.assertTrue(self.breaker.allow())
+            with self.assertRaises(CircuitOpen):
+                self.breaker.allow()  # Only one probe at a time
+            self.breaker.record(True, probe=True)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.state()['state'], CircuitBreaker.CLOSED)
+
+    @override_settings(MPESA_RATE_LIMITS={'stk_push': 2}, MPESA_RATE_LIMIT_MAX_WAIT=0)
+    def test_rate_limiter_refuses_calls_over_the_limit(self):
+        limiter = RateLimiter(prefix='test:ratelimit')
+        with mock.patch('mpesa.resilience.time.time', return_value=1000.5):
+            limiter.acquire('stk_push')
+            limiter.acquire('stk_push')
+            with self.assertRaises(RateLimited):
+                limiter.acquire('stk_push')
+            limiter.acquire('stk_query')  # No limit configured
+            self.assertEqual(limiter.usage(), {'stk_push': 3})
+
+    def test_stk_push_fails_fast_while_circuit_is_open(self):
+        daraja = DarajaClient(base_url='http://daraja.test/', backoff=0, breaker=self.breaker)
+        self.breaker._open(cache)
+        with mock.patch.object(views, 'get_client', return_value=daraja), \
+                mock.patch.object(views, 'generate_access_token', return_value='token'), \
+                mock.patch.object(daraja.session, 'request') as request:
+            result = views.process_stk_push('254712345678', 10)
+
+        request.assert_not_called()
+        self.assertEqual(result['error_code'], 'CB_OPEN')
+        transaction = MpesaTransaction.objects.get(id=result['transaction_id'])
+        self.assertEqual((transaction.status, transaction.result_code), ('FAILED', 'CB_OPEN'))
+
+    def test_keyed_push_refused_by_open_circuit_can_be_retried(self):
+        daraja = DarajaClient(base_url='http://daraja.test/', backoff=0, breaker=self.breaker)
+        self.breaker._open(cache)
+        with mock.patch.object(views, 'get_client', return_value=daraja), \
+                mock.patch.object(views, 'generate_access_token', return_value='token'):
+            refused = views.process_stk_push('254712345678', 10, idempotency_key='order-1')
+        self.assertEqual(refused['error_code'], 'CB_OPEN')
+
+        # The circuit has closed again
+        cache.clear()
+        with mock.patch.object(views, 'get_client', return_value=daraja), \
+                mock.patch.object(views, 'generate_access_token', return_value='token'), \
+                mock.patch.object(daraja.session, 'request', return_value=fake_response(200, STK_PUSH_ACCEPTED)):
+            result = views.process_stk_push('254712345678', 10, idempotency_key='order-1')
+
+        self.assertTrue(result['success'])
+        self.assertNotIn('idempotent_replay', result)
+        self.assertEqual(MpesaTransaction.objects.get(idempotency_key='anon:order-1').status, 'PENDING')
+
+
+class TransactionRollupTests(TestCase):
+    def settle(self, status, amount, reference='SHOP', created_at='2025-01-01T10:15:00Z'):
+        transaction = MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=amount, status=status, account_reference=reference,
+        )
+        MpesaTransaction.objects.filter(id=transaction.id).update(created_at=created_at)
+        return transaction
+
+    def test_settled_transactions_are_counted_once(self):
+        ids = [
+            self.settle('SUCCESS', 100).id,
+            self.settle('SUCCESS', 50, created_at='2025-01-01T11:00:00Z').id,
+            self.settle('CANCELLED', 20).id,
+            self.settle('PENDING', 10).id,
+        ]
+        self.assertEqual(rollups.roll_up(ids), 3)
+        self.assertEqual(rollups.roll_up(ids), 0)
+
+        start, end = rollups.parse_bound('2025-01-01'), rollups.parse_bound('2025-01-02')
+        [day] = rollups.summarize('day', start, end)
+        self.assertEqual((day['count'], day['success_count'], day['success_amount']), (3, 2, '150.00'))
+        self.assertEqual(day['success_rate'], 0.6667)
+        self.assertEqual(len(rollups.summarize('hour', start, end)), 2)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        for status, amount, reference in [('SUCCESS', 100, 'A'), ('SUCCESS', 30, 'B'), ('FAILED', 10, 'A')]:
+            self.settle(status, amount, reference)
+        rollups.roll_up()
+        incremental = set(TransactionRollup.objects.values_list(
+            'period', 'period_start', 'status', 'merchant_code', 'account_reference', 'count', 'amount'))
+
+        chunks = list(rollups.rebuild_rollups(end=rollups.parse_bound('2025-01-03')))
+        self.assertEqual([count for _, _, count in chunks], [3, 0])
+        rebuilt = set(TransactionRollup.objects.values_list(
+            'period', 'period_start', 'status', 'merchant_code', 'account_reference', 'count', 'amount'))
+        self.assertEqual(rebuilt, incremental)
+
+    def test_callback_settlement_updates_rollups(self):
+        MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=10, status='PENDING', checkout_request_id='ws_CO_1',
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            views.process_callback(stk_callback_body('ws_CO_1'))
+        rollup = TransactionRollup.objects.get(period='day')
+        self.assertEqual((rollup.status, rollup.count, rollup.amount), ('SUCCESS', 1, 10))
+
+    def test_report_is_staff_only(self):
+        self.settle('SUCCESS', 100)
+        rollups.roll_up()
+        from django.contrib.auth.models import User
+        user = User.objects.create_user('finance')
+        self.client.force_login(user)
+        params = {'period': 'day', 'start': '2025-01-01', 'end': '2025-01-08'}
+        self.assertEqual(self.client.get('/reports/rollups/', params).status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        response = self.client.get('/reports/rollups/', params)
+        self.assertEqual(response.json()['results'][0]['success_amount'], '100.00')
+        self.assertEqual(self.client.get('/reports/rollups/', {'period': 'week'}).status_code, 400)
+
+
+class ArchiveTests(TestCase):
+    def make(self, status='SUCCESS', days_old=200, rolled_up=True, checkout_request_id=None):
+        transaction = MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=10, status=status, result_code='0',
+            checkout_request_id=checkout_request_id,
+        )
+        MpesaTransaction.objects.filter(id=transaction.id).update(
+            created_at=timezone.now() - timedelta(days=days_old),
+            rolled_up_at=timezone.now() if rolled_up else None,
+        )
+        return transaction
+
+    def test_settled_old_transactions_move_with_their_callbacks(self):
+        archived = self.make(checkout_request_id='ws_CO_1')
+        MpesaCallback.objects.create(
+            transaction=archived, merchant_request_id='1', checkout_request_id='ws_CO_1',
+            result_code='0', result_desc='ok', callback_data=stk_callback_body('ws_CO_1'),
+        )
+        kept = [self.make(status='PENDING'), self.make(days_old=1), self.make(rolled_up=False)]
+
+        export = io.StringIO()
+        self.assertEqual(sum(archive.archive_transactions(older_than_days=180, export=export)), 1)
+        self.assertEqual(set(MpesaTransaction.objects.values_list('id', flat=True)), {t.id for t in kept})
+        self.assertFalse(MpesaCallback.objects.exists())
+
+        row = ArchivedTransaction.objects.get(id=archived.id)
+        self.assertEqual(row.callback_records[0]['callback_data'], stk_callback_body('ws_CO_1'))
+        self.assertEqual(json.loads(export.getvalue())['id'], str(archived.id))
+
+        # Lookups fall back to the archive
+        response = self.client.get(f'/transaction/{archived.id}/status/')
+        self.assertEqual(response.json()['status'], 'SUCCESS')
+        self.assertEqual(coalesce.find_transaction('ws_CO_1').pk, archived.id)
+
+    def test_rebuilt_rollups_include_archived_transactions(self):
+        self.make()
+        self.make(days_old=1)
+        list(archive.archive_transactions(older_than_days=180))
+        counted = sum(count for _, _, count in rollups.rebuild_rollups())
+        self.assertEqual(counted, 2)
+        self.assertEqual(sum(TransactionRollup.objects.filter(period='day').values_list('count', flat=True)), 2)
+
+
+STATEMENT = """Receipt No.,Completion Time,Transaction Status,Paid In,Withdrawn,Other Party Info
+RCP0000001,01-01-2025 10:00:05,Completed,100.00,,254712345671 - JANE DOE
+RCP0000002,01-01-2025 10:03:00,Completed,50.00,,254712345672 - JOHN DOE
+RCP0000003,01-01-2025 11:00:00,Completed,75.00,,254712345673 - MARY DOE
+RCP0000004,01-01-2025 12:00:00,Completed,"1,000.00",,254712345674 - PAUL DOE
+RCP0000005,01-01-2025 12:30:00,Failed,20.00,,254712345675 - ANN DOE
+"""
+
+
+class ReconcileStatementTests(TestCase):
+    def make(self, phone, amount, status='SUCCESS', receipt=None, created_at='2025-01-01T07:00:00Z'):
+        transaction = MpesaTransaction.objects.create(
+            phone_number=phone, amount=amount, status=status, mpesa_receipt_number=receipt,
+        )
+        MpesaTransaction.objects.filter(id=transaction.id).update(created_at=created_at)
+        return transaction
+
+    def reconcile(self, apply=False):
+        report = io.StringIO()
+        counts = reconcile.reconcile_statement(io.StringIO(STATEMENT), report, apply=apply)
+        rows = list(csv.DictReader(io.StringIO(report.getvalue())))
+        return counts, {row['receipt']: row['kind'] for row in rows}
+
+    def setUp(self):
+        self.make('254712345671', 100, receipt='RCP0000001')
+        self.unsettled = self.make('254712345672', 50, status='TIMEOUT', created_at='2025-01-01T07:02:00Z')
+        self.make('254712345674', 100, receipt='RCP0000004', created_at='2025-01-01T09:00:00Z')
+        self.make('254712345679', 30, receipt='RCPLOCAL01', created_at='2025-01-01T10:00:00Z')
+
+    def test_report_lists_each_kind_of_discrepancy(self):
+        counts, kinds = self.reconcile()
+        self.assertEqual(kinds, {
+            'RCP0000002': 'unsettled',
+            'RCP0000003': 'missing',
+            'RCP0000004': 'mismatched',
+            'RCPLOCAL01': 'extra',
+        })
+        self.assertEqual((counts['statement_rows'], counts['matched'], counts['corrected']), (4, 1, 0))
+        self.assertEqual(MpesaTransaction.objects.get(id=self.unsettled.id).status, 'TIMEOUT')
+
+    def test_apply_settles_transactions_paid_on_the_statement(self):
+        counts, _ = self.reconcile(apply=True)
+        self.assertEqual(counts['corrected'], 1)
+        transaction = MpesaTransaction.objects.get(id=self.unsettled.id)
+        self.assertEqual((transaction.status, transaction.mpesa_receipt_number), ('SUCCESS', 'RCP0000002'))
+        self.assertTrue(TransactionRollup.objects.filter(period='day', status='SUCCESS').exists())
+
+
+class LargeTableAdminTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_superuser('admin', password='secret'))
+
+    def add_callbacks(self, count):
+        for _ in range(count):
+            checkout_request_id = f'ws_CO_{uuid.uuid4().hex}'
+            transaction = MpesaTransaction.objects.create(
+                phone_number='254712345678', amount=10, checkout_request_id=checkout_request_id,
+            )
+            MpesaCallback.objects.create(
+                transaction=transaction, merchant_request_id='1', checkout_request_id=checkout_request_id,
+                result_code='0', result_desc='ok', callback_data=stk_callback_body(checkout_request_id),
+            )
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return [query['sql'] for query in queries]
+
+    def test_callback_changelist_query_count_does_not_grow_with_rows(self):
+        self.add_callbacks(2)
+        few = self.changelist_queries('/admin/mpesa/mpesacallback/')
+        self.add_callbacks(5)
+        many = self.changelist_queries('/admin/mpesa/mpesacallback/')
+        self.assertEqual(len(few), len(many))
+        self.assertFalse(any('"payload"' in sql for sql in many))
+
+    def test_counts_stop_at_the_limit(self):
+        self.add_callbacks(3)
+        with self.settings(MPESA_ADMIN_COUNT_LIMIT=2):
+            paginator = EstimatedCountPaginator(MpesaTransaction.objects.all(), 1)
+            self.assertEqual(paginator.count, 2)
+        self.assertEqual(EstimatedCountPaginator(MpesaTransaction.objects.all(), 1).count, 3)
+
+    def test_date_hierarchy_matches_distinct_dates(self):
+        self.add_callbacks(3)
+        for days in (40, 400):
+            MpesaTransaction.objects.filter(pk=MpesaTransaction.objects.first().pk).update(
+                created_at=timezone.now() - timedelta(days=days))
+        queryset = admin.site._registry[MpesaTransaction].get_queryset(None)
+        for kind in ('year', 'month', 'day'):
+            self.assertEqual(list(queryset.datetimes('created_at', kind)),
+                             list(MpesaTransaction.objects.datetimes('created_at', kind)))
+        for url in [
+            '/admin/mpesa/mpesatransaction/',
+            f'/admin/mpesa/mpesatransaction/?created_at__year={timezone.now().year}',
+            '/admin/mpesa/archivedtransaction/',
+            '/admin/mpesa/callbackinbox/',
+        ]:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class TransactionSearchTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_superuser('admin', password='secret'))
+        self.first = MpesaTransaction.objects.create(
+            phone_number='254712345678', amount=10, status='SUCCESS', mpesa_receipt_number='QKA1B2C3D4',
+        )
+        MpesaTransaction.objects.bulk_create([
+            MpesaTransaction(phone_number='254722005678', amount=20, account_reference='INV-7'),
+            MpesaTransaction(phone_number='254733000001', amount=30),
+        ])
+
+    def phones(self, term=None, **params):
+        queryset = search.search_transactions(MpesaTransaction.objects.all(), term, **params)
+        return sorted(queryset.values_list('phone_number', flat=True))
+
+    def test_phone_lookups(self):
+        self.assertEqual(self.phones('0712 345 678'), ['254712345678'])
+        self.assertEqual(self.phones('+254 799'), [])
+        self.assertEqual(self.phones('0712'), ['254712345678'])
+        self.assertEqual(self.phones('*5678'), ['254712345678', '254722005678'])
+        self.assertEqual(self.phones('3000001'), ['254733000001'])
+        self.assertEqual(self.phones(phone_prefix='0722'), ['254722005678'])
+        for too_short in ('*78', '07'):
+            with self.assertRaises(search.SearchError):
+                self.phones(too_short)
+
+    def test_receipt_and_reference_lookups(self):
+        self.assertEqual(self.phones('qka1b2c3d4'), ['254712345678'])
+        self.assertEqual(self.phones('INV-7'), ['254722005678'])
+        self.assertEqual(self.phones(receipt='QKA1B2C3D4', phone_suffix='999'), [])
+
+    def test_suffix_search_uses_the_reversed_column(self):
+        MpesaTransaction.objects.filter(id=self.first.id).update(phone_number='254700000000')
+        self.first.save()
+        self.assertEqual(MpesaTransaction.objects.get(id=self.first.id).phone_reversed, '876543217452')
+        query = str(search.search_transactions(MpesaTransaction.objects.all(), '*5678').query)
+        self.assertIn('phone_reversed', query)
+        self.assertNotIn('LIKE', query)
+
+    def test_search_endpoint_and_admin(self):
+        response = self.client.get('/transactions/search/', {'q': '*5678', 'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['transactions']), 1)
+        response = self.client.get('/transactions/search/', {'q': '*5678', 'cursor': data['next_cursor']})
+        self.assertEqual(len(response.json()['transactions']), 1)
+        self.assertEqual(self.client.get('/transactions/search/').status_code, 400)
+        response = self.client.get('/admin/mpesa/mpesatransaction/', {'q': 'QKA1B2C3D4'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertEqual(self.client.get('/transactions/search/', {'q': '*5678', 'limit': 'x'}).status_code, 400)
+
+    def test_archive_admin_searches_from_the_indexes(self):
+        MpesaTransaction.objects.filter(id=self.first.id).update(
+            created_at=timezone.now() - timedelta(days=200), rolled_up_at=timezone.now(),
+        )
+        list(archive.archive_transactions(older_than_days=180))
+        self.assertEqual(ArchivedTransaction.objects.get().phone_reversed, '876543217452')
+        for term in ('*5678', '0712', str(self.first.id)):
+            with self.subTest(term=term):
+                response = self.client.get('/admin/mpesa/archivedtransaction/', {'q': term})
+                self.assertEqual(response.context['cl'].result_count, 1)
+
+
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_superuser('admin', password='secret'))
+        profiling.stats.reset()
+
+    def test_disabled_by_default(self):
+        from django.core.exceptions import MiddlewareNotUsed
+        with self.assertRaises(MiddlewareNotUsed):
+            profiling.ProfilingMiddleware(lambda request: None)
+        self.assertEqual(self.client.get('/reports/profile/').status_code, 404)
+
+    @override_settings(MPESA_PROFILING=True, MPESA_PROFILE_SAMPLE_RATE=1.0, MPESA_PROFILE_SLOW_SECONDS=0)
+    def test_records_queries_upstream_calls_and_slow_profiles(self):
+        real_after_cursor = views.after_cursor
+
+        def after_cursor_with_daraja_call(queryset, cursor):
+            from .client import _observe
+            _observe('/mpesa/stkpushquery/v1/query', time.perf_counter(), '200')
+            return real_after_cursor(queryset, cursor)
+
+        with mock.patch.object(views, 'after_cursor', after_cursor_with_daraja_call):
+            self.client.get('/transactions/')
+        self.assertEqual(self.client.get('/transactions/').status_code, 200)
+
+        data = self.client.get('/reports/profile/', {'profiles': 1}).json()
+        row = next(row for row in data['views'] if row['view'] == 'mpesa:transaction_history')
+        self.assertEqual(row['requests'], 2)
+        self.assertGreater(row['avg_queries'], 0)
+        self.assertEqual(row['avg_http_calls'], 0.5)
+        self.assertIn('function calls', data['slow_requests'][0]['profile'])
+        self.assertIsNone(profiling._current.get())
+
+
+class MerchantRoutingTests(TestCase):
+    def setUp(self):
+        self.addCleanup(merchants.registry.invalidate)
+        self.till = self.add_merchant('till', '174379', is_default=True)
+        self.paybill = self.add_merchant(
+            'paybill', '600100', party_b='', transaction_type='CustomerPayBillOnline', account_reference='ACC',
+        )
+        self.daraja = mock.Mock()
+        self.daraja.stk_push.return_value = mock.Mock(status_code=200, json=lambda: STK_PUSH_ACCEPTED)
+
+    def add_merchant(self, code, shortcode, **fields):
+        fields.setdefault('party_b', '9000' + shortcode[-2:])
+        return Merchant.objects.create(
+            code=code, name=code.title(), shortcode=shortcode, consumer_key=f'{code}-key',
+            consumer_secret=f'{code}-secret', passkey=f'{code}-pass', callback_url=f'https://example.com/callback/{code}/',
+            **fields,
+        )
+
+    def push(self, **data):
+        with mock.patch.object(views, 'get_client', return_value=self.daraja) as get_client, \
+                mock.patch.object(views, 'generate_access_token', return_value='token') as token:
+            response = self.client.post(
+                '/stk-push/', {'phone_number': '0712345678', 'amount': 10, **data}, content_type='application/json',
+            )
+        return response, get_client.call_args.args[0] if get_client.called else None, token
+
+    def test_push_is_sent_with_the_named_merchants_settings(self):
+        response, route, token = self.push(merchant='paybill')
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(route.code, 'paybill')
+        token.assert_called_once_with(route)
+        body = self.daraja.stk_push.call_args.args[0]
+        self.assertEqual(
+            (body['BusinessShortCode'], body['PartyB'], body['TransactionType'], body['AccountReference']),
+            ('600100', '600100', 'CustomerPayBillOnline', 'ACC'),
+        )
+        self.assertEqual(body['CallBackURL'], 'https://example.com/callback/paybill/')
+        self.assertEqual(MpesaTransaction.objects.get().merchant, self.paybill)
+
+        _, route, _ = self.push()
+        self.assertEqual(route.code, 'till')
+        self.assertEqual(self.push(merchant='nope')[0].status_code, 400)
+
+    def test_rollups_are_kept_per_merchant_and_sent_reference(self):
+        self.push(merchant='paybill')
+        self.push()
+        MpesaTransaction.objects.update(status='SUCCESS')
+        self.assertEqual(
+            set(MpesaTransaction.objects.values_list('merchant__code', 'account_reference')),
+            {('paybill', 'ACC'), ('till', '')},
+        )
+        rollups.roll_up()
+        self.assertEqual(
+            set(TransactionRollup.objects.filter(period='day').values_list('merchant_code', 'account_reference', 'count')),
+            {('paybill', 'ACC', 1), ('till', '', 1)},
+        )
+        day = timezone.now()
+        [row] = rollups.summarize('day', day - timedelta(days=1), day + timedelta(days=1), merchant_code='paybill')
+        self.assertEqual(row['success_amount'], '10.00')
+
+    def test_routes_keep_their_pools_until_the_merchant_changes(self):
+        till, paybill = merchants.get_merchant('till'), merchants.get_merchant('paybill')
+        self.assertNotEqual(till.token_manager.cache_key, paybill.token_manager.cache_key)
+        self.assertIsNot(till.client, paybill.client)
+        self.assertIs(merchants.get_merchant('till'), till)
+        with self.assertNumQueries(0):
+            self.assertIs(merchants.merchant_for_id(self.paybill.id), paybill)
+
+        self.paybill.shortcode = '600200'
+        self.paybill.save()
+        self.assertIs(merchants.get_merchant('till'), till)
+        self.assertEqual(merchants.get_merchant('paybill').shortcode, '600200')
+
+        self.till.is_default = False
+        self.till.save()
+        self.assertEqual(merchants.get_merchant().code, merchants.DEFAULT_CODE)
+
+    def test_callback_url_only_settles_its_merchants_transactions(self):
+        MpesaTransaction.objects.create(
+            merchant=self.till, phone_number='254712345678', amount=10, status='PENDING', checkout_request_id='ws_CO_1',
+        )
+        body = json.dumps(stk_callback_body('ws_CO_1'))
+        self.assertEqual(self.client.post('/callback/paybill/', body, content_type='application/json').status_code, 404)
+        self.assertEqual(self.client.post('/callback/other/', body, content_type='application/json').status_code, 404)
+        self.assertEqual(MpesaTransaction.objects.get().status, 'PENDING')
+        self.assertEqual(self.client.post('/callback/till/', body, content_type='application/json').status_code, 200)
+        self.assertEqual(MpesaTransaction.objects.get().status, 'SUCCESS')
+
+    @override_settings(MPESA_CALLBACK_MODE='queued')
+    def test_queued_callback_only_settles_its_merchants_transactions(self):
+        MpesaTransaction.objects.create(
+            merchant=self.till, phone_number='254712345678', amount=10, status='PENDING', checkout_request_id='ws_CO_1',
+        )
+        body = json.dumps(stk_callback_body('ws_CO_1'))
+        self.assertEqual(self.client.post('/callback/paybill/', body, content_type='application/json').status_code, 200)
+        self.assertEqual(drain_inbox(), 1)
+        self.assertEqual(MpesaTransaction.objects.get().status, 'PENDING')
+        self.assertIn('paybill', CallbackInbox.objects.get().last_error)
+        self.assertFalse(MpesaCallback.objects.exists())
+
+        self.client.post('/callback/till/', body, content_type='application/json')
+        self.assertEqual(drain_inbox(), 1)
+        self.assertEqual(MpesaTransaction.objects.get().status, 'SUCCESS')
@@ -0,0 +1,171 @@
+"""Process-wide cache for M-Pesa OAuth access tokens.
+
+Daraja tokens are valid for an hour, so fetching a new one before every
+API call is wasted round trips. ``AccessTokenManager`` keeps the current
+token in memory, shares it with other workers through the Django cache and
+refreshes it in the background shortly before it expires. Refreshes are
+single-flight: concurrent callers in one process wait on a lock and callers
+in other processes wait on a short-lived cache lock.
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class AccessTokenManager:
+    """Cache an OAuth token until shortly before it expires
+
+    ``fetch`` is a callable returning ``(access_token, expires_in_seconds)``
+    and raising on failure.
+    """
+
+    def __init__(self, fetch, cache_alias='default', cache_key='mpesa:oauth:token',
+                 refresh_margin=300, lock_timeout=30, wait_timeout=10, poll_interval=0.1):
+        self._fetch = fetch
+        self.cache_alias = cache_alias
+        self.cache_key = cache_key
+        self.lock_key = f'{cache_key}:lock'
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._flag_lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._background_refresh = False
+        self._stats = {
+            'hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'background_refreshes': 0,
+            'failures': 0,
+        }
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_token(self):
+        """Return a valid access token, fetching one only when necessary"""
+        now = time.time()
+        token, expires_at = self._token, self._expires_at
+
+        if token and now < expires_at:
+            self._count('hits')
+            if now >= expires_at - self.refresh_margin:
+                self._schedule_refresh()
+            return token
+
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            now = time.time()
+            if self._token and now < self._expires_at:
+                self._count('hits')
+                return self._token
+
+            if self._load_shared(now):
+                self._count('shared_hits')
+                return self._token
+
+            self._count('misses')
+            return self._refresh()
+
+    def peek(self):
+        """Return the in-memory token if it is still valid, without blocking"""
+        if self._token and time.time() < self._expires_at:
+            self._count('hits')
+            return self._token
+        return None
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after Daraja rejects it"""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+            self.cache.delete(self.cache_key)
+
+    def stats(self):
+        """Return a snapshot of the hit/miss/refresh counters"""
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        snapshot['expires_in'] = max(0, int(self._expires_at - time.time())) if self._token else 0
+        return snapshot
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _load_shared(self, now):
+        entry = self.cache.get(self.cache_key)
+        if not entry or now >= entry['expires_at']:
+            return False
+        self._token, self._expires_at = entry['token'], entry['expires_at']
+        return True
+
+    def _store(self, token, expires_in):
+        expires_at = time.time() + int(expires_in)
+        self._token, self._expires_at = token, expires_at
+        self.cache.set(
+            self.cache_key,
+            {'token': token, 'expires_at': expires_at},
+            timeout=max(1, int(expires_in)),
+        )
+
+    def _refresh(self):
+        """Fetch a new token. Must be called with ``self._lock`` held"""
+        cache = self.cache
+        have_lock = cache.add(self.lock_key, 1, timeout=self.lock_timeout)
+        if not have_lock:
+            # Another worker is refreshing; wait for it to publish the token
+            deadline = time.time() + self.wait_timeout
+            while time.time() < deadline:
+                time.sleep(self.poll_interval)
+                if self._load_shared(time.time()):
+                    self._count('shared_hits')
+                    return self._token
+            logger.warning("Timed out waiting for shared token refresh; fetching directly")
+
+        try:
+            token, expires_in = self._fetch()
+        except Exception:
+            self._count('failures')
+            raise
+        finally:
+            if have_lock:
+                cache.delete(self.lock_key)
+
+        self._count('refreshes')
+        self._store(token, expires_in)
+        return token
+
+    def _schedule_refresh(self):
+        with self._flag_lock:
+            if self._background_refresh:
+                return
+            self._background_refresh = True
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def _refresh_in_background(self):
+        try:
+            with self._lock:
+                # Another worker may already have published a fresher token
+                entry = self.cache.get(self.cache_key)
+                if entry and entry['expires_at'] > self._expires_at:
+                    self._token, self._expires_at = entry['token'], entry['expires_at']
+                    if time.time() < self._expires_at - self.refresh_margin:
+                        return
+                self._refresh()
+                self._count('background_refreshes')
+        except Exception:
+            logger.exception("Background access token refresh failed")
+        finally:
+            with self._flag_lock:
+                self._background_refresh = False
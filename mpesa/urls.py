@@ -1,24 +1,48 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
 
 app_name = 'mpesa'
 
+# Native async views only pay off under ASGI; WSGI deployments keep the sync ones
+daraja_views = async_views if getattr(settings, 'MPESA_ASYNC_VIEWS', False) else views
+
 urlpatterns = [
     # Payment form
     path('payment/', views.MpesaPaymentView.as_view(), name='payment_form'),
     
     # STK Push endpoint - FIXED: Match the frontend URL
-    path('stk-push/', views.stk_push_view, name='stk_push'),
+    path('stk-push/', daraja_views.stk_push_view, name='stk_push'),
+    
+    # Batch STK push for campaigns
+    path('stk-push/batch/', views.stk_push_batch_view, name='stk_push_batch'),
+    path('stk-push/batch/<uuid:batch_id>/', views.stk_push_batch_status, name='stk_push_batch_status'),
     
     # Callback endpoint
-    path('callback/', views.mpesa_callback, name='callback'),
+    path('callback/', daraja_views.mpesa_callback, name='callback'),
+    path('callback/<slug:merchant>/', daraja_views.mpesa_callback, name='merchant_callback'),
     
     # Transaction status - FIXED: Match the frontend URL pattern  
     path('transaction/<uuid:transaction_id>/status/', views.transaction_status, name='transaction_status'),
     
+    # Live status updates (Server-Sent Events)
+    path('transaction/<uuid:transaction_id>/events/', daraja_views.transaction_events, name='transaction_events'),
+    
     # Transaction history
     path('transactions/', views.transaction_history, name='transaction_history'),
     
+    # Staff search by phone number or receipt
+    path('transactions/search/', views.transaction_search, name='transaction_search'),
+    
     # Query status endpoint
-    path('query/<str:checkout_request_id>/', views.mpesa_query_status, name='query_status'),
+    path('query/<str:checkout_request_id>/', daraja_views.mpesa_query_status, name='query_status'),
+    
+    # Finance report from the rollup tables
+    path('reports/rollups/', views.transaction_rollups, name='transaction_rollups'),
+    
+    # Per-view profiling summary (MPESA_PROFILING)
+    path('reports/profile/', views.profile_report, name='profile_report'),
+    
+    # Prometheus scrape endpoint
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
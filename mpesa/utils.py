@@ -1,47 +1,172 @@
 import base64
-import requests
-from django.conf import settings
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-CONSUMER_KEY = os.getenv('CONSUMER_KEY')
-CONSUMER_SECRET = os.getenv('CONSUMER_SECRET')
-MPESA_PASSKEY = os.getenv('MPESA_PASSKEY')
-MPESA_SHORTCODE = os.getenv('MPESA_SHORTCODE')  # FIXED: Was using CONSUMER_KEY
-CALLBACK_URL = os.getenv('CALLBACK_URL')
-MPESA_BASE_URL = os.getenv('MPESA_BASE_URL')
-
-def generate_access_token():
-    """Generate M-Pesa access token"""
+import logging
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+from .merchants import get_merchant
+from .resilience import UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+def generate_access_token(merchant=None):
+    """Return a cached M-Pesa access token of ``merchant`` (default merchant if None), fetching one when needed"""
+    merchant = merchant or get_merchant()
     try:
-        # Create basic auth string
-        auth_string = f"{CONSUMER_KEY}:{CONSUMER_SECRET}"
-        auth_bytes = auth_string.encode('utf-8')
-        auth_b64 = base64.b64encode(auth_bytes).decode('utf-8')
-        
-        # Set headers
-        headers = {
-            'Authorization': f'Basic {auth_b64}',
-            'Content-Type': 'application/json'
-        }
-        
-        url = 'https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-        
-        # Make request
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            return response.json().get('access_token')
-        else:
-            print(f"Failed to get access token: {response.status_code} - {response.text}")
-            return None
-            
-    except Exception as e:
-        print(f"Error generating access token: {e}")
+        return merchant.token_manager.get_token()
+    except UpstreamUnavailable:
+        raise
+    except Exception:
+        logger.exception("Error generating access token merchant=%s", merchant.code)
         return None
 
+def generate_stk_password(shortcode, passkey):
+    """Return ``(password, timestamp)`` for an STK push or query request"""
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    password_string = f"{shortcode}{passkey}{timestamp}"
+    password = base64.b64encode(password_string.encode()).decode('utf-8')
+    return password, timestamp
+
+def build_stk_query_request(checkout_request_id, merchant=None):
+    """Build the Daraja STK query request body"""
+    merchant = merchant or get_merchant()
+    password, timestamp = generate_stk_password(merchant.shortcode, merchant.passkey)
+    return {
+        "BusinessShortCode": merchant.shortcode,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id
+    }
+
+def build_stk_push_request(phone_number, amount, account_reference=None, merchant=None):
+    """Build the Daraja STK push request body for ``merchant`` (a ``MerchantRoute``)"""
+    merchant = merchant or get_merchant()
+    password, timestamp = generate_stk_password(merchant.shortcode, merchant.passkey)
+    return {
+        "BusinessShortCode": merchant.shortcode,
+        "Password": password,
+        "Timestamp": timestamp,
+        "TransactionType": merchant.transaction_type,
+        "Amount": amount,
+        "PartyA": phone_number,
+        "PartyB": merchant.party_b,
+        "PhoneNumber": phone_number,
+        "CallBackURL": merchant.callback_url,
+        "AccountReference": account_reference or merchant.account_reference,
+        "TransactionDesc": merchant.transaction_desc,
+    }
+
+def apply_stk_push_response(transaction, status_code, response_data):
+    """Update a transaction from the STK push response and build the API result
+
+    The transaction is not saved; callers persist it (``save``, ``asave`` or
+    ``bulk_update``).
+    """
+    transaction.result_code = response_data.get('ResponseCode', response_data.get('errorCode', 'Unknown'))
+    transaction.result_desc = response_data.get('ResponseDescription', response_data.get('errorMessage', 'No description'))
+
+    if status_code == 200 and response_data.get('ResponseCode') == '0':
+        transaction.merchant_request_id = response_data.get('MerchantRequestID')
+        transaction.checkout_request_id = response_data.get('CheckoutRequestID')
+        transaction.status = 'PENDING'
+
+        return {
+            'success': True,
+            'message': 'STK Push sent successfully',
+            'transaction_id': str(transaction.id),
+            'checkout_request_id': response_data.get('CheckoutRequestID'),
+            'merchant_request_id': response_data.get('MerchantRequestID'),
+            'response_data': response_data
+        }
+
+    # Handle failure - FIXED: Better error code extraction
+    error_code = response_data.get('errorCode', response_data.get('ResponseCode', 'Unknown'))
+    error_message = response_data.get('errorMessage', response_data.get('ResponseDescription', 'STK Push failed'))
+    transaction.status = 'FAILED'
+    transaction.result_code = str(error_code)
+    transaction.result_desc = error_message
+
+    return {
+        'success': False,
+        'error': error_message,
+        'error_code': str(error_code),  # Ensure it's a string
+        'transaction_id': str(transaction.id),
+        'response_data': response_data
+    }
+
+def queued_result(transaction):
+    """Result of an STK push accepted for background dispatch, see outbox.py"""
+    return {
+        'success': True,
+        'queued': True,
+        'message': 'STK Push queued',
+        'transaction_id': str(transaction.id),
+    }
+
+def apply_upstream_unavailable(transaction, error):
+    """Fail a transaction whose STK push was refused by the rate limiter or circuit breaker
+
+    ``error`` is a ``resilience.UpstreamUnavailable``. Daraja was never
+    called, so the idempotency key is released for the retry the result asks
+    for. The transaction is not saved.
+    """
+    transaction.status = 'FAILED'
+    transaction.result_code = error.code
+    transaction.result_desc = str(error)
+    transaction.idempotency_key = None
+    return {
+        'success': False,
+        'error': str(error),
+        'error_code': error.code,
+        'retry_after': error.retry_after,
+        'transaction_id': str(transaction.id),
+    }
+
+def apply_requeue(transaction, error):
+    """Queue an STK push refused by the rate limiter or circuit breaker to be sent again
+
+    ``dispatch_stk_pushes`` sends it once ``error.retry_after`` seconds have
+    passed; Daraja was never called, so nothing is settled. The transaction
+    is not saved.
+    """
+    transaction.status = 'INITIATED'
+    transaction.claim_token = None
+    transaction.claimed_at = None
+    transaction.queued_at = timezone.now() + timedelta(seconds=error.retry_after)
+    return {
+        'success': False,
+        'queued': True,
+        'error': str(error),
+        'error_code': error.code,
+        'retry_after': error.retry_after,
+        'transaction_id': str(transaction.id),
+    }
+
+def apply_push_error(transaction, message):
+    """Fail a transaction whose STK push raised before Daraja answered
+
+    The idempotency key is released, so the client can retry with the same
+    key instead of being told the push is still being processed. The
+    transaction is not saved.
+    """
+    transaction.status = 'FAILED'
+    transaction.result_code = 'Unknown'
+    transaction.result_desc = message
+    transaction.idempotency_key = None
+    return {'success': False, 'error': message, 'transaction_id': str(transaction.id)}
+
+# Final STK result codes that don't mean plain failure
+RESULT_CODE_STATUSES = {
+    '0': 'SUCCESS',
+    '1032': 'CANCELLED',  # Request cancelled by user
+    '1037': 'TIMEOUT',    # User didn't respond in time
+}
+
+def status_for_result_code(result_code):
+    """Map a callback or STK query ``ResultCode`` to a transaction status"""
+    return RESULT_CODE_STATUSES.get(str(result_code), 'FAILED')
+
 def format_phone_number(phone_number):
     """Format phone number to M-Pesa required format (254XXXXXXXXX)"""
     # Remove any spaces, hyphens, or other characters
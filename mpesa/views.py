@@ -1,193 +1,168 @@
+import csv
+import itertools
 import json
-import base64
-from datetime import datetime
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction as db_transaction
 from django.shortcuts import render, get_object_or_404,redirect
-from django.http import HttpResponseBadRequest, JsonResponse, HttpResponse
+from django.http import Http404, HttpResponseBadRequest, HttpResponseNotModified, JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.views import View
+from django.utils import timezone
+from django.utils.http import parse_etags
 import requests
 from django.contrib import messages
-from .models import MpesaTransaction, MpesaCallback
-from .utils import generate_access_token, format_phone_number
+from .models import ArchivedTransaction, MpesaTransaction, MpesaCallback
+from .signals import send_transaction_updated
+from . import metrics, profiling, pubsub, status_cache
+from .status_cache import serialize_transaction_status
+from .pagination import InvalidPage, after_cursor, cursor_page
+from .client import get_client
+from .resilience import UpstreamUnavailable
+from .coalesce import coalesced_query
+from .idempotency import IdempotencyError, begin_stk_push, get_request_key
+from .batch import BatchError, submit_stk_push_batch
+from .outbox import dispatch_mode, enqueue_stk_push
+from .rollups import PERIODS as ROLLUP_PERIODS, parse_bound, summarize
+from .search import SEARCH_PARAMS, SearchError, search_transactions
+from .callbacks import (
+    apply_callback, build_callback_record, callback_mode, enqueue_callback, get_stk_callback,
+    is_duplicate_callback, parse_callback_metadata, settle_transaction,
+)
+from .merchants import UnknownMerchant, get_merchant, merchant_for_checkout
+from .utils import (
+    generate_access_token, format_phone_number, build_stk_push_request,
+    build_stk_query_request, apply_push_error, apply_stk_push_response, apply_upstream_unavailable,
+)
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-CONSUMER_KEY = os.getenv('CONSUMER_KEY')
-CONSUMER_SECRET = os.getenv('CONSUMER_SECRET')
-MPESA_PASSKEY = os.getenv('MPESA_PASSKEY')
-MPESA_SHORTCODE = os.getenv('MPESA_SHORTCODE')
-CALLBACK_URL = os.getenv('CALLBACK_URL')
-MPESA_BASE_URL = os.getenv('MPESA_BASE_URL')
 
-
-def initiate_stk_push(phone_number, amount):
+def initiate_stk_push(phone_number, amount, merchant=None):
     """Utility function to initiate STK push"""
     try:
-        url = 'https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
-        token = generate_access_token()
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password_string = f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}"
-        password = base64.b64encode(password_string.encode()).decode('utf-8')
-
-        request_body = {
-            "BusinessShortCode": MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerBuyGoodsOnline",
-            "Amount": amount,
-            "PartyA": phone_number,
-            "PartyB": 9445283,
-            "PhoneNumber": phone_number,
-            "CallBackURL": "https://ff18444b4591.ngrok-free.app/callback/",
-            "AccountReference": "INNOVESTRA TECH ENTERPRISES",
-            "TransactionDesc": "Payment purchase of bingwa products",
-        }
+        merchant = merchant or get_merchant()
+        token = generate_access_token(merchant)
+        request_body = build_stk_push_request(phone_number, amount, merchant=merchant)
 
-        response = requests.post(
-            url,
-            json=request_body,
-            headers=headers,
-        ).json()
+        response = get_client(merchant).stk_push(request_body, token).json()
 
         return response
 
     except Exception as e:
-        print(f"Failed to initiate STK Push: {str(e)}")
+        logger.exception("Failed to initiate STK Push")
         return e
 
 def query_stk(checkout_request_id):
-    """Utility function to query STK status"""
+    """Utility function to query STK status
+
+    Final transactions are answered from the database, with
+    ``source='local'`` (see ``coalesce.local_query_result``); concurrent
+    queries for the same checkout id share one upstream call.
+    """
+    with metrics.stage('query_stk', 'total'):
+        return coalesced_query(checkout_request_id, query_stk_upstream)
+
+def query_stk_upstream(checkout_request_id):
+    """Query STK status from M-Pesa"""
     try:
-        print(f"DEBUG: Querying STK status for: {checkout_request_id}")
+        logger.debug("STK query checkout_request_id=%s", checkout_request_id)
+        merchant = merchant_for_checkout(checkout_request_id)
         
-        access_token = generate_access_token()
+        with metrics.stage('query_stk', 'token'):
+            access_token = generate_access_token(merchant)
         if not access_token:
             return {'success': False, 'error': 'Failed to authenticate with M-Pesa'}
         
-        if not all([MPESA_SHORTCODE, MPESA_PASSKEY]):
+        if not merchant.configured:
             return {'success': False, 'error': 'Missing M-Pesa configuration'}
         
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password_string = f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}"
-        password = base64.b64encode(password_string.encode()).decode('utf-8')
-        
-        query_data = {
-            "BusinessShortCode": MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "CheckoutRequestID": checkout_request_id
-        }
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        url = 'https://api.safaricom.co.ke/mpesa/stkpushquery/v1/query'
-        print(f"DEBUG: Querying: {url}")
-        
-        response = requests.post(url, json=query_data, headers=headers, timeout=30)
+        query_data = build_stk_query_request(checkout_request_id, merchant)
+        with metrics.stage('query_stk', 'daraja'):
+            response = get_client(merchant).stk_query(query_data, access_token)
         response_data = response.json()
         
-        print(f"DEBUG: Query response: {response_data}")
+        logger.debug("STK query response checkout_request_id=%s response=%s", checkout_request_id, response_data)
+        metrics.result_codes.inc(
+            source='query', result_code=response_data.get('ResultCode', response_data.get('errorCode', 'Unknown')))
         
         return {
             'success': True,
+            'source': 'daraja',
             'response_data': response_data,
             'status_code': response.status_code
         }
         
+    except UpstreamUnavailable as e:
+        return {'success': False, 'error': str(e), 'error_code': e.code}
     except requests.exceptions.RequestException as e:
-        print(f"DEBUG: Query request exception: {str(e)}")
+        logger.warning("STK query network error checkout_request_id=%s error=%s", checkout_request_id, e)
         return {'success': False, 'error': f'Network error: {str(e)}'}
     except Exception as e:
-        print(f"DEBUG: Query exception: {str(e)}")
+        logger.exception("STK query failed checkout_request_id=%s", checkout_request_id)
         return {'success': False, 'error': str(e)}
 
-def process_stk_push(phone_number, amount, user=None):
-    """Process STK push and create transaction record"""
+def process_stk_push(phone_number, amount, user=None, idempotency_key=None, merchant=None):
+    """Process STK push and create transaction record
+
+    With an ``idempotency_key`` seen before, returns the original result
+    without calling M-Pesa again. ``merchant`` is a ``MerchantRoute``,
+    by default the default merchant.
+    """
+    transaction = None
+    merchant = merchant or get_merchant()
     try:
         # Create transaction record
-        transaction = MpesaTransaction.objects.create(
-            user=user if user and user.is_authenticated else None,
-            phone_number=phone_number,
-            amount=amount,
-            status='INITIATED'
-        )
+        with metrics.stage('process_stk_push', 'db_insert'):
+            transaction, replay = begin_stk_push(phone_number, amount, user, idempotency_key, merchant=merchant)
+        if replay is not None:
+            return replay
         
-        url = "https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-        token = generate_access_token()
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password_string = f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}"
-        password = base64.b64encode(password_string.encode()).decode('utf-8')
-
-        request_body = {
-            "BusinessShortCode": MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerBuyGoodsOnline",
-            "Amount": amount,
-            "PartyA": phone_number,
-            "PartyB": 9445283,
-            "PhoneNumber": phone_number,
-            "CallBackURL": CALLBACK_URL,
-            "AccountReference": "INNOVESTRA TECH ENTERPRISES",
-            "TransactionDesc": "Payment purchase of bingwa products",
-        }
+        with metrics.stage('process_stk_push', 'token'):
+            token = generate_access_token(merchant)
+        request_body = build_stk_push_request(phone_number, amount, transaction.account_reference, merchant)
 
-        response = requests.post(url, json=request_body, headers=headers)
-        response_data = response.json()
-        # Update transaction with response
-        transaction.result_code = response_data.get('ResponseCode', response_data.get('errorCode', 'Unknown'))
-        transaction.result_desc = response_data.get('ResponseDescription', response_data.get('errorMessage', 'No description'))
+        with metrics.stage('process_stk_push', 'daraja'):
+            response = get_client(merchant).stk_push(request_body, token)
+        result = apply_stk_push_response(transaction, response.status_code, response.json())
+        metrics.result_codes.inc(source='stk_push', result_code=transaction.result_code)
         
-        if response.status_code == 200 and response_data.get('ResponseCode') == '0':
-            transaction.merchant_request_id = response_data.get('MerchantRequestID')
-            transaction.checkout_request_id = response_data.get('CheckoutRequestID')
-            transaction.status = 'PENDING'
+        with metrics.stage('process_stk_push', 'db_update'):
             transaction.save()
+        send_transaction_updated(transaction.id)
+        logger.info("STK push transaction_id=%s status=%s result_code=%s",
+                    transaction.id, transaction.status, transaction.result_code)
+        return result
             
-            return {
-                'success': True,
-                'message': 'STK Push sent successfully',
-                'transaction_id': str(transaction.id),
-                'checkout_request_id': response_data.get('CheckoutRequestID'),
-                'merchant_request_id': response_data.get('MerchantRequestID'),
-                'response_data': response_data
-            }
-        else:
-            # Handle failure - FIXED: Better error code extraction
-            error_code = response_data.get('errorCode', response_data.get('ResponseCode', 'Unknown'))
-            error_message = response_data.get('errorMessage', response_data.get('ResponseDescription', 'STK Push failed'))
-            transaction.status = 'FAILED'
-            transaction.result_code = str(error_code)
-            transaction.result_desc = error_message
-            transaction.save()
-            
-            return {
-                'success': False,
-                'error': error_message,
-                'error_code': str(error_code),  # Ensure it's a string
-                'transaction_id': str(transaction.id),
-                'response_data': response_data
-            }
-            
+    except IdempotencyError:
+        raise
+    except UpstreamUnavailable as e:
+        logger.warning("STK push not sent: %s", e)
+        result = apply_upstream_unavailable(transaction, e)
+        transaction.save()
+        send_transaction_updated(transaction.id)
+        return result
     except requests.exceptions.RequestException as e:
-        print(f"Network error in STK Push: {str(e)}")
-        return {'success': False, 'error': f'Network error: {str(e)}'}
+        logger.warning("STK push network error: %s", e)
+        return fail_stk_push(transaction, f'Network error: {str(e)}')
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return {'success': False, 'error': str(e)}
+        logger.exception("STK push failed")
+        return fail_stk_push(transaction, str(e))
+
+def fail_stk_push(transaction, message):
+    """Record an STK push that raised, so its idempotency key isn't stuck in INITIATED"""
+    if transaction is None:
+        return {'success': False, 'error': message}
+    result = apply_push_error(transaction, message)
+    transaction.save()
+    send_transaction_updated(transaction.id)
+    return result
 
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -203,22 +178,95 @@ def stk_push_view(request):
         
         # Format phone number if needed
         phone_number = format_phone_number(phone_number)
+        merchant = get_merchant(data.get('merchant'))
+        
+        if dispatch_mode() == 'queued':
+            # Answer with the transaction id; dispatch_stk_pushes sends it
+            result = enqueue_stk_push(
+                phone_number=phone_number,
+                amount=amount,
+                user=request.user,
+                idempotency_key=get_request_key(request, data),
+                merchant=merchant
+            )
+            return JsonResponse(result, status=202)
         
         # Process the STK push
         result = process_stk_push(
             phone_number=phone_number,
             amount=amount,
-            user=request.user
+            user=request.user,
+            idempotency_key=get_request_key(request, data),
+            merchant=merchant
         )
         
         # Always return result with proper structure
         return JsonResponse(result)
             
+    except IdempotencyError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=e.status)
+    except UnknownMerchant as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
     except json.JSONDecodeError:
         return JsonResponse({'success': False, 'error': 'Invalid JSON data'}, status=400)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
+@csrf_exempt
+@require_http_methods(["POST"])
+def stk_push_batch_view(request):
+    """Start a batch of STK pushes and stream per-item results as NDJSON
+
+    Expects ``{"items": [{"phone_number": ..., "amount": ..., "account_reference": ...}]}``
+    and optionally the ``merchant`` code.
+    The first line carries the batch id, the last one a summary.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'success': False, 'error': 'Staff access required'}, status=403)
+    try:
+        data = json.loads(request.body)
+        batch = submit_stk_push_batch(
+            data.get('items') or [], user=request.user, merchant=get_merchant(data.get('merchant')),
+        )
+    except json.JSONDecodeError:
+        return JsonResponse({'success': False, 'error': 'Invalid JSON data'}, status=400)
+    except (BatchError, UnknownMerchant) as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    def stream():
+        yield json.dumps({'batch_id': str(batch.batch_id), 'count': len(batch)}) + '\n'
+        succeeded = queued = 0
+        for result in batch:
+            succeeded += result['success']
+            queued += result.get('queued', False)
+            result.pop('response_data', None)
+            yield json.dumps(result) + '\n'
+        yield json.dumps({
+            'batch_id': str(batch.batch_id),
+            'done': True,
+            'succeeded': succeeded,
+            'queued': queued,
+            'failed': len(batch) - succeeded - queued,
+        }) + '\n'
+
+    return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+def stk_push_batch_status(request, batch_id):
+    """Summarise the transactions of a batch"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff access required'}, status=403)
+    items = list(
+        MpesaTransaction.objects.filter(batch_id=batch_id)
+        .order_by('created_at')
+        .values('id', 'phone_number', 'amount', 'status', 'result_code', 'result_desc', 'checkout_request_id')
+    )
+    counts = {}
+    for item in items:
+        counts[item['status']] = counts.get(item['status'], 0) + 1
+        item['id'] = str(item['id'])
+        item['amount'] = str(item['amount'])
+    return JsonResponse({'batch_id': str(batch_id), 'counts': counts, 'transactions': items})
+
 # Keep the old function name for backward compatibility
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -226,119 +274,251 @@ def payment_processing(request):
     """Alias for stk_push_view for backward compatibility"""
     return stk_push_view(request)
 
-@csrf_exempt
-@require_http_methods(["POST"])
-def mpesa_callback(request):
-    """Handle M-Pesa callback notifications"""
+def process_callback(callback_data, merchant=None):
+    """Record an STK callback and update its transaction. Returns an HttpResponse
+
+    With ``merchant`` (the route named in the callback URL), callbacks for
+    another merchant's transactions are refused.
+    """
+    stk_callback = get_stk_callback(callback_data)
+    checkout_request_id = stk_callback.get('CheckoutRequestID')
+    
+    logger.info("Callback checkout_request_id=%s result_code=%s result_desc=%s",
+                checkout_request_id, stk_callback.get('ResultCode'), stk_callback.get('ResultDesc'))
+    
+    with metrics.stage('mpesa_callback', 'db_lookup'):
+        duplicate = is_duplicate_callback(stk_callback)
+    if duplicate:
+        logger.info("Duplicate callback ignored checkout_request_id=%s", checkout_request_id)
+        metrics.duplicate_callbacks.inc()
+        return HttpResponse('OK')
+    
+    # Find the transaction
     try:
-        callback_data = json.loads(request.body)
-        # Extract callback information
-        stk_callback = callback_data.get('Body', {}).get('stkCallback', {})
-        mpesa_receipt_number = stk_callback.get('MpesaReceiptNumber')
-        checkout_request_id = stk_callback.get('CheckoutRequestID')
-        result_code = stk_callback.get('ResultCode')
-        result_desc = stk_callback.get('ResultDesc')
-        
-        print(f"DEBUG: Callback details - ResultCode: {result_code}, ResultDesc: {result_desc}")
-        
-        # Find the transaction
-        try:
+        with metrics.stage('mpesa_callback', 'db_lookup'):
             transaction = MpesaTransaction.objects.get(
                 checkout_request_id=checkout_request_id
             )
-        except MpesaTransaction.DoesNotExist:
-            return HttpResponse('Transaction not found', status=404)
-        
-        # Create callback record
-        MpesaCallback.objects.create(
-            transaction=transaction,
-            mpesa_receipt_number=mpesa_receipt_number,
-            checkout_request_id=checkout_request_id,
-            result_code=str(result_code),
-            result_desc=result_desc,
-            callback_data=callback_data
-        )
-        
-        # Update transaction status based on result code
-        if result_code == 0:  # Success
-            transaction.status = 'SUCCESS'
-            transaction.result_code = str(result_code)
-            transaction.result_desc = result_desc
+    except MpesaTransaction.DoesNotExist:
+        logger.warning("Callback for unknown checkout_request_id=%s", checkout_request_id)
+        return HttpResponse('Transaction not found', status=404)
+    
+    if merchant is not None and transaction.merchant_id != merchant.id:
+        logger.warning("Callback for checkout_request_id=%s sent to merchant %s", checkout_request_id, merchant.code)
+        return HttpResponse('Transaction not found', status=404)
+    
+    metadata = parse_callback_metadata(stk_callback)
+    try:
+        with metrics.stage('mpesa_callback', 'db_update'), db_transaction.atomic():
+            # Create callback record; a concurrent redelivery fails the unique constraint
+            build_callback_record(transaction, callback_data, metadata).save()
             
-            # Extract callback metadata
-            callback_metadata = stk_callback.get('CallbackMetadata', {}).get('Item', [])
-            for item in callback_metadata:
-                name = item.get('Name')
-                value = item.get('Value')
-                
-                if name == 'MpesaReceiptNumber':
-                    transaction.mpesa_receipt_number = value
-                elif name == 'TransactionDate':
-                    try:
-                        # Convert M-Pesa date format to datetime
-                        transaction.transaction_date = datetime.strptime(str(value), '%Y%m%d%H%M%S')
-                    except ValueError:
-                        print(f"DEBUG: Could not parse transaction date: {value}")
-                    
-        else:  # Failed - FIXED: Handle specific failure codes
-            transaction.status = 'FAILED'
-            transaction.result_code = str(result_code)
-            transaction.result_desc = result_desc
-        
-        transaction.save()
-        
+            # Update transaction status based on result code, unless already settled
+            apply_callback(transaction, stk_callback, metadata)
+            settled = settle_transaction(transaction)
+    except IntegrityError:
+        metrics.duplicate_callbacks.inc()
         return HttpResponse('OK')
+    
+    if settled:
+        send_transaction_updated(transaction.id)
+    else:
+        logger.info("Callback for settled transaction_id=%s not applied", transaction.id)
+    
+    return HttpResponse('OK')
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def mpesa_callback(request, merchant=None):
+    """Handle M-Pesa callback notifications
+
+    ``/callback/<merchant>/`` is the callback URL of a configured merchant
+    and only settles its transactions.
+    Plain ``/callback/`` accepts any, as registered before merchants existed.
+    """
+    try:
+        route = get_merchant(merchant) if merchant else None
+    except UnknownMerchant:
+        return HttpResponse('Unknown merchant', status=404)
+    try:
+        if callback_mode() == 'queued':
+            # Acknowledge straight away; process_callbacks applies it later
+            with metrics.stage('mpesa_callback', 'enqueue'):
+                enqueue_callback(request.body, route)
+            return HttpResponse('OK')
+
+        callback_data = json.loads(request.body)
+        return process_callback(callback_data, route)
         
     except Exception as e:
+        logger.exception("Callback processing failed")
         return HttpResponse(f'Error: {str(e)}', status=500)
 
+def get_status_transaction(request, transaction_id):
+    """Fetch a transaction the requester may see, or raise Http404
+
+    Falls back to the archive for settled transactions moved there.
+    """
+    # Handle both authenticated and anonymous users
+    filters = {'id': transaction_id}
+    if request.user.is_authenticated:
+        filters['user'] = request.user
+    transaction = MpesaTransaction.objects.filter(**filters).first()
+    return transaction or get_object_or_404(ArchivedTransaction, **filters)
+
 def transaction_status(request, transaction_id):
-    """Check transaction status"""
+    """Check transaction status
+
+    Served from the status cache; answers 304 when the client's ETag is current.
+    """
     try:
-        # Handle both authenticated and anonymous users
-        if request.user.is_authenticated:
-            transaction = get_object_or_404(MpesaTransaction, id=transaction_id, user=request.user)
-        else:
-            transaction = get_object_or_404(MpesaTransaction, id=transaction_id)
-        
-        # FIXED: Include result_code in response for better error handling
-        return JsonResponse({
-            'transaction_id': str(transaction.id),
-            'status': transaction.status,
-            'amount': str(transaction.amount),
-            'phone_number': transaction.phone_number,
-            'mpesa_receipt_number': transaction.mpesa_receipt_number,
-            'transaction_date': transaction.transaction_date.isoformat() if transaction.transaction_date else None,
-            'result_desc': transaction.result_desc,
-            'result_code': transaction.result_code  # Include this for frontend error handling
-        })
-        
+        entry = status_cache.get_status_entry(transaction_id)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
+    
+    # Handle both authenticated and anonymous users
+    if entry is None or (request.user.is_authenticated and entry['user_id'] != request.user.id):
+        raise Http404('No MpesaTransaction matches the given query.')
+
+    etag = entry['etag']
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in parse_etags(if_none_match)):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(entry['body'], content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def status_event(transaction):
+    return f'event: status\ndata: {json.dumps(serialize_transaction_status(transaction))}\n\n'
+
+def event_stream_response(stream):
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+def transaction_events(request, transaction_id):
+    """Stream status changes of a transaction as Server-Sent Events
+
+    Sends the current status immediately, then every change published by the
+    callback handlers, and ends once the transaction reaches a final state or
+    after MPESA_SSE_MAX_SECONDS (the browser then reconnects). Under ASGI use
+    ``async_views.transaction_events``, which doesn't hold a thread per stream.
+    """
+    # Read the version first, so an update published while the row is loaded isn't missed
+    version = pubsub.current_version(transaction_id)
+    transaction = get_status_transaction(request, transaction_id)
+    max_seconds = getattr(settings, 'MPESA_SSE_MAX_SECONDS', 90)
+    keepalive = getattr(settings, 'MPESA_SSE_KEEPALIVE_SECONDS', 15)
+
+    def stream(version):
+        yield 'retry: 3000\n\n'
+        deadline = time.monotonic() + max_seconds
+        current = transaction
+        while True:
+            yield status_event(current)
+            if current.status in MpesaTransaction.TERMINAL_STATUSES:
+                return
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                new_version = pubsub.wait_for_update(transaction_id, version, min(keepalive, remaining))
+                if new_version != version:
+                    version = new_version
+                    break
+                yield ': keep-alive\n\n'
+            current = MpesaTransaction.objects.get(id=transaction_id)
+
+    return event_stream_response(stream(version))
+
+HISTORY_FIELDS = (
+    'id', 'amount', 'phone_number', 'status', 'mpesa_receipt_number',
+    'created_at', 'transaction_date', 'result_code', 'result_desc',
+)
+
+def serialize_history_row(row):
+    """Convert a ``.values(*HISTORY_FIELDS)`` row to its JSON form"""
+    return {
+        'id': str(row['id']),
+        'amount': str(row['amount']),
+        'phone_number': row['phone_number'],
+        'status': row['status'],
+        'mpesa_receipt_number': row['mpesa_receipt_number'],
+        'created_at': row['created_at'].isoformat(),
+        'transaction_date': row['transaction_date'].isoformat() if row['transaction_date'] else None,
+        'result_code': row['result_code'],
+        'result_desc': row['result_desc']
+    }
 
 def transaction_history(request):
-    """Get user's transaction history"""
+    """Get user's transaction history
+
+    Paginated newest first with an opaque ``cursor`` (from ``next_cursor``)
+    and ``limit``. ``?format=ndjson`` or ``?format=csv`` streams the whole
+    history from the cursor onwards instead.
+    """
     if request.user.is_authenticated:
-        transactions = MpesaTransaction.objects.filter(user=request.user).order_by('-created_at')
+        transactions = MpesaTransaction.objects.filter(user=request.user)
     else:
         # For anonymous users, return empty list
         transactions = MpesaTransaction.objects.none()
     
-    transactions_data = []
-    for transaction in transactions:
-        transactions_data.append({
-            'id': str(transaction.id),
-            'amount': str(transaction.amount),
-            'phone_number': transaction.phone_number,
-            'status': transaction.status,
-            'mpesa_receipt_number': transaction.mpesa_receipt_number,
-            'created_at': transaction.created_at.isoformat(),
-            'transaction_date': transaction.transaction_date.isoformat() if transaction.transaction_date else None,
-            'result_code': transaction.result_code,
-            'result_desc': transaction.result_desc
-        })
+    try:
+        transactions = after_cursor(transactions, request.GET.get('cursor')).values(*HISTORY_FIELDS)
+        export_format = request.GET.get('format', 'json')
+        if export_format in ('ndjson', 'csv'):
+            return stream_transaction_history(transactions, export_format)
+        return JsonResponse(cursor_page(transactions, request.GET.get('limit', 50), serialize_history_row))
+    except InvalidPage as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+def transaction_search(request):
+    """Search all transactions by phone number or receipt, for staff
+
+    ``q`` takes free text (``*5678`` for the last digits of a phone number);
+    ``phone``, ``phone_prefix``, ``phone_suffix``, ``receipt`` and
+    ``account_reference`` search one field. Paginated like the history.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff access required'}, status=403)
+    
+    try:
+        transactions = search_transactions(
+            MpesaTransaction.objects.all(),
+            request.GET.get('q'),
+            **{name: request.GET[name] for name in SEARCH_PARAMS if name in request.GET},
+        )
+        transactions = after_cursor(transactions, request.GET.get('cursor')).values(*HISTORY_FIELDS)
+        return JsonResponse(cursor_page(transactions, request.GET.get('limit', 50), serialize_history_row))
+    except (SearchError, InvalidPage) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+def stream_transaction_history(transactions, export_format):
+    """Stream ``.values()`` rows as NDJSON or CSV without loading them all"""
+    rows = transactions.iterator(chunk_size=getattr(settings, 'MPESA_HISTORY_CHUNK_SIZE', 2000))
     
-    return JsonResponse({'transactions': transactions_data})
+    if export_format == 'ndjson':
+        content = (json.dumps(serialize_history_row(row)) + '\n' for row in rows)
+        response = StreamingHttpResponse(content, content_type='application/x-ndjson')
+    else:
+        buffer = Echo()
+        writer = csv.DictWriter(buffer, fieldnames=HISTORY_FIELDS)
+        content = itertools.chain(
+            [writer.writeheader()],
+            (writer.writerow(serialize_history_row(row)) for row in rows),
+        )
+        response = StreamingHttpResponse(content, content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="transactions.csv"'
+    return response
+
+class Echo:
+    """File-like object whose write() returns the value, for streaming csv.writer output"""
+    
+    def write(self, value):
+        return value
 
 class MpesaPaymentView(View):
     """Render payment form"""
@@ -346,15 +526,82 @@ class MpesaPaymentView(View):
     def get(self, request):
         return render(request, 'mpesa/payment_form.html')
 
+def query_status_body(result):
+    """JSON body for a successful query: Daraja's answer, or the local status of a final transaction"""
+    if result.get('source') == 'local':
+        return {key: value for key, value in result.items() if key != 'success'}
+    return result['response_data']
+
 def mpesa_query_status(request, checkout_request_id):
     """Query STK Push status from M-Pesa API"""
     try:
         result = query_stk(checkout_request_id)
         
         if result['success']:
-            return JsonResponse(result['response_data'])
+            return JsonResponse(query_status_body(result))
         else:
-            return JsonResponse({'error': result['error']}, status=500)
+            # 503 when Daraja calls are paused by the rate limiter or circuit breaker
+            return JsonResponse({'error': result['error']}, status=503 if result.get('error_code') else 500)
         
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=500)
+
+def transaction_rollups(request):
+    """Settled counts, revenue and success rate per hour or day, for staff
+
+    Served from the pre-aggregated rollups. Accepts ``period`` (``hour`` or
+    ``day``), ``start`` and ``end`` (ISO dates or datetimes),
+    ``account_reference`` and ``merchant`` (a merchant code).
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff access required'}, status=403)
+    
+    period = request.GET.get('period', 'day')
+    if period not in ROLLUP_PERIODS:
+        return JsonResponse({'error': 'period must be hour or day'}, status=400)
+    step = timedelta(hours=1) if period == 'hour' else timedelta(days=1)
+    try:
+        end = parse_bound(request.GET['end']) if 'end' in request.GET else timezone.now()
+        start = parse_bound(request.GET['start']) if 'start' in request.GET else end - step * 30
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    max_periods = getattr(settings, 'MPESA_ROLLUP_MAX_PERIODS', 744)
+    if end <= start or (end - start) / step > max_periods:
+        return JsonResponse({'error': f'Range must cover 1 to {max_periods} periods'}, status=400)
+    
+    return JsonResponse({
+        'period': period,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'results': summarize(
+            period, start, end, request.GET.get('account_reference'), request.GET.get('merchant'),
+        ),
+    })
+
+def profile_report(request):
+    """Per-view query and Daraja timings of this process, for staff
+
+    Needs MPESA_PROFILING. ``?profiles=1`` adds the kept slow request
+    profiles; a POST clears everything.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff access required'}, status=403)
+    if not getattr(settings, 'MPESA_PROFILING', False):
+        return JsonResponse({'error': 'Profiling is off; set MPESA_PROFILING'}, status=404)
+    if request.method == 'POST':
+        profiling.stats.reset()
+    data = {'pid': os.getpid(), 'views': profiling.stats.summary()}
+    if request.GET.get('profiles'):
+        data['slow_requests'] = list(profiling.stats.slow)
+    return JsonResponse(data)
+
+def metrics_view(request):
+    """Expose payment flow metrics in the Prometheus text format
+
+    When MPESA_METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
+    token = getattr(settings, 'MPESA_METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse('Unauthorized', status=401)
+    return HttpResponse(metrics.REGISTRY.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
\ No newline at end of file